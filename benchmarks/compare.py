@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Compare two results files of the benchmark suite:
+
+    python -m benchmarks.compare BASE.json NEW.json [--threshold 0.1]
+
+Exit with status 1 when a benchmark of NEW is slower than BASE by more than
+the threshold, or runs more queries.
+"""
+import argparse
+import json
+import sys
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare two results files of the benchmark suite.")
+    parser.add_argument('base', help="Results of the reference commit.")
+    parser.add_argument('new', help="Results of the compared commit.")
+    parser.add_argument(
+        '-t', '--threshold', type=float, default=0.1,
+        help=(
+            "Tolerated throughput loss, as a fraction of the reference. "
+            "Defaults to 0.1."
+        ))
+    args = parser.parse_args(argv)
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    sys.stdout.write("{:<22} {:>12} {:>12} {:>8} {:>10} {:>10}\n".format(
+        "benchmark", "base items/s", "new items/s", "change",
+        "p99 ms", "queries"))
+    regressions = []
+    for name in sorted(set(base['results']) & set(new['results'])):
+        old, cur = base['results'][name], new['results'][name]
+        change = cur['items_per_sec'] / old['items_per_sec'] - 1
+        sys.stdout.write(
+            "{:<22} {:>12.1f} {:>12.1f} {:>+7.1%} {:>10} {:>10}\n".format(
+                name, old['items_per_sec'], cur['items_per_sec'], change,
+                '{:.2f}>{:.2f}'.format(old['p99_ms'], cur['p99_ms']),
+                '{:g}>{:g}'.format(
+                    old['queries_per_item'], cur['queries_per_item'])))
+        if change < -args.threshold:
+            regressions.append("{} is {:.1%} slower".format(name, -change))
+        if cur['queries_per_item'] > old['queries_per_item']:
+            regressions.append("{} runs more queries".format(name))
+    for regression in regressions:
+        sys.stdout.write("Regression: {}\n".format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
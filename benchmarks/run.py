@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite of mails rendering and sending.
+
+Run it from the repository root:
+
+    python -m benchmarks.run [--settings MODULE] [--iterations N]
+                             [--output FILE] [BENCHMARK ...]
+
+Benchmarks run on a test database created from the DATABASES setting, and
+mails are sent through the SMTP e-mail backend to an in-process SMTP sink.
+Results are written as JSON, to be compared between commits with
+`python -m benchmarks.compare`.
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+BENCHMARKS = []
+
+
+def benchmark(cls):
+    BENCHMARKS.append(cls)
+    return cls
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class Benchmark:
+    """A benchmarked operation. `run` is timed once per iteration, after an
+    untimed call to `prepare`. `items` is the number of mails, or calls,
+    handled by one run.
+    """
+
+    name = None
+    items = 1
+
+    def setup(self):
+        pass
+
+    def prepare(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError
+
+    def get_latencies(self):
+        """Return the latencies of the items of the last run, or None to use
+        the duration of the whole run divided by `items`."""
+        return None
+
+
+class RenderBenchmark(Benchmark):
+
+    def setup(self):
+        from django.template.loader import get_template
+        self.template = get_template('mailing/benchmark.html')
+        self.nb_mails = 0
+
+    def get_context(self):
+        return {
+            'first_name': "John",
+            'offers': [{
+                'slug': 'offer-{}'.format(i),
+                'title': "Offer #{}".format(i),
+                'description': "A great offer " * 10,
+                'price': i * 10,
+            } for i in range(10)],
+        }
+
+    def get_recipient(self):
+        self.nb_mails += 1
+        return 'John Doe <recipient{}@example.net>'.format(self.nb_mails)
+
+
+@benchmark
+class HtmlToText(RenderBenchmark):
+    name = 'html_to_text'
+
+    def setup(self):
+        super().setup()
+        from mailing.utils import html_to_text
+        self.html_to_text = html_to_text
+        self.html = self.template.render(self.get_context())
+
+    def run(self):
+        self.html_to_text(self.html)
+
+
+@benchmark
+class FilterBlacklisted(Benchmark):
+    name = 'filter_blacklisted'
+
+    def setup(self):
+        from mailing.models import Blacklist
+        self.manager = Blacklist.objects
+        self.manager.bulk_blacklist(
+            ('user{}@example.com'.format(i) for i in range(0, 20000, 2)),
+            reason=Blacklist.REASON_HARDBOUNCE)
+
+    def run(self):
+        self.manager.filter_blacklisted(
+            'John <User1@example.com>, user2@example.com, jane@example.org',
+            'cc@example.org', None)
+
+
+@benchmark
+class RenderMail(RenderBenchmark):
+    name = 'render_mail'
+
+    def setup(self):
+        super().setup()
+        from mailing.utils import render_mail
+        self.render_mail = render_mail
+        with open(self.template.origin.name) as f:
+            self.html_template = f.read()
+
+    def run(self):
+        self.render_mail(
+            "Offers for {{ first_name }}", self.html_template,
+            {'To': self.get_recipient(), 'Reply-To': 'offers@example.com'},
+            self.get_context())
+
+
+class CampaignBenchmark(RenderBenchmark):
+
+    def setup(self):
+        super().setup()
+        from mailing.models import Campaign, Subscription, SubscriptionType
+        self.campaign = Campaign.objects.filter(key='benchmark').first()
+        if self.campaign is not None:
+            return
+        subscription_type = SubscriptionType.objects.create(
+            name="Offers", description="Weekly offers")
+        # Recipients of even rank have a subscription.
+        Subscription.objects.bulk_set_subscribed(
+            ('recipient{}@example.net'.format(i) for i in range(0, 20000, 2)),
+            [subscription_type.pk], subscribed=True)
+        self.campaign = Campaign.objects.create(
+            key='benchmark', name="Benchmark",
+            subject="Offers for {{ first_name }}",
+            subscription_type=subscription_type)
+        self.campaign.extra_headers.create(
+            name='Reply-To', value='offers@example.com')
+        self.campaign.extra_headers.create(
+            name='List-Unsubscribe',
+            value='<{{ mailing.subscriptions_management_url }}>')
+
+
+@benchmark
+class RenderCampaignMail(CampaignBenchmark):
+    name = 'render_campaign_mail'
+
+    def setup(self):
+        super().setup()
+        from mailing.utils import render_campaign_mail
+        self.render_campaign_mail = render_campaign_mail
+
+    def run(self):
+        self.render_campaign_mail(
+            self.campaign, self.get_context(),
+            extra_headers={'To': self.get_recipient()})
+
+
+@benchmark
+class QueueMail(CampaignBenchmark):
+    name = 'queue_mail'
+
+    def setup(self):
+        super().setup()
+        from mailing.utils import queue_mail
+        self.queue_mail = queue_mail
+
+    def run(self):
+        self.queue_mail(
+            'benchmark', self.get_context(), {'To': self.get_recipient()})
+
+
+@benchmark
+class SendQueuedMails(RenderBenchmark):
+    name = 'send_queued_mails'
+    items = 20
+
+    def setup(self):
+        super().setup()
+        from django.utils import timezone
+        from mailing.models import Mail
+        from mailing.signals import post_send
+        from mailing.utils import send_queued_mails
+        self.Mail = Mail
+        self.send_queued_mails = send_queued_mails
+        self.html_body = self.template.render(self.get_context())
+        self.scheduled_on = timezone.now() - timedelta(minutes=1)
+        self.latencies = []
+        post_send.connect(self.post_send, sender=Mail)
+
+    def post_send(self, sender, durations, **kwargs):
+        self.latencies.append(sum(durations.values()))
+
+    def prepare(self):
+        self.latencies = []
+        self.Mail.objects.bulk_create([
+            self.Mail(
+                subject="Offers for John", html_body=self.html_body,
+                status=self.Mail.STATUS_PENDING,
+                scheduled_on=self.scheduled_on,
+                inline_headers={
+                    'From': 'offers@example.com',
+                    'To': self.get_recipient(),
+                })
+            for i in range(self.items)
+        ])
+
+    def run(self):
+        self.send_queued_mails()
+
+    def get_latencies(self):
+        return self.latencies
+
+
+def run_benchmark(benchmark, iterations):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    benchmark.setup()
+    # The first run warms caches up and counts queries.
+    benchmark.prepare()
+    with CaptureQueriesContext(connection) as queries:
+        benchmark.run()
+    latencies = []
+    total = 0
+    for i in range(iterations):
+        benchmark.prepare()
+        started = time.perf_counter()
+        benchmark.run()
+        elapsed = time.perf_counter() - started
+        total += elapsed
+        latencies.extend(
+            benchmark.get_latencies() or
+            [elapsed / benchmark.items] * benchmark.items)
+    return {
+        'items_per_sec': benchmark.items * iterations / total,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'queries_per_item': len(queries) / benchmark.items,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark mails rendering and sending.")
+    parser.add_argument(
+        'benchmarks', nargs='*', metavar='BENCHMARK',
+        help="Benchmarks to run, among: {}. Defaults to all.".format(
+            ', '.join(b.name for b in BENCHMARKS)))
+    parser.add_argument(
+        '--settings', default='benchmarks.settings',
+        help="Django settings module. Defaults to benchmarks.settings.")
+    parser.add_argument(
+        '-n', '--iterations', type=int, default=200,
+        help="Number of timed runs of each benchmark. Defaults to 200.")
+    parser.add_argument(
+        '-o', '--output',
+        help="Path of the JSON results file. Defaults to standard output.")
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - {b.name for b in BENCHMARKS}
+    if unknown:
+        parser.error("Unknown benchmarks: {}".format(', '.join(unknown)))
+
+    os.environ['DJANGO_SETTINGS_MODULE'] = args.settings
+    import django
+    django.setup()
+    from django.db import connection
+    from django.test.utils import (
+        override_settings, setup_databases, teardown_databases,
+    )
+    from mailing.smtpsink import SMTPSink
+
+    sink = SMTPSink()
+    host, port = sink.start()
+    databases = setup_databases(verbosity=0, interactive=False)
+    results = {}
+    try:
+        with override_settings(EMAIL_HOST=host, EMAIL_PORT=port):
+            for cls in BENCHMARKS:
+                if args.benchmarks and cls.name not in args.benchmarks:
+                    continue
+                result = results[cls.name] = run_benchmark(
+                    cls(), args.iterations)
+                sys.stderr.write(
+                    "{:<22} {:>9.1f} items/s  p50 {:>7.2f} ms  "
+                    "p99 {:>7.2f} ms  {:>5.1f} queries/item\n".format(
+                        cls.name, result['items_per_sec'], result['p50_ms'],
+                        result['p99_ms'], result['queries_per_item']))
+        vendor = connection.vendor
+    finally:
+        teardown_databases(databases, verbosity=0)
+        sink.stop()
+
+    output = json.dumps({
+        'meta': {
+            'commit': get_commit(),
+            'date': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': vendor,
+            'iterations': args.iterations,
+        },
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Settings of the benchmark suite.
+
+Benchmarks run on a test database created from DATABASES, SQLite by default.
+To run them on PostgreSQL, write a settings module importing these ones and
+overriding DATABASES, then pass it with --settings.
+"""
+import os
+
+from django_mailing.settings import *  # noqa
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MIDDLEWARE = []
+
+ROOT_URLCONF = 'benchmarks.urls'
+
+TEMPLATES[0]['DIRS'] = [os.path.join(BENCHMARKS_DIR, 'templates')]  # noqa
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCHMARKS_DIR, 'benchmarks.sqlite3'),
+    },
+}
+
+# Mails are sent to the SMTP sink started by the benchmark runner.
+EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
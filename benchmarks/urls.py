@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+from django.conf.urls import include, url
+
+urlpatterns = [
+    url(r'^mailing/', include('mailing.urls')),
+]
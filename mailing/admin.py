@@ -1,35 +1,54 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
-from itertools import product
+import json
 import re
 
 from django.conf import settings
 from django.conf.urls import url
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import SEARCH_VAR, ChangeList
+from django.core.exceptions import ValidationError
+from django.core.paginator import EmptyPage, Paginator
+from django.db import connections
 from django.db.models import Q
-from django.db.models.functions import Lower
 from django import forms
 from django.http import HttpResponseRedirect
 from django.template.response import TemplateResponse
 from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html, format_html_join
+from django.utils.http import urlencode
+from django.utils.safestring import mark_safe
+from django.utils.text import smart_split, unescape_string_literal
 from django.utils.translation import ugettext_lazy as _
 
-from .conf import pytz_is_available, SUBJECT_PREFIX
+from .conf import (
+    pytz_is_available, SUBJECT_PREFIX, ADMIN_COUNT_LIMIT, ADMIN_DATE_HIERARCHY,
+    ADMIN_KEYSET_PAGINATION,
+)
 from .forms import (
-    CampaignMailHeaderForm, MailHeaderForm, CampaignStaticAttachmentForm,
-    MailStaticAttachmentForm,
+    CampaignMailHeaderForm, MailHeaderForm, MailForm,
+    CampaignStaticAttachmentForm, MailStaticAttachmentForm,
 )
 from .models import (
     Campaign, CampaignMailHeader, CampaignStaticAttachment,
-    Mail, MailHeader, MailStaticAttachment, MailDynamicAttachment,
-    SubscriptionType, Subscription, Blacklist,
+    Mail, MailHeader, MailRecipient, MailStaticAttachment,
+    MailDynamicAttachment,
+    MailArchive, MailArchiveHeader, MailArchiveStaticAttachment,
+    MailArchiveDynamicAttachment, SubscriptionType, Subscription, Blacklist,
+    OutboxMail,
 )
 
 __all__ = [
     'CampaignMailHeaderInline', 'MailHeaderInline',
     'CampaignStaticAttachmentInline', 'MailStaticAttachmentInline',
-    'MailDynamicAttachmentInline', 'CampaignAdmin', 'MailAdmin',
+    'MailDynamicAttachmentInline', 'MailArchiveHeaderInline',
+    'MailArchiveStaticAttachmentInline', 'MailArchiveDynamicAttachmentInline',
+    'EstimatedCountPaginator', 'MailChangeList', 'KeysetMailChangeList',
+    'CampaignAdmin', 'MailAdmin', 'MailArchiveAdmin',
     'SubscriptionTypeAdmin', 'SubscriptionAdmin', 'BlacklistAdmin',
+    'OutboxMailAdmin',
 ]
 
 
@@ -62,6 +81,162 @@ class MailDynamicAttachmentInline(admin.TabularInline):
     extra = 1
 
 
+class ReadOnlyInline(admin.TabularInline):
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class MailArchiveHeaderInline(ReadOnlyInline):
+    model = MailArchiveHeader
+
+
+class MailArchiveStaticAttachmentInline(ReadOnlyInline):
+    model = MailArchiveStaticAttachment
+
+
+class MailArchiveDynamicAttachmentInline(ReadOnlyInline):
+    model = MailArchiveDynamicAttachment
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator counting at most ADMIN_COUNT_LIMIT objects.
+
+    Beyond the limit, an unfiltered list is counted from the table size
+    estimated by the database, when available. See `conf.ADMIN_COUNT_LIMIT`.
+    As such a count is not exact, pages past it are still served as long as
+    they are not empty.
+    """
+
+    @property
+    def count_is_capped(self):
+        return bool(ADMIN_COUNT_LIMIT) and self.count >= ADMIN_COUNT_LIMIT
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if not self.count_is_capped:
+                raise
+            # An integer greater than the number of pages counted.
+            return int(number)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if number <= self.num_pages:
+            return super().page(number)
+        bottom = (number - 1) * self.per_page
+        object_list = list(self.object_list[bottom:bottom + self.per_page])
+        if not object_list:
+            raise EmptyPage(_("That page contains no results"))
+        return self._get_page(object_list, number, self)
+
+    @cached_property
+    def count(self):
+        if not ADMIN_COUNT_LIMIT:
+            return super().count
+        queryset = self.object_list
+        count = queryset.order_by().values('pk')[:ADMIN_COUNT_LIMIT].count()
+        if count < ADMIN_COUNT_LIMIT or queryset.query.where:
+            return count
+        return max(count, self.estimate_count(queryset) or 0)
+
+    @staticmethod
+    def estimate_count(queryset):
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        if connection.vendor == 'postgresql':
+            sql = "SELECT reltuples FROM pg_class WHERE oid = %s::regclass"
+        elif connection.vendor == 'mysql':
+            sql = (
+                "SELECT table_rows FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = %s"
+            )
+        else:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+        return int(row[0]) if row and row[0] else None
+
+
+class MailChangeList(ChangeList):
+    """Mails changelist that does not load mail bodies."""
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer(
+            'html_body', 'text_body', 'failure_reason', 'inline_headers')
+
+
+class KeysetMailChangeList(MailChangeList):
+    """Mails changelist paginated by primary key ranges rather than page
+    numbers. See `conf.ADMIN_KEYSET_PAGINATION`.
+    """
+
+    keyset_pagination = True
+    BEFORE_VAR = 'before'
+
+    def __init__(self, request, *args, **kwargs):
+        try:
+            self.before = int(request.GET.get(self.BEFORE_VAR, 0)) or None
+        except ValueError:
+            raise IncorrectLookupParameters
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        params = super().get_filters_params(params)
+        params.pop(self.BEFORE_VAR, None)
+        return params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # Changing filters, search or date must go back to the first page.
+        new_params = new_params or {}
+        remove = list(remove or [])
+        if self.BEFORE_VAR not in new_params:
+            remove.append(self.BEFORE_VAR)
+        return super().get_query_string(new_params, remove)
+
+    def get_ordering(self, request, queryset):
+        return ['-pk']
+
+    def get_results(self, request):
+        queryset = self.queryset
+        if self.before is not None:
+            queryset = queryset.filter(pk__lt=self.before)
+        result_list = list(queryset[:self.list_per_page + 1])
+        self.multi_page = len(result_list) > self.list_per_page
+        self.result_list = result_list[:self.list_per_page]
+        self.result_count = len(self.result_list)
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.can_show_all = False
+        # Only there for the pagination template tag, which needs one.
+        self.paginator = Paginator(self.result_list, self.list_per_page)
+        self.first_page_url = None
+        self.next_page_url = None
+        if self.before is not None:
+            self.first_page_url = self.get_query_string()
+        if self.multi_page:
+            self.next_page_url = self.get_query_string(
+                {self.BEFORE_VAR: self.result_list[-1].pk})
+
+
+def json_escape(value):
+    """Return `value` as it appears within JSON strings stored by
+    JSONTextField, to look for it in their raw text."""
+    return json.dumps(value, ensure_ascii=False)[1:-1]
+
+
+email_re = re.compile(r'^[^\s@:,]+@[^\s@:,]+$')
+domain_re = re.compile(r'^@[^\s@:,]+$')
+
+
 @admin.register(Campaign)
 class CampaignAdmin(admin.ModelAdmin):
 
@@ -109,16 +284,17 @@ class CampaignAdmin(admin.ModelAdmin):
         )
 
 
-@admin.register(Mail)
-class MailAdmin(admin.ModelAdmin):
+class BaseMailAdmin(admin.ModelAdmin):
 
     list_display = [
         'subject', 'campaign', 'scheduled_on', 'sent_on', 'status',
     ]
     list_filter = ['status', 'campaign']
-    search_fields = ['subject', 'headers__value']
-    if not settings.USE_TZ or pytz_is_available:
+    search_fields = ['subject', 'headers__value', 'inline_headers']
+    if ADMIN_DATE_HIERARCHY and (not settings.USE_TZ or pytz_is_available):
         date_hierarchy = 'scheduled_on'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = not ADMIN_COUNT_LIMIT
 
     fieldsets = [
         (_("Properties"), {'fields': [
@@ -128,24 +304,61 @@ class MailAdmin(admin.ModelAdmin):
             'status', 'sent_on', 'failure_reason',
         ]}),
         (_("E-mail"), {'fields': [
-            'subject', 'html_body', 'text_body',
+            'inline_headers_display', 'subject', 'html_body', 'text_body',
         ]}),
     ]
 
-    inlines = [
-        MailHeaderInline, MailStaticAttachmentInline,
-        MailDynamicAttachmentInline
-    ]
-    readonly_fields = ['sent_on', 'failure_reason']
-
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('campaign')
 
+    def get_changelist(self, request, **kwargs):
+        if ADMIN_KEYSET_PAGINATION:
+            return KeysetMailChangeList
+        return MailChangeList
+
+    def get_sortable_by(self, request):
+        if ADMIN_KEYSET_PAGINATION:
+            return []
+        return super().get_sortable_by(request)
+
+    def inline_headers_display(self, obj):
+        return format_html_join(
+            mark_safe('<br>'), '{}: {}', (obj.inline_headers or {}).items())
+    inline_headers_display.short_description = _("headers")
+
     def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
         try:
-            return self.get_headers_search_results(request, queryset, search_term)
+            results, use_distinct = self.get_headers_search_results(
+                request, queryset, search_term)
         except Exception:
-            return super().get_search_results(request, queryset, search_term)
+            results, use_distinct = self.get_text_search_results(
+                request, queryset, search_term)
+        # Addresses and domains are also looked for in the recipients index.
+        if email_re.match(search_term):
+            recipients = queryset.sent_to(search_term)
+        elif domain_re.match(search_term):
+            recipients = queryset.sent_to_domain(search_term[1:])
+        else:
+            return results, use_distinct
+        return queryset.filter(
+            Q(pk__in=results.values('pk')) |
+            Q(pk__in=recipients.values('pk'))), False
+
+    def get_text_search_results(self, request, queryset, search_term):
+        # Like the default search on `search_fields`, except that words are
+        # looked for in the JSON text of inline headers as they are encoded.
+        query = Q()
+        for bit in smart_split(search_term):
+            if bit[:1] in ('"', "'") and bit[-1:] == bit[:1]:
+                bit = unescape_string_literal(bit)
+            query &= (
+                Q(subject__icontains=bit) | Q(headers__value__icontains=bit) |
+                Q(inline_headers__icontains=json_escape(bit))
+            )
+        return queryset.filter(query), True
 
     def get_headers_search_results(self, request, queryset, search_term):
         terms = re.split(r'(?:^|\s+)([a-z0-9,_-]+:(?:".*?"|[^ ]+))(?:\s+|$)', search_term)
@@ -167,9 +380,113 @@ class MailAdmin(admin.ModelAdmin):
                     headers__name__iexact=headers[0],
                     headers__value__icontains=header_value
                 )
+            # Mails storing their headers inline: look for both the header
+            # name and the value in the JSON text.
+            names_query = Q()
+            for header in headers:
+                names_query |= Q(inline_headers__icontains='"{}": '.format(
+                    json_escape(header)))
+            query |= names_query & Q(
+                inline_headers__icontains=json_escape(header_value))
         return queryset.filter(query), True
 
 
+@admin.register(Mail)
+class MailAdmin(BaseMailAdmin):
+
+    form = MailForm
+    inlines = [
+        MailHeaderInline, MailStaticAttachmentInline,
+        MailDynamicAttachmentInline
+    ]
+    readonly_fields = ['sent_on', 'failure_reason', 'inline_headers_display']
+
+    @staticmethod
+    def stores_headers_inline(obj):
+        # New mails store their headers inline, as rendered mails do.
+        return obj is None or obj.inline_headers is not None
+
+    def get_fieldsets(self, request, obj=None):
+        fieldsets = super().get_fieldsets(request, obj)
+        if self.stores_headers_inline(obj) and (obj is None or obj.status in (
+                Mail.STATUS_DRAFT, Mail.STATUS_PENDING)):
+            # Headers of mails not sent yet may still be edited.
+            fieldsets = [
+                (name, dict(options, fields=[
+                    'headers_text' if field == 'inline_headers_display'
+                    else field for field in options['fields']
+                ]))
+                for name, options in fieldsets
+            ]
+        return fieldsets
+
+    def get_inline_instances(self, request, obj=None):
+        inlines = super().get_inline_instances(request, obj)
+        if self.stores_headers_inline(obj):
+            # Header rows are ignored for mails storing headers inline.
+            inlines = [
+                inline for inline in inlines
+                if not isinstance(inline, MailHeaderInline)
+            ]
+        return inlines
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        # Mails moved to the archive keep their primary key: redirect there.
+        # Invalid primary keys are left to the stock "doesn't exist" message.
+        try:
+            pk = Mail._meta.pk.to_python(object_id)
+        except ValidationError:
+            pk = None
+        if (pk is not None and not Mail.objects.filter(pk=pk).exists() and
+                MailArchive.objects.filter(pk=pk).exists()):
+            return HttpResponseRedirect(reverse(
+                'admin:mailing_mailarchive_change', args=[pk]))
+        return super().change_view(request, object_id, form_url, extra_context)
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Headers may have changed: rebuild the recipients index.
+        mail = form.instance
+        mail.recipients.all().delete()
+        MailRecipient.objects.bulk_create(MailRecipient.objects.from_headers(
+            dict(mail.headers.items()), mail=mail))
+
+    def changelist_view(self, request, extra_context=None):
+        # Mails moved to the archive are no longer listed here: tell when a
+        # search also matches archived mails.
+        search_term = request.GET.get(SEARCH_VAR, '').strip()
+        if search_term and request.method == 'GET':
+            archive_admin = self.admin_site._registry.get(MailArchive)
+            if archive_admin is not None and archive_admin.has_view_permission(
+                    request):
+                archived, use_distinct = archive_admin.get_search_results(
+                    request, MailArchive.objects.all(), search_term)
+                if archived.exists():
+                    self.message_user(request, format_html(
+                        _('Archived mails also match this search: '
+                          '<a href="{}">see them</a>.'),
+                        '{}?{}'.format(
+                            reverse('admin:mailing_mailarchive_changelist'),
+                            urlencode({SEARCH_VAR: search_term}))))
+        return super().changelist_view(request, extra_context)
+
+
+@admin.register(MailArchive)
+class MailArchiveAdmin(BaseMailAdmin):
+
+    inlines = [
+        MailArchiveHeaderInline, MailArchiveStaticAttachmentInline,
+        MailArchiveDynamicAttachmentInline
+    ]
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_readonly_fields(self, request, obj=None):
+        return [f.name for f in self.model._meta.fields] + [
+            'inline_headers_display']
+
+
 @admin.register(SubscriptionType)
 class SubscriptionTypeAdmin(admin.ModelAdmin):
     list_display = [
@@ -196,34 +513,20 @@ class SubscriptionAdmin(admin.ModelAdmin):
         'email', 'subscription_type', 'subscribed',
     ]
     list_filter = ['subscription_type', 'subscribed']
+    list_select_related = ['subscription_type']
     search_fields = ['email']
     actions = [unsubscribe]
 
     def bulk_subscription_management_view(self, request, *args, **kwargs):
         form = BulkSubscriptionManagementForm(request.POST or None)
         if request.method == 'POST' and form.is_valid():
-            emails = set(
-                x.lower() for x in form.cleaned_data['emails'].splitlines()
-            )
-            unsubscribe = form.cleaned_data['unsubscribe'].values_list(
-                'id', flat=True)
-            pairs = set(product(emails, unsubscribe))
-            queryset = (
-                Subscription.objects.annotate(lower_email=Lower('email'))
-                .filter(
-                    lower_email__in=emails,
-                    subscription_type_id__in=unsubscribe,
-                )
-            )
-            pairs_to_update = set(
-                queryset.values_list('lower_email', 'subscription_type_id')
-            )
-            pairs_to_insert = pairs - pairs_to_update
-            Subscription.objects.bulk_create([
-                Subscription(email=x[0], subscription_type_id=x[1])
-                for x in pairs_to_insert
-            ])
-            queryset.update(subscribed=False)
+            nb_updated, nb_created = Subscription.objects.bulk_set_subscribed(
+                form.cleaned_data['emails'].splitlines(),
+                form.cleaned_data['unsubscribe'].values_list('id', flat=True),
+                subscribed=False)
+            self.message_user(request, _(
+                "{updated} subscriptions updated, {created} created."
+            ).format(updated=nb_updated, created=nb_created))
             return HttpResponseRedirect(
                 reverse('admin:mailing_subscription_changelist'))
         context = dict(
@@ -251,3 +554,24 @@ class BlacklistAdmin(admin.ModelAdmin):
         'reported_on', 'email', 'reason',
     ]
     list_display_links = ['reported_on', 'email']
+
+
+@admin.register(OutboxMail)
+class OutboxMailAdmin(admin.ModelAdmin):
+    list_display = [
+        'pk', 'created_on', 'campaign_key', 'status', 'failure_reason',
+    ]
+    list_filter = ['status']
+    readonly_fields = [
+        'campaign_key', 'context', 'extra_headers', 'options', 'status',
+        'failure_reason', 'created_on',
+    ]
+    actions = ['retry']
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry(self, request, queryset):
+        queryset.update(
+            status=OutboxMail.STATUS_PENDING, failure_reason='')
+    retry.short_description = _("Render selected outbox mails again")
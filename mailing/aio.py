@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+"""Coroutines queuing mails from asynchronous code, and sending them over
+many SMTP sessions on a single event loop.
+
+Database access, template rendering and MIME building are blocking: they are
+offloaded to a thread once per call or batch, with `asgiref.sync_to_async`
+when available (Django 3.0 and later), or else a dedicated thread.
+"""
+import asyncio
+import base64
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+import re
+from smtplib import (
+    SMTPException, SMTPRecipientsRefused, SMTPResponseException,
+    SMTPServerDisconnected,
+)
+import ssl
+
+from django.conf import settings
+from django.core.mail.message import sanitize_address
+from django.core.mail.utils import DNS_NAME
+from django.db import connections
+from django.utils import timezone
+
+from .models import Mail
+from .queues import get_queue
+from .signals import pre_send, post_send, batch_finished
+from .utils import _build_message, _timed, queue_mail, render_mail
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+__all__ = [
+    'AsyncSMTPConnection', 'aqueue_mail', 'arender_mail', 'run_sync',
+    'send_queued_mails_async',
+]
+
+
+@lru_cache(maxsize=None)
+def _get_executor():
+    # A single thread, so that database connections are not shared.
+    return ThreadPoolExecutor(1, thread_name_prefix='mailing-sync')
+
+
+def _close_old_connections():
+    # Like Django around each request, so that CONN_MAX_AGE is honored and
+    # connections dropped by the server are replaced. Connections within a
+    # transaction of the caller are left alone.
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close_if_unusable_or_obsolete()
+
+
+def _call(func, *args, **kwargs):
+    _close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _close_old_connections()
+
+
+def run_sync(func, *args, **kwargs):
+    """Return an awaitable of the result of the blocking function `func`,
+    run in a thread. Database connections which are unusable or older than
+    CONN_MAX_AGE are closed before and after the call."""
+    if sync_to_async is not None:
+        return sync_to_async(_call, thread_sensitive=True)(
+            func, *args, **kwargs)
+    return asyncio.get_event_loop().run_in_executor(
+        _get_executor(), partial(_call, func, *args, **kwargs))
+
+
+async def arender_mail(subject, html_template, headers, context=None,
+                       **kwargs):
+    """Coroutine version of `render_mail`.
+
+    Templates are rendered and the mail saved in a single call offloaded to
+    a thread, within a transaction of its own.
+    """
+    return await run_sync(
+        render_mail, subject, html_template, headers, context, **kwargs)
+
+
+async def aqueue_mail(campaign_key=None, context=None, extra_headers=None,
+                      **kwargs):
+    """Coroutine version of `queue_mail`.
+
+    Fetching the campaign, rendering templates and saving the mail happen in
+    a single call offloaded to a thread, so that the event loop keeps
+    handling requests meanwhile. Context values lazily querying the database
+    are evaluated in that thread too.
+    """
+    return await run_sync(
+        queue_mail, campaign_key, context, extra_headers, **kwargs)
+
+
+class AsyncSMTPConnection:
+    """Minimal asyncio SMTP client sending messages over a single session,
+    configured by the EMAIL_* settings of Django unless given otherwise.
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 use_tls=None, use_ssl=None, timeout=None):
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.username = (
+            settings.EMAIL_HOST_USER if username is None else username)
+        self.password = (
+            settings.EMAIL_HOST_PASSWORD if password is None else password)
+        self.use_tls = settings.EMAIL_USE_TLS if use_tls is None else use_tls
+        self.use_ssl = settings.EMAIL_USE_SSL if use_ssl is None else use_ssl
+        self.timeout = (
+            settings.EMAIL_TIMEOUT if timeout is None else timeout) or 60
+        self.reader = self.writer = None
+        self.extensions = set()
+
+    def get_ssl_context(self):
+        context = ssl.create_default_context()
+        if settings.EMAIL_SSL_CERTFILE:
+            context.load_cert_chain(
+                settings.EMAIL_SSL_CERTFILE, settings.EMAIL_SSL_KEYFILE)
+        return context
+
+    async def open(self):
+        context = self.get_ssl_context() if (
+            self.use_ssl or self.use_tls) else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                self.host, self.port, ssl=context if self.use_ssl else None),
+            self.timeout)
+        await self.expect(220)
+        local_hostname = await asyncio.get_event_loop().run_in_executor(
+            None, DNS_NAME.get_fqdn)
+        await self.ehlo(local_hostname)
+        if self.use_tls:
+            await self.command('STARTTLS', 220)
+            await self.writer.start_tls(context, server_hostname=self.host)
+            await self.ehlo(local_hostname)
+        if self.username and self.password:
+            credentials = '\0{}\0{}'.format(self.username, self.password)
+            await self.command(
+                'AUTH PLAIN ' + base64.b64encode(
+                    credentials.encode()).decode(), 235)
+
+    async def ehlo(self, local_hostname):
+        code, lines = await self.command('EHLO ' + local_hostname, 250)
+        self.extensions = {
+            line.split()[0].upper() for line in lines[1:] if line}
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            await self.command('QUIT', 221)
+        except (SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.abort()
+
+    def abort(self):
+        """Close the connection without ending the session."""
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def read_reply(self):
+        lines = []
+        while True:
+            line = await asyncio.wait_for(
+                self.reader.readline(), self.timeout)
+            if not line:
+                raise SMTPServerDisconnected(
+                    "Connection unexpectedly closed")
+            lines.append(line[4:].strip().decode('utf-8', 'replace'))
+            if line[3:4] != b'-':
+                return int(line[:3]), lines
+
+    async def expect(self, expected_code):
+        code, lines = await self.read_reply()
+        if code != expected_code:
+            raise SMTPResponseException(code, '\n'.join(lines))
+        return code, lines
+
+    async def command(self, line, expected_code=None):
+        self.writer.write(line.encode() + b'\r\n')
+        if expected_code is None:
+            return await self.read_reply()
+        return await self.expect(expected_code)
+
+    @staticmethod
+    def get_envelope(email_message):
+        """Return the (from_addr, to_addrs, data) arguments of `sendmail` for
+        an `EmailMessage` instance, as the SMTP e-mail backend of Django
+        would send it."""
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        return (
+            sanitize_address(email_message.from_email, encoding),
+            [sanitize_address(addr, encoding)
+             for addr in email_message.recipients()],
+            email_message.message().as_bytes(linesep='\r\n'),
+        )
+
+    async def send(self, email_message):
+        """Send an `EmailMessage` instance."""
+        await self.sendmail(*self.get_envelope(email_message))
+
+    async def sendmail(self, from_addr, to_addrs, data):
+        """Send `data` to `to_addrs` and return the recipients refused, like
+        `smtplib.SMTP.sendmail`."""
+        if not to_addrs:
+            return {}
+        await self.command('MAIL FROM:<{}>'.format(from_addr), 250)
+        refused = {}
+        for addr in to_addrs:
+            code, lines = await self.command('RCPT TO:<{}>'.format(addr))
+            if code not in (250, 251):
+                refused[addr] = (code, '\n'.join(lines))
+        if len(refused) == len(to_addrs):
+            await self.command('RSET', 250)
+            raise SMTPRecipientsRefused(refused)
+        await self.command('DATA', 354)
+        # Dot-stuffing, as smtplib does.
+        data = re.sub(br'(?m)^\.', b'..', data)
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        self.writer.write(data + b'.\r\n')
+        await self.expect(250)
+        return refused
+
+
+def _claim_and_build(queue, limit, durations):
+    """Claim mails and build their messages. Return 4-tuples (mail, message,
+    envelope, durations), where message is an exception if building it
+    failed, or None if the mail must not be sent."""
+    with _timed(durations, 'db'):
+        mails = queue.claim(limit)
+    items = []
+    for mail in mails:
+        pre_send.send(
+            sender=Mail, mail=mail, mail_id=mail.pk,
+            campaign_key=mail.campaign.key if mail.campaign else None)
+        mail_durations = defaultdict(float)
+        envelope = None
+        try:
+            with _timed(mail_durations, 'mime'):
+                msg = _build_message(mail)
+                if msg is not None:
+                    envelope = AsyncSMTPConnection.get_envelope(msg)
+        except Exception as e:
+            msg = e
+        durations['mime'] += mail_durations['mime']
+        items.append((mail, msg, envelope, mail_durations))
+    return items
+
+
+async def _open_connection():
+    connection = AsyncSMTPConnection()
+    try:
+        await connection.open()
+    except BaseException:
+        connection.abort()
+        raise
+    return connection
+
+
+async def _send_session(outbox, results, durations):
+    """Send messages from `outbox` over a single SMTP session, reconnecting
+    after connection errors."""
+    connection = None
+    try:
+        while True:
+            try:
+                mail, msg, envelope, mail_durations = outbox.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            exception = None
+            with _timed(mail_durations, 'smtp'):
+                try:
+                    if connection is None:
+                        connection = await _open_connection()
+                    await connection.sendmail(*envelope)
+                except SMTPRecipientsRefused as e:
+                    exception = e
+                except SMTPResponseException as e:
+                    exception = e
+                    if connection is not None:
+                        try:
+                            await connection.command('RSET', 250)
+                        except Exception:
+                            connection.abort()
+                            connection = None
+                except Exception as e:
+                    # The session is no longer usable.
+                    exception = e
+                    if connection is not None:
+                        connection.abort()
+                        connection = None
+            durations['smtp'] += mail_durations['smtp']
+            results.append((mail, msg, exception, mail_durations))
+    finally:
+        if connection is not None:
+            await connection.close()
+
+
+def _record(queue, now, results, durations):
+    successes = []
+    failures = []
+    skipped = []
+    for mail, msg, exception, mail_durations in results:
+        if exception is not None:
+            mail.failure_reason = str(exception)
+            failures.append(mail)
+        elif msg is None:
+            skipped.append(mail)
+        else:
+            successes.append(mail)
+        post_send.send(
+            sender=Mail, mail=mail, mail_id=mail.pk,
+            campaign_key=mail.campaign.key if mail.campaign else None,
+            message=msg if exception is None else None, exception=exception,
+            durations=dict(mail_durations))
+    with _timed(durations, 'db'):
+        queue.ack(successes, now)
+        queue.nack(failures)
+        # Mails of campaigns in debug mode without DEBUG_EMAIL stay pending.
+        queue.nack(skipped, retry=True)
+    nb_successes = len(successes)
+    nb_failures = len(results) - nb_successes
+    batch_finished.send(
+        sender=Mail, nb_successes=nb_successes, nb_failures=nb_failures,
+        durations=dict(durations))
+    return nb_successes, nb_failures
+
+
+async def send_queued_mails_async(limit=None, sessions=20):
+    """Like `send_queued_mails`, but send mails over at most `sessions`
+    concurrent SMTP sessions to the EMAIL_HOST, whatever the EMAIL_BACKEND.
+
+    Claiming mails and building their messages, then recording their status,
+    each happen in a single offload to a thread. `post_send` is sent for
+    each mail once the batch is sent.
+    """
+    now = timezone.now()
+    durations = defaultdict(float)
+    queue = get_queue()
+    items = await run_sync(_claim_and_build, queue, limit, durations)
+
+    results = []
+    outbox = asyncio.Queue()
+    for mail, msg, envelope, mail_durations in items:
+        if msg is None:
+            results.append((mail, None, None, mail_durations))
+        elif isinstance(msg, Exception):
+            results.append((mail, None, msg, mail_durations))
+        elif not envelope[1]:
+            # Like Django e-mail backends, consider mails without recipients
+            # as sent.
+            results.append((mail, msg, None, mail_durations))
+        else:
+            outbox.put_nowait((mail, msg, envelope, mail_durations))
+    await asyncio.gather(*[
+        _send_session(outbox, results, durations)
+        for i in range(min(sessions, outbox.qsize()))
+    ])
+    return await run_sync(_record, queue, now, results, durations)
@@ -7,3 +7,9 @@ from django.utils.translation import ugettext_lazy as _
 class MailingConfig(AppConfig):
     name = 'mailing'
     verbose_name = _("Mailing")
+
+    def ready(self):
+        from .conf import METRICS_ENABLED
+        if METRICS_ENABLED:
+            from .metrics import connect_receivers
+            connect_receivers()
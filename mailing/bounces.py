@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+from collections import defaultdict, namedtuple
+from email.feedparser import BytesFeedParser
+from email.parser import BytesParser, HeaderParser
+import os
+
+from django.db import transaction
+
+from .models import Mail, Blacklist
+
+__all__ = [
+    'Bounce', 'parse_dsn', 'iter_mbox', 'iter_maildir', 'record_bounces',
+]
+
+Bounce = namedtuple('Bounce', 'mail_id recipient hard status diagnostic')
+Bounce.__doc__ = """A failed or delayed delivery reported by a DSN.
+
+`mail_id` is the primary key of the bounced Mail, or None if the original
+message could not be identified. `hard` tells permanent failures apart from
+temporary ones.
+"""
+
+
+def _get_mail_id(message):
+    # The X-Mail-Id header is added by Mail.get_headers. Reporting MTAs
+    # return the original message, or only its headers, in the DSN.
+    for part in message.walk():
+        if part.get_content_type() == 'text/rfc822-headers':
+            headers = HeaderParser().parsestr(
+                part.get_payload(decode=True).decode('ascii', 'replace'))
+            value = headers.get('X-Mail-Id')
+        else:
+            value = part.get('X-Mail-Id')
+        if value and value.strip().isdigit():
+            return int(value)
+    return None
+
+
+def _get_address(value):
+    # Recipient fields are typed, such as "rfc822; john@example.com".
+    return value.split(';', 1)[-1].strip()
+
+
+def parse_dsn(message):
+    """Return the list of bounces reported by the given delivery status
+    notification, as email.message.Message.
+
+    Messages that are not a DSN, and recipients that were delivered,
+    relayed or expanded, are ignored.
+    """
+    if message.get_content_type() != 'multipart/report':
+        return []
+    bounces = []
+    mail_id = _get_mail_id(message)
+    for part in message.walk():
+        if part.get_content_type() != 'message/delivery-status':
+            continue
+        # The first block holds per-message fields, the following ones
+        # per-recipient fields.
+        for fields in part.get_payload()[1:]:
+            action = (fields.get('Action') or '').strip().lower()
+            if action not in ('failed', 'delayed'):
+                continue
+            recipient = fields.get('Final-Recipient') or fields.get(
+                'Original-Recipient')
+            if not recipient:
+                continue
+            status = (fields.get('Status') or '').strip()
+            bounces.append(Bounce(
+                mail_id=mail_id,
+                recipient=_get_address(recipient),
+                hard=action == 'failed' and status.startswith('5'),
+                status=status,
+                diagnostic=' '.join((fields.get('Diagnostic-Code') or '').split()),
+            ))
+    return bounces
+
+
+def iter_mbox(path):
+    """Yield the messages of the mbox file at `path`.
+
+    The file is read line by line, so that only one message is held in
+    memory at a time, whatever the size of the mailbox.
+    """
+    with open(path, 'rb') as f:
+        parser = None
+        for line in f:
+            # Lines starting with "From " within messages are escaped.
+            if line.startswith(b'From '):
+                if parser is not None:
+                    yield parser.close()
+                parser = BytesFeedParser()
+            elif parser is not None:
+                parser.feed(line)
+        if parser is not None:
+            yield parser.close()
+
+
+def iter_maildir(path):
+    """Yield the paths of the message files of the Maildir at `path`."""
+    for subdir in ('new', 'cur'):
+        with os.scandir(os.path.join(path, subdir)) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    yield entry.path
+
+
+def read_message(path):
+    with open(path, 'rb') as f:
+        return BytesParser().parse(f)
+
+
+def record_bounces(bounces):
+    """Record the given bounces in one transaction.
+
+    Sent mails that hard bounced are marked as failed, those that soft
+    bounced only get a failure reason. Hard bounced addresses are
+    blacklisted with REASON_HARDBOUNCE. Mails are updated with one query per
+    distinct bounce status, rather than one per mail. Return the number of
+    newly blacklisted addresses.
+    """
+    # Hard bounces come last so that they prevail for mails having both.
+    updates = defaultdict(set)
+    for bounce in sorted(bounces, key=lambda b: b.hard):
+        if bounce.mail_id is not None:
+            updates[bounce.hard, bounce.status].add(bounce.mail_id)
+    with transaction.atomic():
+        for (hard, status), pks in updates.items():
+            fields = {'failure_reason': "{} bounce ({})".format(
+                "Hard" if hard else "Soft", status or "unknown status")}
+            if hard:
+                fields['status'] = Mail.STATUS_FAILURE
+            Mail.objects.filter(
+                pk__in=pks, status=Mail.STATUS_SENT).update(**fields)
+        emails = [b.recipient for b in bounces if b.hard]
+        nb_created, nb_existing = Blacklist.objects.bulk_blacklist(
+            emails, batch_size=len(emails) or 1,
+            reason=Blacklist.REASON_HARDBOUNCE)
+    return nb_created
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
 import os
+import tempfile
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
@@ -10,6 +11,11 @@ __all__ = [
     'TEMPLATES_UPLOAD_DIR', 'ATTACHMENTS_DIR', 'ATTACHMENTS_UPLOAD_DIR',
     'SUBJECT_PREFIX', 'UNEXISTING_CAMPAIGN_FAIL_SILENTLY',
     'MIRROR_SIGNING_SALT', 'SUBSCRIPTION_SIGNING_SALT', 'DEBUG_EMAIL',
+    'MIRROR_MAX_AGE', 'MIRROR_CACHE',
+    'ADMIN_COUNT_LIMIT', 'ADMIN_DATE_HIERARCHY', 'ADMIN_KEYSET_PAGINATION',
+    'SUBSCRIPTION_CACHE_TIMEOUT', 'SUBSCRIPTION_CACHE',
+    'SUBSCRIPTION_CACHE_MAX_ENTRIES', 'METRICS_ENABLED', 'METRICS_CACHE',
+    'PROFILE_DIR', 'QUEUE_BACKEND', 'QUEUE_OPTIONS', 'OUTBOX_ENABLED',
     'TextConfRef', 'StrConfRef', 'pytz_is_available',
 ]
 
@@ -108,6 +114,129 @@ If not given, mails which campaigns are in debug mode will stay in state
 "pending" until the debug mode is deactivated.
 """
 
+MIRROR_MAX_AGE = get_setting('MIRROR_MAX_AGE', 30 * 24 * 3600)
+"""Number of seconds browsers may cache mirror pages of sent mails, which never
+change. Responses are marked private since mails may hold personal data.
+
+Defaults to 30 days.
+"""
+
+MIRROR_CACHE = get_setting('MIRROR_CACHE', None)
+"""Alias of a cache from your CACHES setting, where to keep mirror pages of sent
+mails so that they are served without querying the database.
+
+Defaults to None, which means mirror pages are not cached server-side.
+"""
+
+ADMIN_COUNT_LIMIT = get_setting('ADMIN_COUNT_LIMIT', 10000)
+"""Maximum number of mails counted to paginate the mails admin changelists.
+
+Beyond this limit, the number of mails of an unfiltered changelist is the
+table size estimated by the database (PostgreSQL and MySQL only), and the
+number of mails of a filtered changelist is the limit itself. Pages past
+that number are still served, as long as they list mails.
+
+Set it to None to always count mails exactly.
+
+Defaults to 10000.
+"""
+
+ADMIN_DATE_HIERARCHY = get_setting('ADMIN_DATE_HIERARCHY', True)
+"""Whether to display the date drill-down navigation on mails admin
+changelists. It runs extra aggregate queries on every page load, so you may
+want to disable it when the mails table is very large.
+
+Defaults to True.
+"""
+
+ADMIN_KEYSET_PAGINATION = get_setting('ADMIN_KEYSET_PAGINATION', False)
+"""Set this to True to paginate mails admin changelists by primary key ranges
+rather than page numbers. Pages are then sorted by descending primary key and
+only offer "next page" navigation, but they load in constant time however far
+you browse and never count mails.
+
+Defaults to False.
+"""
+
+SUBSCRIPTION_CACHE_TIMEOUT = get_setting('SUBSCRIPTION_CACHE_TIMEOUT', 0)
+"""Number of seconds the subscription state of an e-mail address to a
+subscription type may be cached, so that several mails sent to the same
+recipient do not query subscriptions again.
+
+Defaults to 0, which means subscriptions are not cached.
+"""
+
+SUBSCRIPTION_CACHE = get_setting('SUBSCRIPTION_CACHE', None)
+"""Alias of a cache from your CACHES setting, where to cache subscription
+states, and the subscription types listed by the subscriptions management
+page for 60 seconds. Use a shared cache backend so that subscription changes
+are seen by every process as soon as they are saved. Otherwise they are cached
+in the memory of each process, and changes made by other processes are only
+seen once SUBSCRIPTION_CACHE_TIMEOUT, or 60 seconds for subscription types,
+has elapsed.
+
+Defaults to None, which means subscription states and types are cached in the
+memory of each process.
+"""
+
+SUBSCRIPTION_CACHE_MAX_ENTRIES = get_setting(
+    'SUBSCRIPTION_CACHE_MAX_ENTRIES', 10000)
+"""Maximum number of subscription states cached in the memory of each process
+when SUBSCRIPTION_CACHE is None. The least recently used ones are evicted
+first.
+
+Defaults to 10000.
+"""
+
+METRICS_ENABLED = get_setting('METRICS_ENABLED', False)
+"""Set this to True to expose metrics of the mail queue in Prometheus text
+format at the "metrics/" URL of mailing.urls, and to record send counters and
+latency histograms.
+
+Defaults to False.
+"""
+
+METRICS_CACHE = get_setting('METRICS_CACHE', None)
+"""Alias of a cache from your CACHES setting, where to keep send counters and
+latency histograms. Use a shared cache backend supporting atomic increments so
+that the metrics view reports what every process, such as the sending daemon,
+recorded.
+
+Defaults to None, which means counters are kept in the memory of each
+process, and only those of the process serving the metrics view are reported.
+"""
+
+PROFILE_DIR = get_setting('PROFILE_DIR', os.path.join(
+    tempfile.gettempdir(), 'mailing-profiles'))
+"""The directory where the sending daemon writes the `.prof` files of
+profiled batches when run with --profile.
+
+Defaults to "<system temporary directory>/mailing-profiles"
+"""
+
+QUEUE_BACKEND = get_setting('QUEUE_BACKEND', 'mailing.queues.DatabaseQueue')
+"""Dotted path of the queue backend class through which queue_mail hands
+mails over and send_queued_mails claims them. See mailing.queues.
+
+Defaults to "mailing.queues.DatabaseQueue", which polls the mails table.
+"""
+
+QUEUE_OPTIONS = get_setting('QUEUE_OPTIONS', {})
+"""Keyword arguments passed to the QUEUE_BACKEND class, such as `url` for
+mailing.queues.RedisQueue.
+
+Defaults to {}.
+"""
+
+OUTBOX_ENABLED = get_setting('OUTBOX_ENABLED', False)
+"""Whether `queue_mail` only records the campaign key, context and headers of
+mails in the outbox, to be rendered after the current transaction is
+committed by the sending daemon or the `process_outbox` command. May be
+overridden by passing `outbox` to `queue_mail`.
+
+Defaults to False.
+"""
+
 
 @deconstructible
 class TextConfRef:
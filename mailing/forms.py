@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
 from django import forms
+from django.db import transaction
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from .models import (
-    CampaignMailHeader, MailHeader, Subscription, SubscriptionType,
+    CampaignMailHeader, Mail, MailHeader, Subscription, SubscriptionType,
     CampaignStaticAttachment, MailStaticAttachment,
 )
+from .models.manager import normalize_email
 
 __all__ = [
-    'CampaignMailHeaderForm', 'MailHeaderForm', 'SubscriptionsManagementForm',
+    'CampaignMailHeaderForm', 'MailHeaderForm', 'MailForm',
+    'SubscriptionsManagementForm',
     'CampaignStaticAttachmentForm', 'MailStaticAttachmentForm',
 ]
 
@@ -37,36 +41,103 @@ class MailHeaderForm(forms.ModelForm):
         }
 
 
+class MailForm(forms.ModelForm):
+    """Mail form editing the headers stored inline, as "Name: value" lines,
+    when its `headers_text` field is included."""
+
+    headers_text = forms.CharField(
+        label=_("headers"), required=False,
+        widget=forms.Textarea(attrs={'rows': 4}),
+        help_text=_("One header per line, as \"Name: value\"."))
+
+    class Meta:
+        model = Mail
+        fields = '__all__'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if 'headers_text' in self.fields and self.instance.inline_headers:
+            self.fields['headers_text'].initial = '\n'.join(
+                '{}: {}'.format(name, value)
+                for name, value in self.instance.inline_headers.items())
+
+    def clean_headers_text(self):
+        headers = {}
+        for line in self.cleaned_data['headers_text'].splitlines():
+            if not line.strip():
+                continue
+            name, sep, value = line.partition(':')
+            if not sep or not name.strip():
+                raise forms.ValidationError(
+                    _("Invalid header line: %(line)s"), code='invalid',
+                    params={'line': line})
+            headers[name.strip()] = value.strip()
+        return headers
+
+    def save(self, commit=True):
+        if 'headers_text' in self.fields:
+            self.instance.inline_headers = self.cleaned_data['headers_text']
+        return super().save(commit)
+
+
 class SubscriptionsManagementForm(forms.Form):
 
     def __init__(self, *args, **kwargs):
         self.email = kwargs.pop('email')
-        subscription_types = SubscriptionType.objects.all()
-        for subscription_type in subscription_types:
-            self.base_fields['subscribed_{}'.format(subscription_type.pk)] = (
+        self.normalized_email = normalize_email(self.email)
+        super().__init__(*args, **kwargs)
+        self.subscriptions = {
+            s.subscription_type_id: s
+            for s in Subscription.objects.filter(
+                normalized_email=self.normalized_email)
+        }
+        for subscription_type in SubscriptionType.objects.cached():
+            subscription = self.subscriptions.get(subscription_type.pk)
+            if subscription is not None:
+                initial = subscription.subscribed
+            else:
+                initial = subscription_type.subscribed_by_default
+            self.fields['subscribed_{}'.format(subscription_type.pk)] = (
                 forms.BooleanField(
                     label=subscription_type.name,
                     help_text=subscription_type.description,
-                    initial=subscription_type.is_subscribed(self.email),
+                    initial=initial,
                     required=False,
                 )
             )
-        super().__init__(*args, **kwargs)
 
     def save(self):
-        subscriptions = {
-            s.subscription_type_id: s
-            for s in Subscription.objects.filter(email=self.email)
-        }
-
+        to_create = []
+        to_update = {True: [], False: []}
+        subscription_type_ids = []
         for field, value in self.cleaned_data.items():
             pk = int(field.split('_')[-1])
-            if pk not in subscriptions:
-                Subscription(email=self.email, subscription_type_id=pk,
-                             subscribed=value).save()
-            elif subscriptions[pk].subscribed != value:
-                subscriptions[pk].subscribed = value
-                subscriptions[pk].save()
+            subscription_type_ids.append(pk)
+            if pk not in self.subscriptions:
+                to_create.append(Subscription(
+                    email=self.email, normalized_email=self.normalized_email,
+                    subscription_type_id=pk, subscribed=value))
+            elif self.subscriptions[pk].subscribed != value:
+                to_update[value].append(self.subscriptions[pk].pk)
+
+        with transaction.atomic():
+            if to_create:
+                # Subscription types are cached: some may have been deleted
+                # meanwhile.
+                existing = set(SubscriptionType.objects.filter(
+                    pk__in=subscription_type_ids,
+                ).values_list('pk', flat=True))
+                to_create = [
+                    subscription for subscription in to_create
+                    if subscription.subscription_type_id in existing
+                ]
+            Subscription.objects.bulk_create(to_create, ignore_conflicts=True)
+            for subscribed, pks in to_update.items():
+                if pks:
+                    Subscription.objects.filter(pk__in=pks).update(
+                        subscribed=subscribed, last_modified=timezone.now())
+            Subscription.objects.clear_cache(
+                [self.normalized_email], subscription_type_ids)
 
 
 class CampaignStaticAttachmentForm(forms.ModelForm):
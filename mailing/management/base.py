@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
+from datetime import date, datetime, timedelta
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ..models import Mail, MailArchive
+
+__all__ = [
+    'OldMailsCommand',
+]
+
+
+class OldMailsCommand(BaseCommand):
+    """Base class for commands processing, by batches, the mails scheduled
+    more than a given number of days ago.
+
+    Unless `archived_option` is False, the `--archived` option processes the
+    mails moved to the archive tables instead.
+    """
+
+    archived_option = True
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'days', type=int,
+            help="Number of days to keep archived until today.")
+        if self.archived_option:
+            parser.add_argument(
+                '-a', '--archived', action='store_true',
+                help=(
+                    "Process mails moved to the archive tables by "
+                    "move_mails_to_archive instead of the mails table."
+                ))
+        parser.add_argument(
+            '-e', '--exclude-statuses', nargs='*', default=[], type=str,
+            help=(
+                "Ignore mails at the given statuses. This can be either "
+                "statuses uppercased name of integer value."
+            ))
+        parser.add_argument(
+            '-o', '--only-statuses', nargs='*', default=[], type=str,
+            help=(
+                "Only process mails at the given statuses. This can be either "
+                "statuses uppercased name or integer value."
+            ))
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=1000,
+            help=(
+                "Number of mails processed per transaction. Mails are "
+                "processed by ascending primary key. Defaults to 1000."
+            ))
+        parser.add_argument(
+            '-s', '--sleep', type=float, default=0,
+            help=(
+                "Number of seconds to wait between two batches, to let the "
+                "database breathe. Defaults to 0."
+            ))
+
+    def get_model(self, options):
+        """Return the model of the mails to process: Mail or MailArchive."""
+        return MailArchive if options.get('archived') else Mail
+
+    def get_queryset(self, options):
+        """Return the mails matching command line options. Exit with an error
+        message if options are invalid.
+        """
+        self.init_statuses()
+        if options['batch_size'] < 1:
+            self.stderr.write("Batch size must be a positive integer")
+            sys.exit(1)
+        try:
+            only_statuses = set(
+                map(self.parse_status, options['only_statuses']))
+            exclude_statuses = set(
+                map(self.parse_status, options['exclude_statuses']))
+        except ValueError as e:
+            self.stderr.write(str(e))
+            sys.exit(1)
+
+        until = date.today() - timedelta(days=options['days'])
+        # A plain range on the column (rather than `scheduled_on__date`) lets
+        # the database use the (status, scheduled_on) index.
+        before = datetime.combine(until, datetime.min.time())
+        if settings.USE_TZ:
+            before = timezone.make_aware(before)
+
+        mails = self.get_model(options).objects.filter(
+            scheduled_on__lt=before)
+        if only_statuses:
+            mails = mails.filter(status__in=only_statuses)
+        if exclude_statuses:
+            mails = mails.exclude(status__in=exclude_statuses)
+        return mails
+
+    def process_batches(self, mails, options, process, verb):
+        """Call `process` with lists of primary keys of `mails`, `batch_size`
+        at a time, and report progress. `process` must return the number of
+        mails it processed.
+        """
+        started = time.monotonic()
+        processed = 0
+        for pks in mails.pk_chunks(options['batch_size']):
+            processed += process(pks)
+            if options['verbosity'] > 1:
+                self.stdout.write(self.progress(processed, started, verb))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        if options['verbosity'] > 0:
+            self.stdout.write(self.progress(processed, started, verb))
+        return processed
+
+    @staticmethod
+    def progress(processed, started, verb):
+        elapsed = time.monotonic() - started
+        return "{} mails {} in {:.1f}s ({:.0f} mails/s)".format(
+            processed, verb, elapsed, processed / elapsed if elapsed else 0)
+
+    def init_statuses(self):
+        self.statuses = {}
+        for prop in dir(Mail):
+            if prop.startswith("STATUS_") and prop != "STATUS_CHOICES":
+                self.statuses[prop[7:]] = getattr(Mail, prop)
+
+    def parse_status(self, status):
+        if status in self.statuses:
+            return self.statuses[status]
+        elif status.isdigit():
+            return int(status)
+        else:
+            raise ValueError("{} is not a valid status".format(status))
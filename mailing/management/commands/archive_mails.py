@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
+from collections import defaultdict
+from email.generator import BytesGenerator
+from email.utils import format_datetime
+import gzip
+from io import BytesIO
+import json
+import os
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from ..base import OldMailsCommand
+
+
+class Command(OldMailsCommand):
+    help = """Archive mails past given period into a JSON Lines or mbox file,
+    optionally deleting them once archived."""
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            'output',
+            help=(
+                "Path of the archive file. If it already exists, mails are "
+                "appended to it."
+            ))
+        parser.add_argument(
+            '-f', '--format', choices=['jsonl', 'mbox'], default='jsonl',
+            help="Format of the archive file. Defaults to jsonl.")
+        parser.add_argument(
+            '--no-compress', action='store_false', dest='compress',
+            help="Do not gzip the archive file.")
+        parser.add_argument(
+            '-d', '--delete', action='store_true',
+            help=(
+                "Delete mails as soon as each batch has been written and "
+                "synced to disk."
+            ))
+
+    def handle(self, *args, **options):
+        mails = self.get_queryset(options)
+        model = self.get_model(options)
+        serialize = getattr(self, 'serialize_{}'.format(options['format']))
+        with open(options['output'], 'ab') as raw:
+            out = gzip.GzipFile(mode='wb', fileobj=raw) if options['compress'] else raw
+
+            def archive(pks):
+                count = 0
+                for mail, headers, attachments in self.iter_mails(model, pks):
+                    out.write(serialize(mail, headers, attachments))
+                    count += 1
+                out.flush()
+                if out is not raw:
+                    raw.flush()
+                os.fsync(raw.fileno())
+                if options['delete']:
+                    with transaction.atomic():
+                        model.objects.filter(pk__in=pks).raw_delete()
+                return count
+
+            try:
+                self.process_batches(
+                    mails, options, archive,
+                    "archived and deleted" if options['delete'] else "archived")
+            finally:
+                if out is not raw:
+                    out.close()
+
+    @staticmethod
+    def iter_mails(model, pks):
+        """Yield (mail, headers, attachments) tuples for the given mails of
+        `model`, Mail or MailArchive.
+
+        Headers and attachments of the whole batch are fetched in one query
+        per table. Every query is iterated with a server-side cursor where the
+        database supports it.
+        """
+        def related_model(name):
+            return model._meta.get_field(name).related_model
+
+        headers = defaultdict(list)
+        for mail_id, name, value in (
+                related_model('headers').objects.filter(mail_id__in=pks)
+                .order_by('pk').values_list('mail_id', 'name', 'value')
+                .iterator()):
+            headers[mail_id].append((name, value))
+        attachments = defaultdict(list)
+        for kind, name in [('static', 'static_attachments'),
+                           ('dynamic', 'dynamic_attachments')]:
+            for mail_id, filename, mime_type, path in (
+                    related_model(name).objects.filter(mail_id__in=pks)
+                    .order_by('pk')
+                    .values_list('mail_id', 'filename', 'mime_type',
+                                 'attachment')
+                    .iterator()):
+                attachments[mail_id].append({
+                    'kind': kind, 'filename': filename,
+                    'mime_type': mime_type, 'attachment': path,
+                })
+        mails = (
+            model.objects.filter(pk__in=pks).select_related('campaign')
+            .order_by('pk').iterator()
+        )
+        for mail in mails:
+            if mail.inline_headers is not None:
+                mail_headers = list(mail.inline_headers.items())
+            else:
+                mail_headers = headers[mail.pk]
+            yield mail, mail_headers, attachments[mail.pk]
+
+    @staticmethod
+    def serialize_jsonl(mail, headers, attachments):
+        record = {
+            'id': mail.pk,
+            'campaign': mail.campaign.key if mail.campaign else None,
+            'status': mail.status,
+            'scheduled_on': mail.scheduled_on,
+            'sent_on': mail.sent_on,
+            'subject': mail.subject,
+            'html_body': mail.html_body,
+            'text_body': mail.text_body,
+            'failure_reason': mail.failure_reason,
+            'headers': headers,
+            'attachments': attachments,
+        }
+        return json.dumps(record, cls=DjangoJSONEncoder).encode() + b'\n'
+
+    @staticmethod
+    def serialize_mbox(mail, headers, attachments):
+        extra_headers = dict(headers)
+        from_email = extra_headers.pop('From', settings.DEFAULT_FROM_EMAIL)
+        extra_headers.setdefault('Date', format_datetime(
+            mail.sent_on or mail.scheduled_on))
+        extra_headers.setdefault('X-Mail-Id', str(mail.pk))
+        msg = EmailMultiAlternatives(
+            mail.subject, mail.text_body, from_email, headers=extra_headers)
+        msg.attach_alternative(mail.html_body, 'text/html')
+        message = msg.message()
+        message['X-Mailing-Status'] = mail.get_status_display()
+        for attachment in attachments:
+            # Only keep a reference to attachment files, not their content.
+            message['X-Mailing-Attachment'] = attachment['attachment']
+        message.set_unixfrom('From MAILER-DAEMON {:%a %b %d %H:%M:%S %Y}'.format(
+            mail.sent_on or mail.scheduled_on))
+        output = BytesIO()
+        BytesGenerator(output, mangle_from_=True).flatten(
+            message, unixfrom=True)
+        return output.getvalue() + b'\n'
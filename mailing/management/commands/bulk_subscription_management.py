@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
+import csv
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import Subscription, SubscriptionType
+
+
+class Command(BaseCommand):
+    help = """Subscribe or unsubscribe e-mail addresses read from a CSV file
+    to the given subscription types."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'file',
+            help="Path of the CSV file, or - to read standard input.")
+        parser.add_argument(
+            'subscription_types', nargs='+',
+            help="Names or IDs of the subscription types.")
+        parser.add_argument(
+            '--subscribe', action='store_true',
+            help="Subscribe addresses rather than unsubscribing them.")
+        parser.add_argument(
+            '-c', '--column', type=int, default=0,
+            help=(
+                "Index of the column holding e-mail addresses, starting from "
+                "0. Defaults to 0."
+            ))
+        parser.add_argument(
+            '-d', '--delimiter', default=',',
+            help="CSV fields delimiter. Defaults to ','.")
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=500,
+            help="Number of addresses handled per transaction. Defaults to 500.")
+
+    def handle(self, *args, **options):
+        subscription_type_ids = self.get_subscription_type_ids(
+            options['subscription_types'])
+        started = time.monotonic()
+        if options['file'] == '-':
+            nb_updated, nb_created = self.process(
+                sys.stdin, subscription_type_ids, options)
+        else:
+            with open(options['file'], newline='') as f:
+                nb_updated, nb_created = self.process(
+                    f, subscription_type_ids, options)
+        if options['verbosity'] > 0:
+            self.stdout.write(
+                "{} subscriptions updated, {} created in {:.1f}s".format(
+                    nb_updated, nb_created, time.monotonic() - started))
+
+    @staticmethod
+    def get_subscription_type_ids(names):
+        ids = []
+        for name in names:
+            lookup = {'pk': int(name)} if name.isdigit() else {'name': name}
+            try:
+                ids.append(SubscriptionType.objects.get(**lookup).pk)
+            except SubscriptionType.DoesNotExist:
+                raise CommandError(
+                    "Subscription type {} does not exist".format(name))
+        return ids
+
+    @staticmethod
+    def process(f, subscription_type_ids, options):
+        column = options['column']
+        # Header and malformed lines are skipped.
+        emails = (
+            row[column] for row in csv.reader(f, delimiter=options['delimiter'])
+            if len(row) > column and '@' in row[column]
+        )
+        return Subscription.objects.bulk_set_subscribed(
+            emails, subscription_type_ids, subscribed=options['subscribe'],
+            batch_size=options['batch_size'])
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+from django.core.management.base import BaseCommand
+
+from ...models import Mail
+from ...queues import get_queue
+
+
+class Command(BaseCommand):
+    help = """Push every pending mail to the QUEUE_BACKEND, after switching
+    backends or losing the content of the queue. Mails already queued are
+    pushed again, which the Redis backend ignores."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=1000,
+            help="Number of mails pushed at once. Defaults to 1000.")
+
+    def handle(self, *args, **options):
+        queue = get_queue()
+        mails = Mail.objects.filter(status=Mail.STATUS_PENDING)
+        pushed = 0
+        for pks in mails.pk_chunks(options['batch_size']):
+            queue.push([
+                (pk, scheduled_on.timestamp()) for pk, scheduled_on
+                in Mail.objects.filter(pk__in=pks).values_list(
+                    'pk', 'scheduled_on')
+            ])
+            pushed += len(pks)
+            if options['verbosity'] > 1:
+                self.stdout.write("{} mails pushed".format(pushed))
+        if options['verbosity'] > 0:
+            self.stdout.write("{} mails pushed".format(pushed))
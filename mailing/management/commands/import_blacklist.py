@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
+import csv
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...models import Blacklist
+
+REASONS = {
+    'spam': Blacklist.REASON_SPAM,
+    'blocked': Blacklist.REASON_BLOCKED,
+    'hardbounce': Blacklist.REASON_HARDBOUNCE,
+    'other': Blacklist.REASON_OTHER,
+}
+
+
+class Command(BaseCommand):
+    help = """Blacklist e-mail addresses read from a CSV or plain text file,
+    one address per line. Addresses already blacklisted are left untouched."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'file',
+            help="Path of the file, or - to read standard input.")
+        parser.add_argument(
+            '-r', '--reason', choices=sorted(REASONS), default='other',
+            help="Reason of the blacklisting. Defaults to other.")
+        parser.add_argument(
+            '--verbose-reason', default='',
+            help="Details about the reason, stored on every new entry.")
+        parser.add_argument(
+            '-c', '--column', type=int, default=0,
+            help=(
+                "Index of the column holding e-mail addresses, starting from "
+                "0. Defaults to 0."
+            ))
+        parser.add_argument(
+            '-d', '--delimiter', default=',',
+            help="CSV fields delimiter. Defaults to ','.")
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=1000,
+            help="Number of addresses handled per transaction. Defaults to 1000.")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        if options['file'] == '-':
+            nb_created, nb_existing = self.process(sys.stdin, options)
+        else:
+            with open(options['file'], newline='') as f:
+                nb_created, nb_existing = self.process(f, options)
+        if options['verbosity'] > 0:
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                "{} addresses blacklisted, {} already blacklisted in {:.1f}s "
+                "({:.0f} addresses/s)".format(
+                    nb_created, nb_existing, elapsed,
+                    (nb_created + nb_existing) / elapsed if elapsed else 0))
+
+    @staticmethod
+    def process(f, options):
+        column = options['column']
+        # Header and malformed lines are skipped.
+        emails = (
+            row[column] for row in csv.reader(f, delimiter=options['delimiter'])
+            if len(row) > column and '@' in row[column]
+        )
+        return Blacklist.objects.bulk_blacklist(
+            emails, batch_size=options['batch_size'],
+            reason=REASONS[options['reason']],
+            verbose_reason=options['verbose_reason'])
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import Mail, MailRecipient, MailArchive, MailArchiveRecipient
+
+
+class Command(BaseCommand):
+    help = """Fill in the recipients index of mails rendered before it
+    existed."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=1000,
+            help="Number of mails indexed per transaction. Defaults to 1000.")
+
+    def handle(self, *args, **options):
+        for mail_model, recipient_model in [
+                (Mail, MailRecipient), (MailArchive, MailArchiveRecipient)]:
+            mails = mail_model.objects.filter(recipients__isnull=True)
+            indexed = 0
+            for pks in mails.pk_chunks(options['batch_size']):
+                chunk = (
+                    mail_model.objects.filter(pk__in=pks)
+                    .only('pk', 'inline_headers').prefetch_related('headers')
+                )
+                recipients = []
+                for mail in chunk:
+                    recipients += recipient_model.objects.from_headers(
+                        dict(mail.headers.items()), mail=mail)
+                with transaction.atomic():
+                    recipient_model.objects.bulk_create(recipients)
+                indexed += len(pks)
+                if options['verbosity'] > 1:
+                    self.stdout.write("{} {} indexed".format(
+                        indexed, mail_model._meta.verbose_name_plural))
+            if options['verbosity'] > 0:
+                self.stdout.write("{} {} indexed".format(
+                    indexed, mail_model._meta.verbose_name_plural))
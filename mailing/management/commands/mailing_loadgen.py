@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
+from datetime import timedelta
+import os
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from ...conf import ATTACHMENTS_DIR
+from ...models import (
+    Blacklist, Campaign, CampaignStaticAttachment, Mail, MailRecipient,
+    MailStaticAttachment, Subscription, SubscriptionType,
+)
+from ...smtpsink import SMTPSink
+
+DOMAINS = [
+    # Recipients are spread unevenly among domains, as they are in practice.
+    ('example.com', 40), ('example.net', 25), ('example.org', 15),
+    ('mail.example.com', 10), ('mx.example.net', 5), ('example.fr', 5),
+]
+
+PARAGRAPH = (
+    "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do "
+    "eiusmod tempor incididunt ut labore et dolore magna aliqua. "
+    "<a href=\"https://example.com/offers/{}/\">See the offer</a></p>\n"
+)
+
+
+class Command(BaseCommand):
+    help = """Fill the database with generated campaigns, pending mails,
+    blacklisted addresses and subscriptions to measure sending throughput,
+    or run an SMTP server accepting every message with --smtp-sink."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--mails', type=int, default=100000,
+            help="Number of pending mails to create. Defaults to 100000.")
+        parser.add_argument(
+            '-c', '--campaigns', type=int, default=10,
+            help=(
+                "Number of campaigns mails are spread among. Half of them "
+                "have a static attachment. Defaults to 10."
+            ))
+        parser.add_argument(
+            '-r', '--recipients', type=int, default=100000,
+            help=(
+                "Number of distinct addresses mails are sent to. Defaults to "
+                "100000."
+            ))
+        parser.add_argument(
+            '--blacklist', type=int, default=10000,
+            help=(
+                "Number of blacklisted addresses, drawn among recipients. "
+                "Defaults to 10000."
+            ))
+        parser.add_argument(
+            '--subscriptions', type=int, default=50000,
+            help=(
+                "Number of subscriptions, drawn among recipients, one in ten "
+                "being unsubscribed. Defaults to 50000."
+            ))
+        parser.add_argument(
+            '--spread', type=float, default=24,
+            help=(
+                "Number of hours before now over which mails are scheduled. "
+                "Defaults to 24."
+            ))
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help=(
+                "Seed of the random generator. The same seed generates the "
+                "same data. Defaults to 0."
+            ))
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=5000,
+            help="Number of rows inserted per query. Defaults to 5000.")
+        parser.add_argument(
+            '--smtp-sink', action='store_true',
+            help=(
+                "Instead of generating data, run an SMTP server accepting "
+                "every message until interrupted, reporting its throughput."
+            ))
+        parser.add_argument(
+            '--host', default='127.0.0.1',
+            help="Address the SMTP sink listens on. Defaults to 127.0.0.1.")
+        parser.add_argument(
+            '--port', type=int, default=1025,
+            help="Port the SMTP sink listens on. Defaults to 1025.")
+        parser.add_argument(
+            '--record',
+            help="Path of an mbox file where the SMTP sink appends messages.")
+
+    def handle(self, *args, **options):
+        if options['smtp_sink']:
+            return self.run_sink(options)
+        started = time.monotonic()
+        self.verbosity = options['verbosity']
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        domains, weights = zip(*DOMAINS)
+        self.domains = self.random.choices(
+            domains, weights, k=options['recipients'])
+        campaigns = self.create_campaigns(options['campaigns'])
+        self.step("{} campaigns".format(len(campaigns)), started)
+        self.create_blacklist(options['blacklist'])
+        self.step("{} blacklisted addresses".format(options['blacklist']),
+                  started)
+        self.create_subscriptions(options['subscriptions'], campaigns)
+        self.step("{} subscriptions".format(options['subscriptions']),
+                  started)
+        self.create_mails(options['mails'], campaigns, options['spread'])
+        self.step("{} mails".format(options['mails']), started)
+
+    def step(self, what, started):
+        if self.verbosity > 0:
+            self.stdout.write("Created {} ({:.1f}s)".format(
+                what, time.monotonic() - started))
+
+    def get_recipient(self):
+        i = self.random.randrange(len(self.domains))
+        return 'user{}@{}'.format(i, self.domains[i])
+
+    def create_campaigns(self, count):
+        attachment_path = os.path.join(ATTACHMENTS_DIR, 'loadgen', 'offer.pdf')
+        os.makedirs(os.path.dirname(attachment_path), exist_ok=True)
+        if not os.path.exists(attachment_path):
+            with open(attachment_path, 'wb') as f:
+                f.write(b'%PDF-1.4\n' + bytes(range(256)) * 200)
+        subscription_types = [
+            SubscriptionType.objects.get_or_create(
+                name='loadgen-{}'.format(i),
+                defaults={'description': "Generated subscription type"})[0]
+            for i in range(3)
+        ]
+        campaigns = []
+        for i in range(count):
+            campaign, created = Campaign.objects.get_or_create(
+                key='loadgen-{}'.format(i), defaults={
+                    'name': "Generated campaign {}".format(i),
+                    'subject': "Offers #{} for {{{{ first_name }}}}".format(i),
+                    'subscription_type': subscription_types[i % 3],
+                })
+            if created:
+                campaign.extra_headers.create(
+                    name='Reply-To', value='offers@example.com')
+                campaign.extra_headers.create(
+                    name='List-Unsubscribe',
+                    value='<{{ mailing.subscriptions_management_url }}>')
+                if i % 2 == 0:
+                    CampaignStaticAttachment.objects.create(
+                        campaign=campaign, attachment=attachment_path,
+                        filename='offer.pdf', mime_type='application/pdf')
+            # Bodies of 5 to 50 kB.
+            campaign.html_body = ''.join(
+                PARAGRAPH.format(j)
+                for j in range(self.random.randint(20, 200)))
+            campaign.attachments = list(
+                campaign.static_attachments.values(
+                    'attachment', 'filename', 'mime_type'))
+            campaigns.append(campaign)
+        return campaigns
+
+    def create_blacklist(self, count):
+        Blacklist.objects.bulk_blacklist(
+            (self.get_recipient() for i in range(count)),
+            batch_size=self.batch_size, reason=Blacklist.REASON_HARDBOUNCE)
+
+    def create_subscriptions(self, count, campaigns):
+        subscription_type_ids = sorted({
+            c.subscription_type_id for c in campaigns})
+        for start in range(0, count, self.batch_size):
+            subscriptions = []
+            for i in range(min(self.batch_size, count - start)):
+                email = self.get_recipient()
+                subscriptions.append(Subscription(
+                    email=email, normalized_email=email,
+                    subscription_type_id=self.random.choice(
+                        subscription_type_ids),
+                    subscribed=self.random.random() >= 0.1))
+            Subscription.objects.bulk_create(
+                subscriptions, ignore_conflicts=True)
+
+    def create_mails(self, count, campaigns, spread):
+        now = timezone.now()
+        spread = spread * 3600
+        for start in range(0, count, self.batch_size):
+            mails = []
+            for i in range(min(self.batch_size, count - start)):
+                campaign = self.random.choice(campaigns)
+                mail = Mail(
+                    campaign=campaign, status=Mail.STATUS_PENDING,
+                    scheduled_on=now - timedelta(
+                        seconds=self.random.random() * spread),
+                    subject=campaign.subject.replace(
+                        '{{ first_name }}', "John"),
+                    html_body=campaign.html_body,
+                    inline_headers={
+                        'From': 'offers@example.com',
+                        'To': self.get_recipient(),
+                        'Reply-To': 'offers@example.com',
+                    })
+                mails.append(mail)
+            with transaction.atomic():
+                last_pk = (
+                    Mail.objects.order_by('-pk')
+                    .values_list('pk', flat=True).first() or 0)
+                Mail.objects.bulk_create(mails)
+                if mails[0].pk is None:
+                    # Primary keys are only set by backends returning them.
+                    pks = Mail.objects.filter(pk__gt=last_pk).order_by(
+                        'pk').values_list('pk', flat=True)
+                    for mail, pk in zip(mails, pks):
+                        mail.pk = pk
+                recipients = []
+                attachments = []
+                for mail in mails:
+                    recipients.extend(MailRecipient.objects.from_headers(
+                        mail.inline_headers, mail_id=mail.pk))
+                    attachments.extend(
+                        MailStaticAttachment(mail_id=mail.pk, **attachment)
+                        for attachment in mail.campaign.attachments)
+                MailRecipient.objects.bulk_create(recipients)
+                MailStaticAttachment.objects.bulk_create(attachments)
+            if self.verbosity > 1:
+                self.stdout.write("{} mails created".format(
+                    start + len(mails)))
+
+    def run_sink(self, options):
+        record = open(options['record'], 'ab') if options['record'] else None
+
+        def write_message(mail_from, rcpt_tos, data):
+            record.write('From {} {}\n'.format(
+                mail_from.strip('<>') or 'MAILER-DAEMON',
+                time.asctime()).encode())
+            for line in data.splitlines(keepends=True):
+                if line.startswith(b'From '):
+                    line = b'>' + line
+                record.write(line.rstrip(b'\r\n') + b'\n')
+            record.write(b'\n')
+            record.flush()
+
+        sink = SMTPSink(
+            (options['host'], options['port']),
+            on_message=write_message if record else None)
+        host, port = sink.start()
+        self.stdout.write(
+            "SMTP sink listening on {}:{}. Quit with CONTROL-C.".format(
+                host, port))
+        last_count, last_time = 0, time.monotonic()
+        try:
+            while True:
+                time.sleep(5)
+                count, now = sink.nb_messages, time.monotonic()
+                self.stdout.write(
+                    "{} messages accepted, {:.1f} messages/s".format(
+                        count, (count - last_count) / (now - last_time)))
+                last_count, last_time = count, now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sink.stop()
+            if record:
+                record.close()
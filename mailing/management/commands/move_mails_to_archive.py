@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
+from ...models import Mail, MailArchive
+from ..base import OldMailsCommand
+
+
+class Command(OldMailsCommand):
+    help = """Move sent, canceled and failed mails past given period to the
+    archive tables."""
+
+    archived_option = False
+
+    ARCHIVABLE_STATUSES = [
+        Mail.STATUS_SENT, Mail.STATUS_CANCELED, Mail.STATUS_FAILURE,
+    ]
+
+    def handle(self, *args, **options):
+        mails = self.get_queryset(options).filter(
+            status__in=self.ARCHIVABLE_STATUSES)
+        self.process_batches(
+            mails, options, MailArchive.objects.archive, "archived")
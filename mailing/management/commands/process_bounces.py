@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from ...bounces import (
+    iter_maildir, iter_mbox, parse_dsn, read_message, record_bounces,
+)
+
+
+def process_unit(unit, batch_size):
+    """Process one unit of work, either ('mbox', path) or
+    ('maildir', [message paths]), recording bounces by batches. Return a
+    Counter of messages, hard and soft bounces and blacklisted addresses.
+    """
+    kind, arg = unit
+    if kind == 'mbox':
+        messages = iter_mbox(arg)
+    else:
+        messages = map(read_message, arg)
+    counts = Counter()
+    batch = []
+    for message in messages:
+        counts['messages'] += 1
+        for bounce in parse_dsn(message):
+            counts['hard' if bounce.hard else 'soft'] += 1
+            batch.append(bounce)
+        if len(batch) >= batch_size:
+            counts['blacklisted'] += record_bounces(batch)
+            batch = []
+    if batch:
+        counts['blacklisted'] += record_bounces(batch)
+    return counts
+
+
+class Command(BaseCommand):
+    help = """Read delivery status notifications from mbox files or Maildir
+    directories, mark bounced mails and blacklist hard bounced addresses."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help="Paths of mbox files or Maildir directories.")
+        parser.add_argument(
+            '-j', '--jobs', type=int, default=1,
+            help=(
+                "Number of processes reading mailboxes in parallel. mbox "
+                "files, and chunks of Maildir messages, are spread among "
+                "them. Defaults to 1."
+            ))
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=1000,
+            help=(
+                "Number of bounces recorded per transaction, and of Maildir "
+                "messages per chunk. Defaults to 1000."
+            ))
+
+    def handle(self, *args, **options):
+        for path in options['paths']:
+            if not os.path.exists(path):
+                raise CommandError("{} does not exist".format(path))
+        started = time.monotonic()
+        units = self.iter_units(options['paths'], options['batch_size'])
+        if options['jobs'] > 1:
+            counts = self.process_parallel(units, options)
+        else:
+            counts = sum((
+                process_unit(unit, options['batch_size']) for unit in units
+            ), Counter())
+        if options['verbosity'] > 0:
+            self.stdout.write(
+                "{} messages read, {} hard bounces, {} soft bounces, {} "
+                "addresses blacklisted in {:.1f}s".format(
+                    counts['messages'], counts['hard'], counts['soft'],
+                    counts['blacklisted'], time.monotonic() - started))
+
+    @staticmethod
+    def iter_units(paths, chunk_size):
+        for path in paths:
+            if os.path.isdir(path):
+                messages = iter_maildir(path)
+                while True:
+                    chunk = list(islice(messages, chunk_size))
+                    if not chunk:
+                        break
+                    yield ('maildir', chunk)
+            else:
+                yield ('mbox', path)
+
+    @staticmethod
+    def process_parallel(units, options):
+        # Child processes must not share the connections of their parent.
+        connections.close_all()
+        counts = Counter()
+        pending = set()
+        with ProcessPoolExecutor(options['jobs']) as executor:
+            for unit in units:
+                # Only a few units are queued ahead, so that Maildir paths
+                # are listed as they are processed.
+                if len(pending) >= 2 * options['jobs']:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        counts += future.result()
+                pending.add(executor.submit(
+                    process_unit, unit, options['batch_size']))
+            for future in pending:
+                counts += future.result()
+        return counts
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+from django.core.management.base import BaseCommand
+
+from ...outbox import process_outbox
+
+
+class Command(BaseCommand):
+    help = """Render and queue the mails recorded in the outbox by
+    `queue_mail` in outbox mode. The sending daemon does it before each
+    batch."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=100,
+            help="Number of mails rendered per batch. Defaults to 100.")
+
+    def handle(self, *args, **options):
+        processed = failures = 0
+        while True:
+            nb_processed, nb_failures = process_outbox(options['batch_size'])
+            if not nb_processed:
+                break
+            processed += nb_processed
+            failures += nb_failures
+            if options['verbosity'] > 1:
+                self.stdout.write("{} mails processed".format(processed))
+        if options['verbosity'] > 0:
+            self.stdout.write("{} mails processed, {} failures".format(
+                processed, failures))
@@ -1,16 +1,186 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
+import asyncio
+from functools import partial
+import signal
+import threading
+
 from django.core.management.base import BaseCommand
 
+from ...aio import send_queued_mails_async
+from ...conf import PROFILE_DIR
+from ...outbox import process_outbox
+from ...pipeline import SendPipeline
+from ...prefork import STOP_SIGNALS, Supervisor
+from ...profiling import BatchProfiler
+from ...queues import get_queue
 from ...utils import send_queued_mails
-import time
+
 
 class Command(BaseCommand):
     help = """Send mails with `status` Mail.STATUS_PENDING and having
     `scheduled_on` set on a past date. In daemon mode."""
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=15,
+            help=(
+                "Seconds to wait after a batch which was not full, no more "
+                "mails being due. Defaults to 15."
+            ))
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=None,
+            help=(
+                "Maximum number of mails sent per batch. Defaults to every "
+                "due mail with the database queue backend."
+            ))
+        parser.add_argument(
+            '-p', '--processes', type=int, default=1,
+            help=(
+                "Number of worker processes forked to send mails in "
+                "parallel, restarted when they crash. Defaults to 1, sending "
+                "from the current process."
+            ))
+        parser.add_argument(
+            '--max-mails', type=int, default=0,
+            help=(
+                "Number of mails after which a worker process exits, to be "
+                "replaced by a new one. Without --processes, the daemon "
+                "itself exits, to be restarted by your process manager. "
+                "Defaults to 0, never."
+            ))
+        engine = parser.add_mutually_exclusive_group()
+        engine.add_argument(
+            '--pipeline', action='store_true',
+            help=(
+                "Send each batch through concurrent stages fetching, "
+                "building, sending and recording mails, until no mail is due."
+            ))
+        parser.add_argument(
+            '--builders', type=int, default=2,
+            help=(
+                "Number of threads building MIME messages with --pipeline. "
+                "Defaults to 2."
+            ))
+        parser.add_argument(
+            '--senders', type=int, default=4,
+            help=(
+                "Number of threads sending messages with --pipeline, each "
+                "with its own SMTP connection. Defaults to 4."
+            ))
+        parser.add_argument(
+            '--writers', type=int, default=1,
+            help=(
+                "Number of threads recording the status of mails with "
+                "--pipeline. Defaults to 1."
+            ))
+        parser.add_argument(
+            '--queue-size', type=int, default=100,
+            help=(
+                "Maximum number of mails waiting between two stages with "
+                "--pipeline. Defaults to 100."
+            ))
+        engine.add_argument(
+            '--async', action='store_true',
+            help=(
+                "Send each batch over concurrent SMTP sessions to EMAIL_HOST "
+                "on an asyncio event loop."
+            ))
+        parser.add_argument(
+            '--smtp-sessions', type=int, default=20,
+            help=(
+                "Maximum number of concurrent SMTP sessions with --async. "
+                "Defaults to 20."
+            ))
+        parser.add_argument(
+            '--profile', action='store_true',
+            help=(
+                "Profile batches with cProfile, writing .prof files to "
+                "--profile-dir and logging their hottest functions."
+            ))
+        parser.add_argument(
+            '--profile-dir', default=PROFILE_DIR,
+            help=(
+                "Directory of the .prof files. Defaults to the PROFILE_DIR "
+                "setting."
+            ))
+        parser.add_argument(
+            '--profile-every', type=int, default=1,
+            help="Profile one batch out of N. Defaults to 1.")
+        parser.add_argument(
+            '--profile-keep', type=int, default=10,
+            help="Number of .prof files kept. Defaults to 10.")
+        parser.add_argument(
+            '--profile-top', type=int, default=20,
+            help=(
+                "Number of functions with the highest cumulative time logged "
+                "per profiled batch, 0 to log none. Defaults to 20."
+            ))
+
     def handle(self, *args, **options):
-        while True:
-            send_queued_mails()
-            time.sleep(15)
+        if options['processes'] > 1:
+            Supervisor(
+                partial(self.work, options), options['processes']).run()
+        else:
+            # Stop gracefully, as forked workers do, so that mails already
+            # sent are recorded.
+            stop_event = threading.Event()
+            previous_handlers = {
+                signum: signal.signal(
+                    signum, lambda signum, frame: stop_event.set())
+                for signum in STOP_SIGNALS
+            }
+            try:
+                self.work(options, 0, 1, stop_event)
+            finally:
+                for signum, handler in previous_handlers.items():
+                    signal.signal(signum, handler)
+
+    def work(self, options, index, count, stop_event):
+        """Render mails of the outbox and send batches of mails until
+        `stop_event` is set or `max_mails` mails were sent. `index` is the
+        partition of the queue claimed among `count` ones."""
+        queue = get_queue()
+        queue.set_partition(index, count)
+        profiler = None
+        if options['profile']:
+            profiler = BatchProfiler(
+                options['profile_dir'], every=options['profile_every'],
+                keep=options['profile_keep'], top=options['profile_top'])
+        # Mails claimed per batch, when limited: a full batch is followed by
+        # another one without waiting. Pipelines send until no mail is due.
+        batch_size = options['batch_size'] or getattr(
+            queue, 'batch_size', None)
+        if options['pipeline']:
+            send = partial(self.send_pipelined, options, stop_event)
+            batch_size = None
+        elif options['async']:
+            send = partial(self.send_async, options)
+        else:
+            send = partial(send_queued_mails, options['batch_size'])
+        nb_mails = 0
+        while not stop_event.is_set():
+            # Render mails recorded by queue_mail in outbox mode first.
+            process_outbox(options['batch_size'] or 100, (index, count))
+            if profiler is None:
+                nb_successes, nb_failures = send()
+            else:
+                nb_successes, nb_failures = profiler.run(send)
+            nb_mails += nb_successes + nb_failures
+            if options['max_mails'] and nb_mails >= options['max_mails']:
+                return
+            if batch_size and nb_successes + nb_failures >= batch_size:
+                continue
+            stop_event.wait(options['interval'])
+
+    def send_pipelined(self, options, stop_event):
+        fetch_size = options['batch_size'] or 100
+        pipeline = SendPipeline(
+            builders=options['builders'], senders=options['senders'],
+            writers=options['writers'], queue_size=options['queue_size'],
+            fetch_size=fetch_size, write_size=fetch_size)
+        return pipeline.run(stop_event)
 
+    def send_async(self, options):
+        return asyncio.run(send_queued_mails_async(
+            options['batch_size'], options['smtp_sessions']))
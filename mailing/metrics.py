@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+"""Metrics of the mail queue, exposed in Prometheus text format.
+
+Queue gauges are computed from the mails table on every scrape, with queries
+on the (status, scheduled_on) index. Counters and latency histograms are fed
+by the send pipeline signals and kept in the METRICS_CACHE cache, or in the
+memory of the current process.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+
+from django.core.cache import caches
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from .conf import METRICS_CACHE
+from .models import Campaign, Mail
+from .signals import post_render, post_send, batch_finished
+
+__all__ = [
+    'BUCKETS', 'connect_receivers', 'render_metrics',
+]
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+"""Upper bounds, in seconds, of the latency histograms buckets."""
+
+HISTOGRAMS = [
+    ('render', 'mailing_render_duration_seconds',
+     "Time spent rendering the templates of a mail."),
+    ('smtp', 'mailing_smtp_duration_seconds',
+     "Time spent transmitting a mail to the e-mail backend."),
+]
+
+COUNTERS = [
+    ('cycles', 'mailing_send_cycles_total',
+     "Number of send_queued_mails cycles."),
+    ('sent', 'mailing_sent_mails_total',
+     "Number of mails successfully sent."),
+    ('failed', 'mailing_failed_mails_total',
+     "Number of mails that failed to be sent."),
+]
+
+KEY_PREFIX = 'mailing:metrics:'
+
+# Sums of durations are stored in microseconds, so that every value can be
+# incremented atomically by cache backends.
+MICROSECONDS = 1000000
+
+_local_values = defaultdict(int)
+_local_lock = threading.Lock()
+
+
+def _incr(key):
+    _incr_by(key, 1)
+
+
+def _incr_by(key, delta):
+    if METRICS_CACHE:
+        cache = caches[METRICS_CACHE]
+        key = KEY_PREFIX + key
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, delta)
+    else:
+        with _local_lock:
+            _local_values[key] += delta
+
+
+def _get_values(keys):
+    if METRICS_CACHE:
+        values = caches[METRICS_CACHE].get_many(
+            [KEY_PREFIX + key for key in keys])
+        return {key: values.get(KEY_PREFIX + key, 0) for key in keys}
+    with _local_lock:
+        return {key: _local_values.get(key, 0) for key in keys}
+
+
+def _observe(name, duration):
+    # Only the bucket of the observation is incremented, buckets are made
+    # cumulative when rendered.
+    _incr('{}:bucket:{}'.format(name, bisect_left(BUCKETS, duration)))
+    _incr('{}:count'.format(name))
+    _incr_by('{}:sum'.format(name), int(duration * MICROSECONDS))
+
+
+def _post_render_receiver(sender, durations, **kwargs):
+    _observe('render', durations.get('render', 0))
+
+
+def _post_send_receiver(sender, message, durations, **kwargs):
+    if message is not None:
+        _observe('smtp', durations.get('smtp', 0))
+
+
+def _batch_finished_receiver(sender, nb_successes, nb_failures, **kwargs):
+    _incr('cycles')
+    _incr_by('sent', nb_successes)
+    _incr_by('failed', nb_failures)
+
+
+def connect_receivers():
+    """Start feeding counters and histograms from the send pipeline."""
+    post_render.connect(
+        _post_render_receiver, sender=Mail, dispatch_uid='mailing.metrics')
+    post_send.connect(
+        _post_send_receiver, sender=Mail, dispatch_uid='mailing.metrics')
+    batch_finished.connect(
+        _batch_finished_receiver, sender=Mail, dispatch_uid='mailing.metrics')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_float(value):
+    return repr(float(value))
+
+
+def _render_queue(lines):
+    now = timezone.now()
+    queue = (
+        Mail.objects.filter(status=Mail.STATUS_PENDING)
+        .order_by().values_list('campaign_id')
+        .annotate(
+            count=Count('pk'),
+            oldest=Min('scheduled_on', filter=Q(scheduled_on__lte=now)),
+        )
+    )
+    queue = list(queue)
+    keys = dict(Campaign.objects.filter(
+        pk__in=[campaign_id for campaign_id, _, _ in queue if campaign_id],
+    ).values_list('pk', 'key'))
+    lines.append(
+        "# HELP mailing_pending_mails Number of pending mails.")
+    lines.append("# TYPE mailing_pending_mails gauge")
+    for campaign_id, count, oldest in queue:
+        lines.append('mailing_pending_mails{{campaign="{}"}} {}'.format(
+            _escape(keys.get(campaign_id, '')), count))
+    lines.append(
+        "# HELP mailing_oldest_pending_mail_age_seconds Time since the "
+        "oldest pending mail was due to be sent.")
+    lines.append("# TYPE mailing_oldest_pending_mail_age_seconds gauge")
+    for campaign_id, count, oldest in queue:
+        if oldest is None:
+            continue
+        lines.append(
+            'mailing_oldest_pending_mail_age_seconds{{campaign="{}"}} '
+            '{}'.format(
+                _escape(keys.get(campaign_id, '')),
+                _format_float((now - oldest).total_seconds())))
+
+
+def _render_counters(lines, values):
+    for key, name, help_text in COUNTERS:
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} counter".format(name))
+        lines.append("{} {}".format(name, values[key]))
+
+
+def _render_histograms(lines, values):
+    for key, name, help_text in HISTOGRAMS:
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} histogram".format(name))
+        cumulative = 0
+        for i, bound in enumerate(BUCKETS):
+            cumulative += values['{}:bucket:{}'.format(key, i)]
+            lines.append('{}_bucket{{le="{}"}} {}'.format(
+                name, _format_float(bound), cumulative))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(
+            name, values['{}:count'.format(key)]))
+        lines.append('{}_sum {}'.format(name, _format_float(
+            values['{}:sum'.format(key)] / MICROSECONDS)))
+        lines.append('{}_count {}'.format(
+            name, values['{}:count'.format(key)]))
+
+
+def render_metrics():
+    """Return every metric in Prometheus text exposition format."""
+    keys = [key for key, name, help_text in COUNTERS]
+    for key, name, help_text in HISTOGRAMS:
+        keys.extend(
+            '{}:bucket:{}'.format(key, i) for i in range(len(BUCKETS)))
+        keys.extend(['{}:count'.format(key), '{}:sum'.format(key)])
+    values = _get_values(keys)
+    lines = []
+    _render_queue(lines)
+    _render_counters(lines, values)
+    _render_histograms(lines, values)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-19 17:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0012_subscription_date_joined'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(fields=['status', 'scheduled_on'], name='mailing_mai_status_9a23e5_idx'),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 2.2.28 on 2026-10-19 17:19
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import mailing.models.options
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0013_mail_status_scheduled_on_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailArchive',
+            fields=[
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'Pending'), (2, 'Sent'), (3, 'Canceled'), (4, 'Failure'), (5, 'Draft')], default=5, verbose_name='status')),
+                ('scheduled_on', models.DateTimeField(default=django.utils.timezone.now, verbose_name='scheduled on')),
+                ('sent_on', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='sent on')),
+                ('subject', models.CharField(max_length=255, verbose_name='subject')),
+                ('html_body', models.TextField(verbose_name='HTML body')),
+                ('text_body', models.TextField(blank=True, help_text='Leave blank to generate from HTML body.', verbose_name='text body')),
+                ('failure_reason', models.TextField(blank=True, editable=False, verbose_name='failure reason')),
+                ('id', models.IntegerField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('campaign', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='mailing.Campaign', verbose_name='campaign')),
+            ],
+            options={
+                'verbose_name': 'archived e-mail',
+                'verbose_name_plural': 'archived e-mails',
+                'ordering': ['-scheduled_on'],
+            },
+        ),
+        migrations.CreateModel(
+            name='MailArchiveStaticAttachment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(blank=True, max_length=100, verbose_name='filename')),
+                ('mime_type', models.CharField(blank=True, max_length=100, verbose_name='mime type')),
+                ('attachment', mailing.models.options.FilePathField(recursive=True, verbose_name='file')),
+                ('mail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='static_attachments', to='mailing.MailArchive')),
+            ],
+            options={
+                'verbose_name': 'static attachment',
+                'verbose_name_plural': 'static attachments',
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='MailArchiveHeader',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.SlugField(max_length=70, verbose_name='name')),
+                ('value', models.TextField(validators=[django.core.validators.MaxLengthValidator(998)], verbose_name='value')),
+                ('mail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='headers', to='mailing.MailArchive')),
+            ],
+            options={
+                'verbose_name': 'header',
+                'verbose_name_plural': 'headers',
+            },
+        ),
+        migrations.CreateModel(
+            name='MailArchiveDynamicAttachment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(blank=True, max_length=100, verbose_name='filename')),
+                ('mime_type', models.CharField(blank=True, max_length=100, verbose_name='mime type')),
+                ('attachment', models.FileField(upload_to=mailing.models.options.attachments_upload_to, verbose_name='file')),
+                ('mail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dynamic_attachments', to='mailing.MailArchive')),
+            ],
+            options={
+                'verbose_name': 'dynamic attachment',
+                'verbose_name_plural': 'dynamic attachments',
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-19 17:21
+
+from django.db import migrations
+import mailing.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0014_mailarchive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mail',
+            name='inline_headers',
+            field=mailing.models.fields.JSONTextField(blank=True, editable=False, help_text='Headers stored along with the mail. When set, header rows are ignored.', null=True, verbose_name='headers'),
+        ),
+        migrations.AddField(
+            model_name='mailarchive',
+            name='inline_headers',
+            field=mailing.models.fields.JSONTextField(blank=True, editable=False, help_text='Headers stored along with the mail. When set, header rows are ignored.', null=True, verbose_name='headers'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+
+MODELS = [
+    ('Mail', 'MailHeader'),
+    ('MailArchive', 'MailArchiveHeader'),
+]
+
+
+def pk_chunks(queryset):
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        if last_pk is not None:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        else:
+            chunk = list(queryset[:BATCH_SIZE])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1]
+
+
+def headers_to_inline(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    for mail_model_name, header_model_name in MODELS:
+        Mail = apps.get_model('mailing', mail_model_name)
+        Header = apps.get_model('mailing', header_model_name)
+        mails = Mail.objects.using(db_alias).filter(inline_headers__isnull=True)
+        for pks in pk_chunks(mails):
+            with transaction.atomic(using=db_alias):
+                headers = Header.objects.using(db_alias).filter(mail_id__in=pks)
+                inline_headers = {pk: OrderedDict() for pk in pks}
+                for mail_id, name, value in (
+                        headers.order_by('pk')
+                        .values_list('mail_id', 'name', 'value')):
+                    inline_headers[mail_id][name] = value
+                for pk, value in inline_headers.items():
+                    Mail.objects.using(db_alias).filter(pk=pk).update(
+                        inline_headers=value)
+                headers.delete()
+
+
+def inline_to_headers(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    for mail_model_name, header_model_name in MODELS:
+        Mail = apps.get_model('mailing', mail_model_name)
+        Header = apps.get_model('mailing', header_model_name)
+        mails = Mail.objects.using(db_alias).filter(inline_headers__isnull=False)
+        for pks in pk_chunks(mails):
+            with transaction.atomic(using=db_alias):
+                chunk = Mail.objects.using(db_alias).filter(pk__in=pks)
+                Header.objects.using(db_alias).bulk_create([
+                    Header(mail_id=pk, name=name, value=value)
+                    for pk, inline_headers in chunk.values_list(
+                        'pk', 'inline_headers')
+                    for name, value in inline_headers.items()
+                ])
+                chunk.update(inline_headers=None)
+
+
+class Migration(migrations.Migration):
+
+    # Each batch of mails is migrated in its own transaction.
+    atomic = False
+
+    dependencies = [
+        ('mailing', '0015_inline_headers'),
+    ]
+
+    operations = [
+        migrations.RunPython(headers_to_inline, inline_to_headers),
+    ]
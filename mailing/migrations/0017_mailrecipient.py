@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-19 17:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0016_move_headers_inline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailRecipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'To'), (2, 'Cc'), (3, 'Bcc')], verbose_name='kind')),
+                ('address', models.CharField(db_index=True, max_length=254, verbose_name='address')),
+                ('domain', models.CharField(db_index=True, max_length=254, verbose_name='domain')),
+                ('mail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='mailing.Mail')),
+            ],
+            options={
+                'verbose_name': 'recipient',
+                'verbose_name_plural': 'recipients',
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='MailArchiveRecipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'To'), (2, 'Cc'), (3, 'Bcc')], verbose_name='kind')),
+                ('address', models.CharField(db_index=True, max_length=254, verbose_name='address')),
+                ('domain', models.CharField(db_index=True, max_length=254, verbose_name='domain')),
+                ('mail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='mailing.MailArchive')),
+            ],
+            options={
+                'verbose_name': 'recipient',
+                'verbose_name_plural': 'recipients',
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-19 17:24
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0017_mailrecipient'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mail',
+            name='scheduled_on',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='scheduled on'),
+        ),
+        migrations.AlterField(
+            model_name='mailarchive',
+            name='scheduled_on',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='scheduled on'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations, models, transaction
+from django.db.models.functions import Lower, Trim
+
+BATCH_SIZE = 10000
+
+MODELS = ['Subscription', 'Blacklist']
+
+
+def fill_normalized_email(apps, schema_editor):
+    # Stored addresses are bare, so normalizing them only takes trimming and
+    # lowercasing, which the database does without fetching any row.
+    db_alias = schema_editor.connection.alias
+    for model_name in MODELS:
+        model = apps.get_model('mailing', model_name)
+        queryset = model.objects.using(db_alias).order_by('pk')
+        last_pk = queryset.values_list('pk', flat=True).last() or 0
+        for start in range(0, last_pk + 1, BATCH_SIZE):
+            with transaction.atomic(using=db_alias):
+                queryset.filter(
+                    pk__gte=start, pk__lt=start + BATCH_SIZE,
+                ).update(normalized_email=Lower(Trim('email')))
+
+
+class Migration(migrations.Migration):
+
+    # Each batch of rows is backfilled in its own transaction.
+    atomic = False
+
+    dependencies = [
+        ('mailing', '0018_scheduled_on_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blacklist',
+            name='normalized_email',
+            field=models.CharField(db_index=True, default='', editable=False, help_text='Lowercased e-mail address, used for lookups.', max_length=254, verbose_name='normalized e-mail address'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='normalized_email',
+            field=models.CharField(default='', editable=False, help_text='Lowercased e-mail address, used for lookups.', max_length=254, verbose_name='normalized e-mail'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_normalized_email, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['normalized_email', 'subscription_type'], name='mailing_sub_normali_fae21e_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:14
+
+from django.db import migrations, models
+import django.utils.timezone
+import mailing.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0019_normalized_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('campaign_key', models.SlugField(blank=True, null=True, verbose_name='campaign key')),
+                ('context', mailing.models.fields.JSONTextField(blank=True, null=True, verbose_name='context')),
+                ('extra_headers', mailing.models.fields.JSONTextField(blank=True, null=True, verbose_name='extra headers')),
+                ('options', mailing.models.fields.JSONTextField(blank=True, help_text='Other keyword arguments of queue_mail.', null=True, verbose_name='options')),
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'Pending'), (4, 'Failure')], db_index=True, default=1, verbose_name='status')),
+                ('failure_reason', models.TextField(blank=True, editable=False, verbose_name='failure reason')),
+                ('created_on', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created on')),
+            ],
+            options={
+                'verbose_name': 'outbox mail',
+                'verbose_name_plural': 'outbox mails',
+                'ordering': ['pk'],
+            },
+        ),
+    ]
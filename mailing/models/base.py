@@ -2,29 +2,31 @@
 # Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
 from datetime import datetime
 import os
-import re
 
-from django.core.signing import Signer
-from django.urls import reverse
 from django.db import models
 from django.template import Template
 from django.template.loader import get_template
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-from ..conf import (
-    TextConfRef, TEMPLATES_UPLOAD_DIR, SUBJECT_PREFIX, MIRROR_SIGNING_SALT,
+from ..conf import TextConfRef, TEMPLATES_UPLOAD_DIR, SUBJECT_PREFIX
+from .fields import JSONTextField
+from .manager import (
+    normalize_email, BlacklistManager, MailManager, MailArchiveManager, SubscriptionManager,
+    SubscriptionTypeManager,
 )
-from .manager import BlacklistManager, SubscriptionManager
 from .options import (
-    AbstractBaseMailHeader, AbstractBaseStaticAttachment,
-    AbstractBaseDynamicAttachment,
+    AbstractBaseMail, AbstractBaseMailHeader, AbstractBaseMailRecipient,
+    AbstractBaseStaticAttachment, AbstractBaseDynamicAttachment,
 )
 
 __all__ = [
     'Campaign', 'CampaignMailHeader', 'CampaignStaticAttachment',
-    'Mail', 'MailHeader', 'MailStaticAttachment', 'MailDynamicAttachment',
-    'SubscriptionType', 'Subscription', 'Blacklist',
+    'Mail', 'MailHeader', 'MailRecipient', 'MailStaticAttachment',
+    'MailDynamicAttachment', 'MailArchive', 'MailArchiveHeader',
+    'MailArchiveRecipient', 'MailArchiveStaticAttachment',
+    'MailArchiveDynamicAttachment',
+    'SubscriptionType', 'Subscription', 'Blacklist', 'OutboxMail',
 ]
 
 
@@ -52,18 +54,38 @@ class SubscriptionType(models.Model):
             "this type by default"
         ))
 
+    objects = SubscriptionTypeManager()
+
     def __str__(self):
         return self.name
 
-    def is_subscribed(self, email):
-        match = re.match(r'.*\s<([^<> ]+)>', email)
-        if match:
-            email = match.group(1)
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        SubscriptionType.objects.clear_cache()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        SubscriptionType.objects.clear_cache()
+        return result
 
-        try:
-            return self.subscriptions.get(email=email).subscribed
-        except Subscription.DoesNotExist:
+    def is_subscribed(self, email):
+        subscribed = Subscription.objects.get_subscribed(email, self.pk)
+        if subscribed is None:
             return self.subscribed_by_default
+        return subscribed
+
+    def filter_subscribed(self, emails):
+        """Return the given e-mails that are subscribed to this type, in the
+        same order, looking them up with at most one query."""
+        states = Subscription.objects.get_subscribed_many(emails, self.pk)
+        subscribed = []
+        for email in emails:
+            state = states[normalize_email(email)]
+            if state is None:
+                state = self.subscribed_by_default
+            if state:
+                subscribed.append(email)
+        return subscribed
 
 
 class Subscription(models.Model):
@@ -74,9 +96,15 @@ class Subscription(models.Model):
         unique_together = [
             ('email', 'subscription_type'),
         ]
+        indexes = [
+            models.Index(fields=['normalized_email', 'subscription_type']),
+        ]
 
     email = models.EmailField(
         db_index=True, verbose_name=_("e-mail"))
+    normalized_email = models.CharField(
+        max_length=254, editable=False, verbose_name=_("normalized e-mail"),
+        help_text=_("Lowercased e-mail address, used for lookups."))
     subscription_type = models.ForeignKey(
         SubscriptionType, models.CASCADE,
         related_name='subscriptions', related_query_name='subscriptions',
@@ -89,8 +117,17 @@ class Subscription(models.Model):
     objects = SubscriptionManager()
 
     def save(self, *args, **kwargs):
+        self.normalized_email = normalize_email(self.email)
         self.last_modified = timezone.now()
         super().save(*args, **kwargs)
+        Subscription.objects.clear_cache(
+            [self.normalized_email], [self.subscription_type_id])
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        Subscription.objects.clear_cache(
+            [self.normalized_email], [self.subscription_type_id])
+        return result
 
 
 class Campaign(models.Model):
@@ -157,6 +194,11 @@ class Campaign(models.Model):
         return (not self.subscription_type or
                 self.subscription_type.is_subscribed(email))
 
+    def filter_subscribed(self, emails):
+        if not self.subscription_type:
+            return list(emails)
+        return self.subscription_type.filter_subscribed(emails)
+
 
 class CampaignMailHeader(AbstractBaseMailHeader):
 
@@ -174,61 +216,17 @@ class CampaignStaticAttachment(AbstractBaseStaticAttachment):
         'Campaign', models.CASCADE, related_name='static_attachments')
 
 
-class Mail(models.Model):
+class Mail(AbstractBaseMail):
 
     class Meta:
         ordering = ['-scheduled_on']
         verbose_name = _("e-mail")
         verbose_name_plural = _("e-mails")
+        indexes = [
+            models.Index(fields=['status', 'scheduled_on']),
+        ]
 
-    STATUS_PENDING = 1
-    STATUS_SENT = 2
-    STATUS_CANCELED = 3
-    STATUS_FAILURE = 4
-    STATUS_DRAFT = 5
-    STATUS_CHOICES = [
-        (STATUS_PENDING, _("Pending")),
-        (STATUS_SENT, _("Sent")),
-        (STATUS_CANCELED, _("Canceled")),
-        (STATUS_FAILURE, _("Failure")),
-        (STATUS_DRAFT, _("Draft")),
-    ]
-
-    campaign = models.ForeignKey(
-        'Campaign', models.SET_NULL, blank=True, null=True,
-        verbose_name=_("campaign"))
-    status = models.PositiveSmallIntegerField(
-        choices=STATUS_CHOICES, default=STATUS_DRAFT,
-        verbose_name=_("status"))
-    scheduled_on = models.DateTimeField(
-        default=timezone.now, verbose_name=_("scheduled on"))
-    sent_on = models.DateTimeField(
-        blank=True, null=True, editable=False, verbose_name=_("sent on"))
-    subject = models.CharField(
-        max_length=255, verbose_name=_("subject"))
-    html_body = models.TextField(
-        verbose_name=_("HTML body"))
-    text_body = models.TextField(
-        blank=True, verbose_name=_("text body"),
-        help_text=_("Leave blank to generate from HTML body."))
-    failure_reason = models.TextField(
-        blank=True, editable=False, verbose_name=_("failure reason"))
-
-    def __str__(self):
-        return "[{}] {}".format(self.scheduled_on, self.subject)
-
-    def get_headers(self):
-        headers = dict(self.headers.items())
-        headers.setdefault("X-Mail-Id", str(self.pk))
-        return headers
-
-    def get_attachments(self):
-        return list(self.static_attachments.all()) + list(self.dynamic_attachments.all())
-
-    def get_absolute_url(self):
-        signer = Signer(salt=MIRROR_SIGNING_SALT)
-        signed_pk = signer.sign(str(self.pk))
-        return reverse('mailing:mirror', kwargs={'signed_pk': signed_pk})
+    objects = MailManager()
 
 
 class MailHeader(AbstractBaseMailHeader):
@@ -241,6 +239,12 @@ class MailHeader(AbstractBaseMailHeader):
         'Mail', models.CASCADE, related_name='headers')
 
 
+class MailRecipient(AbstractBaseMailRecipient):
+
+    mail = models.ForeignKey(
+        'Mail', models.CASCADE, related_name='recipients')
+
+
 class MailStaticAttachment(AbstractBaseStaticAttachment):
 
     mail = models.ForeignKey(
@@ -253,6 +257,51 @@ class MailDynamicAttachment(AbstractBaseDynamicAttachment):
         'Mail', models.CASCADE, related_name='dynamic_attachments')
 
 
+class MailArchive(AbstractBaseMail):
+    """A sent, canceled or failed mail moved out of the `Mail` table.
+
+    It keeps the primary key of the original mail so that mirror links remain
+    valid. See `MailArchiveManager.archive`.
+    """
+
+    class Meta:
+        ordering = ['-scheduled_on']
+        verbose_name = _("archived e-mail")
+        verbose_name_plural = _("archived e-mails")
+
+    id = models.IntegerField(primary_key=True, verbose_name="ID")
+
+    objects = MailArchiveManager()
+
+
+class MailArchiveHeader(AbstractBaseMailHeader):
+
+    class Meta:
+        verbose_name = _("header")
+        verbose_name_plural = _("headers")
+
+    mail = models.ForeignKey(
+        'MailArchive', models.CASCADE, related_name='headers')
+
+
+class MailArchiveRecipient(AbstractBaseMailRecipient):
+
+    mail = models.ForeignKey(
+        'MailArchive', models.CASCADE, related_name='recipients')
+
+
+class MailArchiveStaticAttachment(AbstractBaseStaticAttachment):
+
+    mail = models.ForeignKey(
+        'MailArchive', models.CASCADE, related_name='static_attachments')
+
+
+class MailArchiveDynamicAttachment(AbstractBaseDynamicAttachment):
+
+    mail = models.ForeignKey(
+        'MailArchive', models.CASCADE, related_name='dynamic_attachments')
+
+
 class Blacklist(models.Model):
 
     class Meta:
@@ -273,6 +322,10 @@ class Blacklist(models.Model):
 
     email = models.EmailField(
         unique=True, verbose_name=_("e-mail address"))
+    normalized_email = models.CharField(
+        max_length=254, db_index=True, editable=False,
+        verbose_name=_("normalized e-mail address"),
+        help_text=_("Lowercased e-mail address, used for lookups."))
     reason = models.PositiveSmallIntegerField(
         choices=REASON_CHOICES, default=REASON_OTHER,
         verbose_name=_("reason"))
@@ -285,3 +338,45 @@ class Blacklist(models.Model):
 
     def __str__(self):
         return "{} ({})".format(self.email, self.get_reason_display())
+
+    def save(self, *args, **kwargs):
+        self.normalized_email = normalize_email(self.email)
+        super().save(*args, **kwargs)
+
+
+class OutboxMail(models.Model):
+    """A mail recorded by `queue_mail` in outbox mode, to be rendered and
+    queued once the transaction which recorded it is committed.
+    """
+
+    class Meta:
+        verbose_name = _("outbox mail")
+        verbose_name_plural = _("outbox mails")
+        ordering = ['pk']
+
+    STATUS_PENDING = 1
+    STATUS_FAILURE = 4
+    STATUS_CHOICES = [
+        (STATUS_PENDING, _("Pending")),
+        (STATUS_FAILURE, _("Failure")),
+    ]
+
+    campaign_key = models.SlugField(
+        max_length=50, blank=True, null=True, verbose_name=_("campaign key"))
+    context = JSONTextField(
+        blank=True, null=True, verbose_name=_("context"))
+    extra_headers = JSONTextField(
+        blank=True, null=True, verbose_name=_("extra headers"))
+    options = JSONTextField(
+        blank=True, null=True, verbose_name=_("options"),
+        help_text=_("Other keyword arguments of queue_mail."))
+    status = models.PositiveSmallIntegerField(
+        choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True,
+        verbose_name=_("status"))
+    failure_reason = models.TextField(
+        blank=True, editable=False, verbose_name=_("failure reason"))
+    created_on = models.DateTimeField(
+        default=timezone.now, verbose_name=_("created on"))
+
+    def __str__(self):
+        return "{} #{}".format(self.campaign_key or '-', self.pk)
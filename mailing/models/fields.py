@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2016 Aladom SAS & Hosting Dvpt SAS
-from django.db.models import BooleanField
+import json
+
+from django.db.models import BooleanField, TextField
 
 __all__ = [
-    'VariableHelpTextBooleanField',
+    'VariableHelpTextBooleanField', 'JSONTextField',
 ]
 
 
@@ -19,3 +21,30 @@ class VariableHelpTextBooleanField(BooleanField):
         if 'help_text' in kwargs:
             del kwargs['help_text']
         return name, path, args, kwargs
+
+
+class JSONTextField(TextField):
+    """Store a JSON serializable value in a text column, whatever the database
+    backend.
+
+    Non-ASCII characters are stored as is, so that `icontains` lookups on the
+    raw JSON text still match accented values.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return json.loads(value)
+
+    def to_python(self, value):
+        if isinstance(value, str):
+            return json.loads(value)
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        return json.dumps(value, ensure_ascii=False)
+
+    def value_to_string(self, obj):
+        return self.get_prep_value(self.value_from_object(obj))
@@ -1,31 +1,180 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2017 Aladom SAS & Hosting Dvpt SAS
-from functools import reduce
+from collections import OrderedDict
+from functools import partial, reduce
+import hashlib
 from io import BytesIO, StringIO
+from itertools import islice, product
 import os.path
 import re
+import threading
+import time
 from uuid import uuid4
 
+from django.core.cache import caches
 from django.core.files import File
 from django.core.files.base import ContentFile
-from django.db import IntegrityError
-from django.db.models import Manager
+from django.db import IntegrityError, transaction
+from django.db.models import CASCADE, Manager, QuerySet
 from django.utils import timezone
 
+from ..conf import (
+    SUBSCRIPTION_CACHE, SUBSCRIPTION_CACHE_TIMEOUT,
+    SUBSCRIPTION_CACHE_MAX_ENTRIES,
+)
+
 __all__ = [
-    'MailHeaderManager', 'BlacklistManager', 'DynamicAttachmentManager',
-    'StaticAttachmentManager', 'SubscriptionManager',
+    'normalize_email', 'MailQuerySet', 'MailManager', 'MailArchiveManager', 'MailHeaderManager',
+    'MailRecipientManager', 'BlacklistManager', 'DynamicAttachmentManager',
+    'StaticAttachmentManager', 'SubscriptionTypeManager',
+    'SubscriptionManager',
 ]
 
+raw_email_re = re.compile(r'.*<\s*([^<> ]+)\s*>')
+
+
+def normalize_email(email):
+    """Return the canonical form of an e-mail address, used for lookups: the
+    bare address, stripped and lowercased.
+
+    "John Doe <John.Doe@Example.com>" gives "john.doe@example.com".
+    """
+    email = email.strip()
+    match = raw_email_re.match(email)
+    if match:
+        email = match.group(1)
+    return email.lower()
+
+
+class MailQuerySet(QuerySet):
+
+    def sent_to(self, email):
+        """Filter mails having `email` among their To, Cc or Bcc recipients.
+
+        `email` may be given as "John <john@example.com>" and is matched
+        case-insensitively through the recipients index.
+        """
+        return self.filter(
+            recipients__address=normalize_email(email)).distinct()
+
+    def sent_to_domain(self, domain):
+        """Filter mails having a To, Cc or Bcc recipient at `domain`."""
+        return self.filter(recipients__domain=domain.lower()).distinct()
+
+    def pk_chunks(self, size):
+        """Yield lists of at most `size` primary keys in ascending order.
+
+        Chunks are fetched by keyset pagination (`pk > last_pk`) so that each
+        query stays an index range scan, however far in the table it goes.
+        """
+        queryset = self.order_by('pk').values_list('pk', flat=True)
+        last_pk = None
+        while True:
+            if last_pk is not None:
+                chunk = list(queryset.filter(pk__gt=last_pk)[:size])
+            else:
+                chunk = list(queryset[:size])
+            if not chunk:
+                return
+            yield chunk
+            last_pk = chunk[-1]
+
+    def raw_delete(self):
+        """Delete the mails and the rows cascading from them (headers,
+        attachments...) with one direct SQL query per table.
+
+        Unlike `delete()`, nothing is loaded in memory and no signal is sent.
+        Files of dynamic attachments are left on the storage, as they are with
+        `delete()`. Return the number of deleted mails.
+        """
+        for related in self.model._meta.related_objects:
+            if related.on_delete is not CASCADE:
+                continue
+            related_model = related.related_model
+            related_model._base_manager.using(self.db).filter(**{
+                '{}__in'.format(related.field.name): self.values('pk'),
+            })._raw_delete(self.db)
+        return self._raw_delete(self.db)
+    raw_delete.alters_data = True
+
+
+class MailManager(Manager.from_queryset(MailQuerySet)):
+    pass
+
+
+class MailArchiveManager(Manager.from_queryset(MailQuerySet)):
+
+    def archive(self, pks):
+        """Move mails with the given primary keys, along with their headers
+        and attachments, from the `Mail` tables to the archive tables.
+
+        Rows are copied by batch inserts, then deleted from the `Mail` tables
+        in the same transaction. Return the number of archived mails.
+        """
+        mail_model = self.model._meta.apps.get_model(
+            self.model._meta.app_label, 'Mail')
+        mails = mail_model.objects.using(self.db).filter(pk__in=pks)
+        fields = [f.attname for f in self.model._meta.concrete_fields]
+        with transaction.atomic(using=self.db):
+            archived = self.bulk_create(
+                [self.model(**values) for values in mails.values(*fields)])
+            for related in self.model._meta.related_objects:
+                if related.on_delete is not CASCADE:
+                    continue
+                model = related.related_model
+                source_model = mail_model._meta.get_field(
+                    related.name).related_model
+                fields = [
+                    f.attname for f in model._meta.concrete_fields
+                    if not f.primary_key
+                ]
+                rows = source_model._base_manager.using(self.db).filter(**{
+                    '{}__in'.format(related.field.name): pks,
+                }).order_by('pk').values(*fields)
+                model._base_manager.using(self.db).bulk_create(
+                    [model(**values) for values in rows])
+            mails.raw_delete()
+        return len(archived)
+
 
 class MailHeaderManager(Manager):
 
     def items(self):
-        """Return headers as a list of tuples (name, value)."""
+        """Return headers as a list of tuples (name, value).
+
+        When accessed from a mail storing its headers inline (see
+        `AbstractBaseMail.inline_headers`), these are returned without
+        querying the header table.
+        """
+        inline_headers = getattr(
+            getattr(self, 'instance', None), 'inline_headers', None)
+        if inline_headers is not None:
+            yield from inline_headers.items()
+            return
         for header in self.get_queryset():
             yield header.name, header.value
 
 
+class MailRecipientManager(Manager):
+
+    def from_headers(self, headers, **kwargs):
+        """Return unsaved recipients for the To, Cc and Bcc `headers`, ready
+        to be passed to `bulk_create`. Extra keyword arguments (typically
+        `mail`) are set on every recipient.
+        """
+        recipients = []
+        for kind, name in self.model.KIND_CHOICES:
+            for email in BlacklistManager._split_recipients(
+                    headers.get(name) or ''):
+                address = normalize_email(email)
+                if not address:
+                    continue
+                recipients.append(self.model(
+                    kind=kind, address=address[:254],
+                    domain=address.rpartition('@')[2][:254], **kwargs))
+        return recipients
+
+
 class DynamicAttachmentManager(Manager):
 
     def create(self, **kwargs):
@@ -48,20 +197,25 @@ class DynamicAttachmentManager(Manager):
 
 class StaticAttachmentManager(Manager):
 
-    def create(self, **kwargs):
+    def build(self, **kwargs):
+        """Return an unsaved attachment, ready to be passed to `bulk_create`,
+        with its path made absolute like `create` does."""
         base_path = self.model._meta.get_field('attachment').path
         attachment = kwargs.pop('attachment')
         if not attachment.startswith(base_path + '/'):
             attachment = os.path.join(base_path, attachment)
         kwargs['attachment'] = attachment
-        obj = self.model(**kwargs)
+        return self.model(**kwargs)
+
+    def create(self, **kwargs):
+        obj = self.build(**kwargs)
         obj.save()
         return obj
 
 
 class BlacklistManager(Manager):
 
-    raw_email_re = re.compile(r'.*<\s*([^<> ]+)\s*>')
+    raw_email_re = raw_email_re
 
     @staticmethod
     def _split_recipients(recipients):
@@ -78,33 +232,232 @@ class BlacklistManager(Manager):
             email = match.group(1)
         return email
 
+    def bulk_blacklist(self, emails, batch_size=1000, **kwargs):
+        """Blacklist every given e-mail not blacklisted yet, with the
+        `reason` and `verbose_reason` given as keyword arguments.
+
+        `emails` may be any iterable, such as a file: it is consumed
+        `batch_size` addresses at a time. Each batch takes one transaction
+        with one INSERT between two SELECTs, matching addresses by their
+        normalized form. Addresses are stored as first given, without their
+        display name. Return a 2-tuple (nb_created, nb_existing).
+        """
+        emails = iter(emails)
+        nb_created = nb_existing = 0
+        while True:
+            chunk = list(islice(emails, batch_size))
+            if not chunk:
+                return nb_created, nb_existing
+            batch = {}
+            for email in chunk:
+                normalized_email = normalize_email(email)
+                if normalized_email:
+                    batch.setdefault(
+                        normalized_email, self._to_raw_email(email))
+            with transaction.atomic(using=self.db):
+                queryset = self.get_queryset().filter(
+                    normalized_email__in=batch)
+                existing = set(
+                    queryset.values_list('normalized_email', flat=True))
+                self.bulk_create([
+                    self.model(
+                        email=email, normalized_email=normalized_email,
+                        **kwargs)
+                    for normalized_email, email in batch.items()
+                    if normalized_email not in existing
+                ], ignore_conflicts=True)
+                # Rows conflicting with others, inserted meanwhile for
+                # instance, are ignored: count the rows actually created.
+                created = queryset.count() - len(existing)
+            nb_created += created
+            nb_existing += len(batch) - created
+
     def filter_blacklisted(self, *args, **kwargs):
         recipients = list(map(self._split_recipients, args))
         ignore = kwargs.get('ignore')
         if ignore is True:
             return args
-        flatten = map(self._to_raw_email,
+        flatten = map(normalize_email,
                       reduce(lambda x, y: x+y if y else x, recipients, []))
-        queryset = self.get_queryset().filter(email__in=flatten)
+        queryset = self.get_queryset().filter(normalized_email__in=flatten)
         if ignore:
             queryset = queryset.exclude(reason__in=ignore)
-        blacklisted = queryset.values_list('email', flat=True)
+        blacklisted = set(queryset.values_list('normalized_email', flat=True))
         filtered = []
         for recipient_list in recipients:
             if recipient_list:
                 filtered.append(', '.join(
                     r for r in recipient_list
-                    if self._to_raw_email(r) not in blacklisted
+                    if normalize_email(r) not in blacklisted
                 ))
             else:
                 filtered.append(None)
         return filtered
 
 
+class SubscriptionTypeManager(Manager):
+
+    cache_key = 'mailing:subscription_types'
+    cache_timeout = 60
+    _cache = None
+    _cached_on = 0
+
+    def cached(self):
+        """Return the list of all subscription types, cached for
+        `cache_timeout` seconds in the SUBSCRIPTION_CACHE cache, or in the
+        memory of the current process.
+
+        The cache is cleared whenever a subscription type is saved or deleted,
+        at once and again once the current transaction is committed. Without
+        SUBSCRIPTION_CACHE, other processes only see the change once
+        `cache_timeout` has elapsed.
+        """
+        if SUBSCRIPTION_CACHE:
+            cache = caches[SUBSCRIPTION_CACHE]
+            subscription_types = cache.get(self.cache_key)
+            if subscription_types is None:
+                subscription_types = list(self.get_queryset())
+                cache.set(
+                    self.cache_key, subscription_types, self.cache_timeout)
+            return subscription_types
+        cls = type(self)
+        if cls._cache is None or time.monotonic() - cls._cached_on > self.cache_timeout:
+            cls._cache = list(self.get_queryset())
+            cls._cached_on = time.monotonic()
+        return cls._cache
+
+    def _delete_cached(self):
+        if SUBSCRIPTION_CACHE:
+            caches[SUBSCRIPTION_CACHE].delete(self.cache_key)
+        type(self)._cache = None
+
+    def clear_cache(self):
+        self._delete_cached()
+        transaction.on_commit(self._delete_cached, using=self.db)
+
+
 class SubscriptionManager(Manager):
 
+    # Subscription states cached in the current process when
+    # SUBSCRIPTION_CACHE is None, by cache key, as (expires_on, value).
+    _local_cache = OrderedDict()
+    _local_cache_lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(normalized_email, subscription_type_id):
+        # Hashed so that any address makes a valid memcached key.
+        return 'mailing:subscription:{}:{}'.format(
+            subscription_type_id,
+            hashlib.md5(normalized_email.encode()).hexdigest())
+
+    def _get_many_cached(self, keys):
+        if SUBSCRIPTION_CACHE:
+            return caches[SUBSCRIPTION_CACHE].get_many(keys)
+        cls = type(self)
+        now = time.monotonic()
+        values = {}
+        with cls._local_cache_lock:
+            for key in keys:
+                expires_on, value = cls._local_cache.get(key, (0, None))
+                if expires_on < now:
+                    cls._local_cache.pop(key, None)
+                    continue
+                cls._local_cache.move_to_end(key)
+                values[key] = value
+        return values
+
+    def _set_many_cached(self, values):
+        if SUBSCRIPTION_CACHE:
+            caches[SUBSCRIPTION_CACHE].set_many(
+                values, SUBSCRIPTION_CACHE_TIMEOUT)
+            return
+        cls = type(self)
+        expires_on = time.monotonic() + SUBSCRIPTION_CACHE_TIMEOUT
+        with cls._local_cache_lock:
+            for key, value in values.items():
+                cls._local_cache[key] = (expires_on, value)
+                cls._local_cache.move_to_end(key)
+            while len(cls._local_cache) > SUBSCRIPTION_CACHE_MAX_ENTRIES:
+                cls._local_cache.popitem(last=False)
+
+    def _delete_cached(self, keys):
+        if SUBSCRIPTION_CACHE:
+            caches[SUBSCRIPTION_CACHE].delete_many(keys)
+            return
+        cls = type(self)
+        with cls._local_cache_lock:
+            for key in keys:
+                cls._local_cache.pop(key, None)
+
+    def get_subscribed(self, email, subscription_type_id):
+        """Return whether `email` is subscribed to the given subscription
+        type, or None if it has no subscription to it.
+
+        The result is cached for SUBSCRIPTION_CACHE_TIMEOUT seconds, in the
+        SUBSCRIPTION_CACHE cache or in the memory of the current process.
+        """
+        return self.get_subscribed_many(
+            [email], subscription_type_id)[normalize_email(email)]
+
+    def get_subscribed_many(self, emails, subscription_type_id):
+        """Return a dictionary mapping the normalized form of every given
+        e-mail to whether it is subscribed to the given subscription type, or
+        None if it has no subscription to it.
+
+        Results are cached like those of `get_subscribed`, and addresses
+        missing from the cache are looked up with a single query.
+        """
+        normalized_emails = set(map(normalize_email, emails))
+        states = {}
+        if SUBSCRIPTION_CACHE_TIMEOUT:
+            keys = {
+                self._cache_key(email, subscription_type_id): email
+                for email in normalized_emails
+            }
+            # Values are wrapped in a tuple to tell a cached None from a miss.
+            for key, cached in self._get_many_cached(list(keys)).items():
+                if cached is not None:
+                    states[keys[key]] = cached[0]
+        missing = normalized_emails - set(states)
+        if not missing:
+            return states
+        fetched = dict.fromkeys(missing)
+        # The latest subscription wins when an address has several.
+        fetched.update(
+            self.get_queryset().filter(
+                normalized_email__in=missing,
+                subscription_type_id=subscription_type_id,
+            ).order_by('last_modified')
+            .values_list('normalized_email', 'subscribed')
+        )
+        if SUBSCRIPTION_CACHE_TIMEOUT:
+            self._set_many_cached({
+                self._cache_key(email, subscription_type_id): (subscribed,)
+                for email, subscribed in fetched.items()
+            })
+        states.update(fetched)
+        return states
+
+    def clear_cache(self, normalized_emails, subscription_type_ids):
+        """Evict the cached states of every given normalized e-mail to every
+        given subscription type.
+
+        They are evicted at once, then again once the current transaction is
+        committed, so that states read by other processes meanwhile do not
+        linger.
+        """
+        if not SUBSCRIPTION_CACHE_TIMEOUT:
+            return
+        keys = [
+            self._cache_key(email, pk) for email, pk
+            in product(normalized_emails, subscription_type_ids)
+        ]
+        self._delete_cached(keys)
+        transaction.on_commit(
+            partial(self._delete_cached, keys), using=self.db)
+
     def create_or_update(self, **kwargs):
-        filter_kwargs = {'email': kwargs['email']}
+        filter_kwargs = {'normalized_email': normalize_email(kwargs['email'])}
         if 'subscription_type_id' in kwargs:
             filter_kwargs['subscription_type_id'] = kwargs['subscription_type_id']
         elif 'subscription_type' in kwargs:
@@ -112,7 +465,46 @@ class SubscriptionManager(Manager):
         else:
             raise KeyError("Missing subscription type")
         try:
-            self.create(**kwargs)
+            # In a savepoint, so that the transaction outlives the conflict.
+            with transaction.atomic(using=self.db):
+                self.create(**kwargs)
         except IntegrityError:
             self.get_queryset().filter(**filter_kwargs).update(
                 subscribed=kwargs['subscribed'], last_modified=timezone.now())
+            subscription_type_id = kwargs.get('subscription_type_id') or (
+                kwargs['subscription_type'].pk)
+            self.clear_cache(
+                [filter_kwargs['normalized_email']], [subscription_type_id])
+
+    def bulk_set_subscribed(self, emails, subscription_type_ids, subscribed,
+                            batch_size=500):
+        """Set `subscribed` on the subscriptions of every given e-mail to
+        every given subscription type, creating the missing ones.
+
+        `emails` may be any iterable, such as a file: it is consumed
+        `batch_size` addresses at a time. Each batch takes one transaction
+        with one SELECT, one UPDATE and one INSERT, matching addresses by
+        their normalized form. Return a 2-tuple (nb_updated, nb_created).
+        """
+        subscription_type_ids = list(subscription_type_ids)
+        emails = filter(None, map(normalize_email, emails))
+        nb_updated = nb_created = 0
+        while True:
+            batch = set(islice(emails, batch_size))
+            if not batch:
+                return nb_updated, nb_created
+            with transaction.atomic(using=self.db):
+                queryset = self.get_queryset().filter(
+                    normalized_email__in=batch,
+                    subscription_type_id__in=subscription_type_ids)
+                existing = set(queryset.values_list(
+                    'normalized_email', 'subscription_type_id'))
+                nb_updated += queryset.update(
+                    subscribed=subscribed, last_modified=timezone.now())
+                nb_created += len(self.bulk_create([
+                    self.model(email=email, normalized_email=email,
+                               subscription_type_id=pk, subscribed=subscribed)
+                    for email, pk in product(batch, subscription_type_ids)
+                    if (email, pk) not in existing
+                ], ignore_conflicts=True))
+                self.clear_cache(batch, subscription_type_ids)
@@ -4,19 +4,24 @@ from datetime import datetime
 import mimetypes
 import os
 
+from django.core.signing import Signer
 from django.core.validators import MaxLengthValidator
 from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE
 from django.db import models
+from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-from ..conf import ATTACHMENTS_DIR, ATTACHMENTS_UPLOAD_DIR
+from ..conf import ATTACHMENTS_DIR, ATTACHMENTS_UPLOAD_DIR, MIRROR_SIGNING_SALT
+from .fields import JSONTextField
 from .manager import (
-    MailHeaderManager, DynamicAttachmentManager, StaticAttachmentManager,
+    MailHeaderManager, MailRecipientManager, DynamicAttachmentManager,
+    StaticAttachmentManager,
 )
 
 __all__ = [
-    'AbstractBaseMailHeader', 'AbstractBaseStaticAttachment',
-    'AbstractBaseDynamicAttachment',
+    'AbstractBaseMail', 'AbstractBaseMailHeader', 'AbstractBaseMailRecipient',
+    'AbstractBaseStaticAttachment', 'AbstractBaseDynamicAttachment',
 ]
 
 
@@ -36,6 +41,67 @@ class FilePathField(models.FilePathField):
         return name, path, args, kwargs
 
 
+class AbstractBaseMail(models.Model):
+
+    class Meta:
+        abstract = True
+
+    STATUS_PENDING = 1
+    STATUS_SENT = 2
+    STATUS_CANCELED = 3
+    STATUS_FAILURE = 4
+    STATUS_DRAFT = 5
+    STATUS_CHOICES = [
+        (STATUS_PENDING, _("Pending")),
+        (STATUS_SENT, _("Sent")),
+        (STATUS_CANCELED, _("Canceled")),
+        (STATUS_FAILURE, _("Failure")),
+        (STATUS_DRAFT, _("Draft")),
+    ]
+
+    campaign = models.ForeignKey(
+        'Campaign', models.SET_NULL, blank=True, null=True,
+        verbose_name=_("campaign"))
+    status = models.PositiveSmallIntegerField(
+        choices=STATUS_CHOICES, default=STATUS_DRAFT,
+        verbose_name=_("status"))
+    scheduled_on = models.DateTimeField(
+        default=timezone.now, db_index=True, verbose_name=_("scheduled on"))
+    sent_on = models.DateTimeField(
+        blank=True, null=True, editable=False, verbose_name=_("sent on"))
+    subject = models.CharField(
+        max_length=255, verbose_name=_("subject"))
+    html_body = models.TextField(
+        verbose_name=_("HTML body"))
+    text_body = models.TextField(
+        blank=True, verbose_name=_("text body"),
+        help_text=_("Leave blank to generate from HTML body."))
+    failure_reason = models.TextField(
+        blank=True, editable=False, verbose_name=_("failure reason"))
+    inline_headers = JSONTextField(
+        blank=True, null=True, editable=False, verbose_name=_("headers"),
+        help_text=_(
+            "Headers stored along with the mail. When set, header rows are "
+            "ignored."
+        ))
+
+    def __str__(self):
+        return "[{}] {}".format(self.scheduled_on, self.subject)
+
+    def get_headers(self):
+        headers = dict(self.headers.items())
+        headers.setdefault("X-Mail-Id", str(self.pk))
+        return headers
+
+    def get_attachments(self):
+        return list(self.static_attachments.all()) + list(self.dynamic_attachments.all())
+
+    def get_absolute_url(self):
+        signer = Signer(salt=MIRROR_SIGNING_SALT)
+        signed_pk = signer.sign(str(self.pk))
+        return reverse('mailing:mirror', kwargs={'signed_pk': signed_pk})
+
+
 class AbstractBaseMailHeader(models.Model):
 
     class Meta:
@@ -56,6 +122,40 @@ class AbstractBaseMailHeader(models.Model):
         return '{}: {}'.format(self.name, self.value)
 
 
+class AbstractBaseMailRecipient(models.Model):
+    """An address a mail was sent to, indexed for fast lookups.
+
+    Rows are derived from the To, Cc and Bcc headers when the mail is
+    rendered. See `MailRecipientManager.from_headers`.
+    """
+
+    class Meta:
+        abstract = True
+        verbose_name = _("recipient")
+        verbose_name_plural = _("recipients")
+
+    KIND_TO = 1
+    KIND_CC = 2
+    KIND_BCC = 3
+    KIND_CHOICES = [
+        (KIND_TO, 'To'),
+        (KIND_CC, 'Cc'),
+        (KIND_BCC, 'Bcc'),
+    ]
+
+    kind = models.PositiveSmallIntegerField(
+        choices=KIND_CHOICES, verbose_name=_("kind"))
+    address = models.CharField(
+        max_length=254, db_index=True, verbose_name=_("address"))
+    domain = models.CharField(
+        max_length=254, db_index=True, verbose_name=_("domain"))
+
+    objects = MailRecipientManager()
+
+    def __str__(self):
+        return '{}: {}'.format(self.get_kind_display(), self.address)
+
+
 class AbstractBaseAttachment(models.Model):
 
     class Meta:
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+"""Transactional outbox: `queue_mail` records mails as OutboxMail rows in the
+transaction of the caller, and `process_outbox` renders and queues them once
+committed, so that rendering templates does not lengthen that transaction.
+
+Contexts, headers and options are stored as JSON. Model instances are stored
+as references, fetched again when mails are rendered. Files, such as dynamic
+attachments, are stored base64 encoded, and written when mails are rendered.
+"""
+import base64
+import datetime
+import decimal
+import io
+import logging
+import os.path
+import uuid
+
+from django.apps import apps
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import connections, models, transaction
+from django.db.models.functions import Mod
+from django.utils.dateparse import parse_date, parse_datetime, parse_time
+from django.utils.functional import Promise
+
+from .models import OutboxMail
+
+__all__ = [
+    'encode_value', 'record_mail', 'process_outbox',
+]
+
+logger = logging.getLogger('mailing.outbox')
+
+_TYPE_KEY = '__type__'
+
+
+def encode_value(value):
+    """Return a JSON serializable version of `value`, decoded back by
+    `ValueDecoder`. Raise TypeError for values which cannot be stored, such
+    as Template instances or unsaved model instances."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Promise):
+        return str(value)
+    if isinstance(value, dict):
+        return {str(k): encode_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+    if isinstance(value, models.Model):
+        if value.pk is None:
+            raise TypeError(
+                "Unsaved {!r} cannot be recorded in the outbox.".format(value))
+        return {_TYPE_KEY: 'model', 'model': value._meta.label_lower,
+                'pk': value.pk}
+    if isinstance(value, datetime.datetime):
+        return {_TYPE_KEY: 'datetime', 'value': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {_TYPE_KEY: 'date', 'value': value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {_TYPE_KEY: 'time', 'value': value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {_TYPE_KEY: 'decimal', 'value': str(value)}
+    if isinstance(value, uuid.UUID):
+        return {_TYPE_KEY: 'uuid', 'value': str(value)}
+    if isinstance(value, (bytes, File, io.BytesIO, io.StringIO)):
+        return _encode_file(value)
+    raise TypeError(
+        "{!r} cannot be recorded in the outbox.".format(value))
+
+
+def _encode_file(value):
+    name = None
+    if isinstance(value, bytes):
+        content = value
+    else:
+        if isinstance(value, File):
+            name = value.name and os.path.basename(value.name)
+        if value.seekable():
+            value.seek(0)
+        content = value.read()
+        if isinstance(content, str):
+            content = content.encode()
+    return {_TYPE_KEY: 'file', 'name': name,
+            'content': base64.b64encode(content).decode('ascii')}
+
+
+class ValueDecoder:
+    """Decode values encoded by `encode_value`, fetching the model instances
+    referenced by a batch of values with one query per model."""
+
+    def __init__(self, values):
+        refs = {}
+        self._collect(values, refs)
+        self.instances = {}
+        for label, pks in refs.items():
+            model = apps.get_model(label)
+            for pk, instance in model._default_manager.in_bulk(pks).items():
+                # Keys of JSON references may be strings.
+                self.instances[label, str(pk)] = instance
+
+    def _collect(self, value, refs):
+        if isinstance(value, dict):
+            if value.get(_TYPE_KEY) == 'model':
+                refs.setdefault(value['model'], set()).add(value['pk'])
+            else:
+                for v in value.values():
+                    self._collect(v, refs)
+        elif isinstance(value, list):
+            for v in value:
+                self._collect(v, refs)
+
+    def decode(self, value):
+        if isinstance(value, list):
+            return [self.decode(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        kind = value.get(_TYPE_KEY)
+        if kind is None:
+            return {k: self.decode(v) for k, v in value.items()}
+        if kind == 'model':
+            try:
+                return self.instances[value['model'], str(value['pk'])]
+            except KeyError:
+                raise LookupError("{} {} no longer exists.".format(
+                    value['model'], value['pk']))
+        if kind == 'datetime':
+            return parse_datetime(value['value'])
+        if kind == 'date':
+            return parse_date(value['value'])
+        if kind == 'time':
+            return parse_time(value['value'])
+        if kind == 'decimal':
+            return decimal.Decimal(value['value'])
+        if kind == 'uuid':
+            return uuid.UUID(value['value'])
+        if kind == 'file':
+            return ContentFile(
+                base64.b64decode(value['content']), name=value['name'])
+        raise ValueError("Unknown outbox value type: {}".format(kind))
+
+
+def record_mail(campaign_key=None, context=None, extra_headers=None,
+                **kwargs):
+    """Record the arguments of a `queue_mail` call in the outbox and return
+    the OutboxMail instance."""
+    return OutboxMail.objects.create(
+        campaign_key=campaign_key, context=encode_value(context),
+        extra_headers=encode_value(extra_headers),
+        options=encode_value(kwargs))
+
+
+def process_outbox(limit=None, partition=None):
+    """Render and queue mails recorded in the outbox, at most `limit` of them
+    if given. Return a 2-tuple (nb_processed, nb_failures).
+
+    Each mail is rendered in a transaction of its own, which starts by
+    deleting its OutboxMail row: concurrent processes never render it twice.
+    On databases supporting SELECT ... FOR UPDATE SKIP LOCKED, mails being
+    rendered by another process are skipped rather than waited for.
+    Elsewhere, concurrent processes should each give their `partition`, an
+    (index, count) tuple, to only render mails whose primary key modulo
+    `count` is `index`.
+
+    Mails which could not be rendered are kept with `status`
+    OutboxMail.STATUS_FAILURE and their `failure_reason`.
+    """
+    from .utils import queue_mail
+
+    queryset = OutboxMail.objects.filter(status=OutboxMail.STATUS_PENDING)
+    skip_locked = connections[
+        queryset.db].features.has_select_for_update_skip_locked
+    if partition is not None and partition[1] > 1 and not skip_locked:
+        index, count = partition
+        queryset = queryset.annotate(
+            partition=Mod('pk', count)).filter(partition=index)
+    if limit is not None:
+        queryset = queryset[:limit]
+    records = list(queryset)
+    if not records:
+        return 0, 0
+    decoder = ValueDecoder([
+        [record.context, record.extra_headers, record.options]
+        for record in records
+    ])
+    nb_processed = 0
+    failures = []
+    for record in records:
+        try:
+            with transaction.atomic():
+                rows = OutboxMail.objects.filter(
+                    pk=record.pk, status=OutboxMail.STATUS_PENDING)
+                if skip_locked and not list(
+                        rows.select_for_update(skip_locked=True)
+                        .values_list('pk', flat=True)):
+                    # Being rendered by another process.
+                    continue
+                if not rows.delete()[0]:
+                    # Processed by another process meanwhile.
+                    continue
+                nb_processed += 1
+                options = decoder.decode(record.options or {})
+                # Never drop a mail whose campaign no longer exists without
+                # keeping track of it.
+                options['fail_silently'] = False
+                queue_mail(
+                    record.campaign_key, decoder.decode(record.context),
+                    decoder.decode(record.extra_headers), outbox=False,
+                    **options)
+        except Exception as e:
+            logger.exception("Failed to render outbox mail %d.", record.pk)
+            record.status = OutboxMail.STATUS_FAILURE
+            record.failure_reason = str(e)
+            failures.append(record)
+    OutboxMail.objects.bulk_update(failures, ['status', 'failure_reason'])
+    return nb_processed, len(failures)
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+"""A staged send pipeline, in which fetching mails from the queue, building
+MIME messages, transmitting them over SMTP and recording their status run
+concurrently, in threads connected by bounded queues.
+"""
+from collections import defaultdict
+from contextlib import nullcontext
+import logging
+import queue
+import threading
+import time
+
+from django.core.mail import get_connection
+from django.db import connection as db_connection
+from django.utils import timezone
+
+from .models import Mail
+from .queues import get_queue
+from .signals import pre_send, post_send, batch_finished
+from .utils import _build_message, _timed
+
+__all__ = [
+    'SendPipeline',
+]
+
+logger = logging.getLogger('mailing.pipeline')
+
+_STOP = object()
+
+
+class Stage:
+    """A step of the pipeline run by `concurrency` threads, each taking items
+    from the `input` queue and putting what `process` returns to the input
+    queue of the next stage.
+    """
+
+    name = None
+
+    def __init__(self, pipeline, concurrency, maxsize=0):
+        if concurrency < 1:
+            raise ValueError(
+                "The concurrency of the {} stage must be a positive "
+                "integer.".format(self.name))
+        self.pipeline = pipeline
+        self.concurrency = concurrency
+        self.input = queue.Queue(maxsize)
+        self.next = None
+        self.nb_items = 0
+        self.busy = 0.0
+        self.occupancy_sum = 0
+        self.max_occupancy = 0
+        self.durations = defaultdict(float)
+        self._running = concurrency
+        self._lock = threading.Lock()
+
+    def open(self):
+        """Return the state of a thread of this stage."""
+        return None
+
+    def close(self, state):
+        pass
+
+    def process(self, item, state):
+        """Process an item and return the list of items for the next
+        stage."""
+        raise NotImplementedError
+
+    def flush(self, state):
+        """Called whenever the input queue is empty, and before exiting."""
+        pass
+
+    def run(self):
+        state = self.open()
+        try:
+            while True:
+                occupancy = self.input.qsize()
+                if not occupancy:
+                    self.timed_flush(state)
+                item = self.input.get()
+                if item is _STOP:
+                    break
+                started = time.perf_counter()
+                outputs = self.process(item, state)
+                busy = time.perf_counter() - started
+                with self._lock:
+                    self.nb_items += 1
+                    self.busy += busy
+                    self.occupancy_sum += occupancy
+                    self.max_occupancy = max(self.max_occupancy, occupancy)
+                for output in outputs:
+                    self.next.input.put(output)
+            self.timed_flush(state)
+        except BaseException as e:
+            self.pipeline.fail(e)
+            # Keep consuming so that upstream stages are not blocked.
+            while self.input.get() is not _STOP:
+                pass
+        finally:
+            self.close(state)
+            db_connection.close()
+            self.stopped()
+
+    def timed_flush(self, state):
+        started = time.perf_counter()
+        self.flush(state)
+        with self._lock:
+            self.busy += time.perf_counter() - started
+
+    def stopped(self):
+        with self._lock:
+            self._running -= 1
+            last = not self._running
+        if last and self.next is not None:
+            for i in range(self.next.concurrency):
+                self.next.input.put(_STOP)
+
+    def add_durations(self, durations):
+        with self._lock:
+            for key, duration in durations.items():
+                self.durations[key] += duration
+
+    def get_stats(self, elapsed):
+        return {
+            'concurrency': self.concurrency,
+            'items': self.nb_items,
+            'items_per_sec': self.nb_items / elapsed if elapsed else 0,
+            # Share of the time the threads of the stage were working.
+            'utilization': (
+                self.busy / (elapsed * self.concurrency) if elapsed else 0),
+            # Number of items waiting in the input queue.
+            'avg_queue': (
+                self.occupancy_sum / self.nb_items if self.nb_items else 0),
+            'max_queue': self.max_occupancy,
+        }
+
+
+class FetchStage(Stage):
+    """Claim mails from the queue backend until it has no more. Backends such
+    as DatabaseQueue return pending mails until they are acked, so mails
+    already fetched by this run are skipped, claiming past them, and fetching
+    waits for the status of mails in flight to be recorded before giving up.
+    """
+
+    name = 'fetch'
+
+    def __init__(self, pipeline, fetch_size):
+        super().__init__(pipeline, 1)
+        self.fetch_size = fetch_size
+        self.seen = set()
+        self.in_flight = set()
+        self.changed = threading.Condition()
+
+    def done(self, pks):
+        with self.changed:
+            self.in_flight.difference_update(pks)
+            self.changed.notify_all()
+
+    def run(self):
+        queue_backend = get_queue()
+        # Number of mails already fetched returned by the last claim, likely
+        # to be returned again ahead of the others.
+        nb_seen = 0
+        try:
+            while not self.pipeline.stop_event.is_set():
+                with self.changed:
+                    nb_in_flight = len(self.in_flight)
+                limit = self.fetch_size + nb_seen
+                durations = defaultdict(float)
+                started = time.perf_counter()
+                with _timed(durations, 'db'), self.pipeline.db_lock:
+                    claimed = queue_backend.claim(limit)
+                mails = [mail for mail in claimed if mail.pk not in self.seen]
+                nb_seen = len(claimed) - len(mails)
+                with self._lock:
+                    self.busy += time.perf_counter() - started
+                self.add_durations(durations)
+                if not mails:
+                    if len(claimed) >= limit:
+                        # Unsent mails may follow those already fetched.
+                        continue
+                    with self.changed:
+                        if not self.in_flight:
+                            break
+                        if len(self.in_flight) == nb_in_flight:
+                            self.changed.wait(1)
+                    continue
+                pks = {mail.pk for mail in mails}
+                self.seen.update(pks)
+                with self.changed:
+                    self.in_flight.update(pks)
+                for mail in mails:
+                    with self._lock:
+                        self.nb_items += 1
+                    self.next.input.put(mail)
+        except BaseException as e:
+            self.pipeline.fail(e)
+        finally:
+            db_connection.close()
+            self.stopped()
+
+
+class BuildStage(Stage):
+    """Build the MIME message of mails."""
+
+    name = 'build'
+
+    def process(self, mail, state):
+        durations = defaultdict(float)
+        pre_send.send(
+            sender=Mail, mail=mail, mail_id=mail.pk,
+            campaign_key=mail.campaign.key if mail.campaign else None)
+        try:
+            with _timed(durations, 'mime'):
+                msg = _build_message(mail)
+        except Exception as e:
+            self.add_durations(durations)
+            self.pipeline.post_send(mail, None, e, durations)
+            mail.failure_reason = str(e)
+            return [(mail, 'failed', durations)]
+        self.add_durations(durations)
+        if msg is None:
+            self.pipeline.post_send(mail, None, None, durations)
+            return [(mail, 'skipped', durations)]
+        return [(mail, msg, durations)]
+
+
+class SendStage(Stage):
+    """Transmit messages to the e-mail backend, each thread keeping its own
+    connection open."""
+
+    name = 'send'
+
+    def open(self):
+        return {'connection': None}
+
+    def close(self, state):
+        if state['connection'] is not None:
+            try:
+                state['connection'].close()
+            except Exception:
+                pass
+
+    def process(self, item, state):
+        mail, msg, durations = item
+        if not hasattr(msg, 'send'):
+            # Already failed or skipped.
+            return [item]
+        local_durations = defaultdict(float)
+        try:
+            with _timed(local_durations, 'smtp'):
+                if state['connection'] is None:
+                    state['connection'] = get_connection()
+                    state['connection'].open()
+                msg.connection = state['connection']
+                msg.send()
+        except Exception as e:
+            # Start over with a new connection.
+            self.close(state)
+            state['connection'] = None
+            durations.update(local_durations)
+            self.add_durations(local_durations)
+            self.pipeline.post_send(mail, None, e, durations)
+            mail.failure_reason = str(e)
+            return [(mail, 'failed', durations)]
+        durations.update(local_durations)
+        self.add_durations(local_durations)
+        self.pipeline.post_send(mail, msg, None, durations)
+        return [(mail, 'sent', durations)]
+
+
+class WriteStage(Stage):
+    """Record the status of mails in bulk, whenever the input queue is
+    empty or `write_size` results are pending."""
+
+    name = 'write'
+
+    def __init__(self, pipeline, concurrency, maxsize, write_size):
+        super().__init__(pipeline, concurrency, maxsize)
+        self.write_size = write_size
+
+    def open(self):
+        return {'sent': [], 'failed': [], 'skipped': []}
+
+    def process(self, item, state):
+        mail, outcome, durations = item
+        state[outcome].append(mail)
+        if sum(map(len, state.values())) >= self.write_size:
+            self.flush(state)
+        return []
+
+    def flush(self, state):
+        if not any(state.values()):
+            return
+        durations = defaultdict(float)
+        with _timed(durations, 'db'), self.pipeline.db_lock:
+            queue_backend = get_queue()
+            queue_backend.ack(state['sent'], timezone.now())
+            queue_backend.nack(state['failed'])
+            # Mails of campaigns in debug mode without DEBUG_EMAIL stay
+            # pending.
+            queue_backend.nack(state['skipped'], retry=True)
+        self.add_durations(durations)
+        pks = set()
+        for outcome, mails in state.items():
+            self.pipeline.record(outcome, len(mails))
+            pks.update(mail.pk for mail in mails)
+            del mails[:]
+        self.pipeline.fetcher.done(pks)
+
+
+class SendPipeline:
+    """Send queued mails with concurrent stages:
+
+    - one fetcher claiming `fetch_size` mails at a time from the queue
+      backend;
+    - `builders` threads building MIME messages;
+    - `senders` threads transmitting them, each with its own connection to
+      the e-mail backend;
+    - `writers` threads recording their status by batches of at most
+      `write_size` mails.
+
+    Stages are connected by queues holding at most `queue_size` items, so
+    that a slow stage holds the previous ones back. Being threads, builders
+    share the GIL: run several processes to use several CPUs.
+    """
+
+    def __init__(self, builders=2, senders=4, writers=1, queue_size=100,
+                 fetch_size=100, write_size=100):
+        self.stop_event = threading.Event()
+        # SQLite does not support concurrent writes: database stages take
+        # turns instead of failing with "database is locked".
+        self.db_lock = (
+            threading.Lock() if db_connection.vendor == 'sqlite'
+            else nullcontext())
+        self.fetcher = FetchStage(self, fetch_size)
+        self.stages = [
+            self.fetcher,
+            BuildStage(self, builders, queue_size),
+            SendStage(self, senders, queue_size),
+            WriteStage(self, writers, queue_size, write_size),
+        ]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+        self.counts = defaultdict(int)
+        self.exception = None
+        self.stats = None
+        self._lock = threading.Lock()
+
+    def record(self, outcome, count):
+        with self._lock:
+            self.counts[outcome] += count
+
+    def fail(self, exception):
+        logger.error(
+            "Send pipeline failed.", exc_info=exception)
+        with self._lock:
+            if self.exception is None:
+                self.exception = exception
+        self.stop_event.set()
+
+    def post_send(self, mail, message, exception, durations):
+        post_send.send(
+            sender=Mail, mail=mail, mail_id=mail.pk,
+            campaign_key=mail.campaign.key if mail.campaign else None,
+            message=message, exception=exception, durations=dict(durations))
+
+    def run(self, stop_event=None):
+        """Send mails until the queue backend has no more mails due, or
+        `stop_event` is set. Return a 2-tuple (nb_successes, nb_failures)
+        like `send_queued_mails`, and keep the statistics of each stage in
+        `stats`.
+        """
+        if stop_event is not None:
+            self.stop_event = stop_event
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(
+                target=stage.run, name='mailing-{}-{}'.format(stage.name, i),
+                daemon=True)
+            for stage in self.stages for i in range(stage.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        self.stats = {
+            stage.name: stage.get_stats(elapsed) for stage in self.stages}
+        if self.exception is not None:
+            raise self.exception
+
+        nb_successes = self.counts['sent']
+        nb_failures = self.counts['failed'] + self.counts['skipped']
+        durations = defaultdict(float)
+        for stage in self.stages:
+            for key, duration in stage.durations.items():
+                durations[key] += duration
+        batch_finished.send(
+            sender=Mail, nb_successes=nb_successes, nb_failures=nb_failures,
+            durations=dict(durations))
+        if nb_successes or nb_failures:
+            logger.info("Pipeline stats: %s", self.format_stats())
+        return nb_successes, nb_failures
+
+    def format_stats(self):
+        return '; '.join(
+            '{} x{}: {} items, {:.1f}/s, {:.0%} busy, queue {:.1f} avg '
+            '{} max'.format(
+                name, stats['concurrency'], stats['items'],
+                stats['items_per_sec'], stats['utilization'],
+                stats['avg_queue'], stats['max_queue'])
+            for name, stats in self.stats.items())
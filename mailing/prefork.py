@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+"""A supervisor forking worker processes, so that the CPU-bound steps of
+sending (MIME building, html_to_text) run in parallel. POSIX only.
+"""
+import logging
+import os
+import signal
+import threading
+import time
+
+from django.db import connections
+
+__all__ = [
+    'Supervisor',
+]
+
+logger = logging.getLogger('mailing.daemon')
+
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+class Supervisor:
+    """Fork `processes` workers calling `worker(index, count, stop_event)`,
+    where `index` is the slot of the worker among `count` slots and
+    `stop_event` a `threading.Event` set when the worker must stop.
+
+    Workers returning are restarted in the same slot, so that they may
+    recycle themselves after some work. Workers crashing are restarted after
+    `restart_delay` seconds. On SIGTERM or SIGINT, the signal is relayed to
+    workers as SIGTERM and `run` returns once they all exited.
+    """
+
+    def __init__(self, worker, processes, restart_delay=1):
+        if processes < 1:
+            raise ValueError("'processes' must be a positive integer.")
+        self.worker = worker
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.children = {}
+        self.stopping = False
+
+    def run(self):
+        previous_handlers = {
+            signum: signal.signal(signum, self.stop) for signum in STOP_SIGNALS
+        }
+        try:
+            for index in range(self.processes):
+                self.spawn(index)
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                index = self.children.pop(pid, None)
+                if index is None:
+                    continue
+                self.reap(pid, index, status)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def reap(self, pid, index, status):
+        if os.WIFSIGNALED(status) or os.WEXITSTATUS(status):
+            logger.error(
+                "Worker %d (pid %d) crashed with status %d.",
+                index, pid, status)
+            if not self.stopping:
+                time.sleep(self.restart_delay)
+        else:
+            logger.info("Worker %d (pid %d) exited.", index, pid)
+        if not self.stopping:
+            self.spawn(index)
+
+    def spawn(self, index):
+        # Forked workers must not share the connections of the supervisor.
+        connections.close_all()
+        # Signals are blocked until the worker installed its own handlers.
+        signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+        pid = os.fork()
+        if pid:
+            # Recorded before a pending signal is handled, so that `stop`
+            # relays it to this worker too.
+            self.children[pid] = index
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+            logger.info("Worker %d started (pid %d).", index, pid)
+            return
+        code = 1
+        try:
+            stop_event = threading.Event()
+            for signum in STOP_SIGNALS:
+                signal.signal(
+                    signum, lambda signum, frame: stop_event.set())
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+            self.worker(index, self.processes, stop_event)
+            code = 0
+        except BaseException:
+            logger.exception("Worker %d (pid %d) failed.", index, os.getpid())
+        finally:
+            # Skip the cleanup of the supervisor, such as atexit handlers.
+            os._exit(code)
+
+    def stop(self, signum=None, frame=None):
+        """Stop gracefully: relay SIGTERM to workers and stop restarting
+        them."""
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+"""Profiling of the sending daemon batches with cProfile."""
+import cProfile
+import glob
+from io import StringIO
+import logging
+import os
+import pstats
+import time
+
+__all__ = [
+    'BatchProfiler',
+]
+
+logger = logging.getLogger('mailing.profiling')
+
+
+class BatchProfiler:
+    """Profile one batch out of `every` and dump its stats to a `.prof` file
+    of `directory`, to be read with `pstats` or tools such as snakeviz.
+
+    Only the `keep` most recent files are kept. The `top` functions with the
+    highest cumulative time are logged to the "mailing.profiling" logger.
+    """
+
+    file_prefix = 'send_queued_mails-'
+
+    def __init__(self, directory, every=1, keep=10, top=20):
+        if every < 1:
+            raise ValueError("'every' must be a positive integer.")
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+        self.top = top
+        self.nb_batches = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def run(self, func, *args, **kwargs):
+        """Call `func(*args, **kwargs)`, profiling it if its turn has come,
+        and return its result."""
+        self.nb_batches += 1
+        if self.nb_batches % self.every:
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self.dump(profile)
+
+    def dump(self, profile):
+        # Names sort by date, so that rotation removes the oldest files.
+        path = os.path.join(self.directory, '{}{}-{}-{:06d}.prof'.format(
+            self.file_prefix, time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+            self.nb_batches))
+        profile.dump_stats(path)
+        self.rotate()
+        if self.top:
+            stream = StringIO()
+            stats = pstats.Stats(profile, stream=stream)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            logger.info(
+                "Profile of batch %d written to %s\n%s",
+                self.nb_batches, path, stream.getvalue())
+        return path
+
+    def rotate(self):
+        paths = sorted(glob.glob(os.path.join(
+            self.directory, '{}*.prof'.format(self.file_prefix))))
+        for path in paths[:max(0, len(paths) - self.keep)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Removed by another daemon sharing the directory.
+                pass
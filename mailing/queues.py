@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+"""Queue backends, through which `queue_mail` hands pending mails over and
+`send_queued_mails` claims them.
+
+Mails and their status are always stored in the database. Backends other
+than `DatabaseQueue` only carry the primary keys of pending mails along with
+their schedule, so that finding work does not scan the mails table.
+"""
+from datetime import timedelta
+from functools import lru_cache, partial
+import heapq
+import socket
+import threading
+import time
+from urllib.parse import unquote, urlparse
+
+from django.db import transaction
+from django.db.models.functions import Mod
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .conf import QUEUE_BACKEND, QUEUE_OPTIONS
+from .models import Mail
+
+__all__ = [
+    'BaseQueue', 'DatabaseQueue', 'MemoryQueue', 'RedisQueue', 'RedisError',
+    'get_queue',
+]
+
+
+class BaseQueue:
+    """Interface of queue backends.
+
+    - `enqueue(mails)` makes pending mails claimable once the current
+      transaction is committed.
+    - `claim(limit)` returns pending mails due to be sent, each of them being
+      handed to a single caller.
+    - `ack(mails, sent_on)` marks claimed mails as sent.
+    - `nack(mails, retry)` gives claimed mails back to the queue if `retry`
+      is True, or marks them as failed with their `failure_reason`.
+    """
+
+    def enqueue(self, mails):
+        items = [(mail.pk, mail.scheduled_on.timestamp()) for mail in mails]
+        if items:
+            transaction.on_commit(partial(self.push, items))
+
+    def push(self, items):
+        """Make the mails of the given (pk, timestamp) items claimable from
+        the given timestamps."""
+        raise NotImplementedError
+
+    def claim(self, limit=None):
+        raise NotImplementedError
+
+    def set_partition(self, index, count):
+        """Only claim the share `index` of `count` of the mails, so that
+        `count` processes may claim mails concurrently. Backends whose claims
+        are already exclusive ignore it."""
+        pass
+
+    def ack(self, mails, sent_on):
+        if mails:
+            # Mails canceled meanwhile, from the admin for instance, keep
+            # their status.
+            Mail.objects.filter(
+                pk__in=[mail.pk for mail in mails],
+                status=Mail.STATUS_PENDING,
+            ).update(status=Mail.STATUS_SENT, sent_on=sent_on)
+
+    def nack(self, mails, retry=False):
+        if mails and not retry:
+            for mail in mails:
+                mail.status = Mail.STATUS_FAILURE
+            Mail.objects.bulk_update(mails, ['status', 'failure_reason'])
+
+    @staticmethod
+    def get_mails(queryset):
+        # Campaigns, headers and attachments are fetched for the whole batch,
+        # so that the number of queries does not depend on the number of
+        # mails.
+        return list(
+            queryset.select_related('campaign')
+            .prefetch_related(
+                'headers', 'static_attachments', 'dynamic_attachments')
+        )
+
+    def get_pending_mails(self, pks):
+        """Return the mails of the given primary keys which are still
+        pending, in the same order."""
+        mails = {
+            mail.pk: mail for mail in self.get_mails(Mail.objects.filter(
+                pk__in=pks, status=Mail.STATUS_PENDING))
+        }
+        return [mails[pk] for pk in pks if pk in mails]
+
+
+class DatabaseQueue(BaseQueue):
+    """Poll the mails table for pending mails due to be sent. Mails are
+    claimable as soon as they are saved, and stay pending until acked or
+    nacked: concurrent processes must each claim their own partition (see
+    `set_partition`). Mails given back to the queue are rescheduled
+    `retry_delay` seconds later.
+    """
+
+    partition = None
+
+    def __init__(self, retry_delay=60):
+        self.retry_delay = retry_delay
+
+    def enqueue(self, mails):
+        pass
+
+    def push(self, items):
+        pass
+
+    def set_partition(self, index, count):
+        # Mails are shared by their primary key modulo `count`.
+        self.partition = (index, count) if count > 1 else None
+
+    def claim(self, limit=None):
+        queryset = Mail.objects.filter(
+            status=Mail.STATUS_PENDING, scheduled_on__lte=timezone.now())
+        if self.partition is not None:
+            index, count = self.partition
+            queryset = queryset.annotate(
+                partition=Mod('pk', count)).filter(partition=index)
+        if limit is not None:
+            queryset = queryset.order_by('scheduled_on')[:limit]
+        return self.get_mails(queryset)
+
+    def nack(self, mails, retry=False):
+        super().nack(mails, retry)
+        if mails and retry:
+            # Defer mails given back, so that they do not stay at the head of
+            # the queue, claimed again and again ahead of later mails.
+            Mail.objects.filter(
+                pk__in=[mail.pk for mail in mails],
+                status=Mail.STATUS_PENDING,
+            ).update(scheduled_on=timezone.now() + timedelta(
+                seconds=self.retry_delay))
+
+
+class MemoryQueue(BaseQueue):
+    """Keep primary keys in the memory of the current process, meant for
+    tests: mails are only claimable from the process which queued them.
+    """
+
+    def __init__(self, batch_size=100, retry_delay=60):
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+
+    def push(self, items):
+        with self._lock:
+            for pk, timestamp in items:
+                heapq.heappush(self._heap, (timestamp, pk))
+
+    def claim(self, limit=None):
+        limit = limit or self.batch_size
+        now = time.time()
+        pks = []
+        with self._lock:
+            while self._heap and len(pks) < limit and self._heap[0][0] <= now:
+                pks.append(heapq.heappop(self._heap)[1])
+        return self.get_pending_mails(pks)
+
+    def nack(self, mails, retry=False):
+        super().nack(mails, retry)
+        if retry:
+            timestamp = time.time() + self.retry_delay
+            self.push([(mail.pk, timestamp) for mail in mails])
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    """Minimal client of the Redis serialization protocol, thread-safe."""
+
+    def __init__(self, url, timeout=10):
+        url = urlparse(url)
+        self.host = url.hostname or 'localhost'
+        self.port = url.port or 6379
+        self.password = unquote(url.password) if url.password else None
+        self.db = int(url.path.strip('/') or 0)
+        self.timeout = timeout
+        self._sock = self._file = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        self._sock = socket.create_connection(
+            (self.host, self.port), self.timeout)
+        self._file = self._sock.makefile('rb')
+        if self.password:
+            self._call('AUTH', self.password)
+        if self.db:
+            self._call('SELECT', self.db)
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = self._file = None
+
+    def execute(self, *args, idempotent=True):
+        """Send a command and return its reply, reconnecting once if the
+        server closed the connection. Commands which are not `idempotent`
+        are not sent again once written, as they may have run although their
+        reply was lost."""
+        with self._lock:
+            if self._sock is None:
+                self.connect()
+            try:
+                self._send(*args)
+            except OSError:
+                self.close()
+                self.connect()
+                self._send(*args)
+            try:
+                return self._read_reply()
+            except (OSError, EOFError):
+                self.close()
+                if not idempotent:
+                    raise
+                self.connect()
+                return self._call(*args)
+
+    def _send(self, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self._sock.sendall(b''.join(parts))
+
+    def _call(self, *args):
+        self._send(*args)
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line.endswith(b'\r\n'):
+            raise EOFError("Connection closed by the Redis server.")
+        kind, value = line[:1], line[1:-2]
+        if kind == b'+':
+            return value.decode()
+        if kind == b'-':
+            raise RedisError(value.decode())
+        if kind == b':':
+            return int(value)
+        if kind == b'$':
+            if int(value) < 0:
+                return None
+            data = self._file.read(int(value) + 2)
+            return data[:-2]
+        if kind == b'*':
+            if int(value) < 0:
+                return None
+            return [self._read_reply() for i in range(int(value))]
+        raise RedisError("Unexpected reply: {!r}".format(line))
+
+
+class RedisQueue(BaseQueue):
+    """Keep primary keys in a sorted set of a Redis server, scored by the
+    timestamp from which mails are due, so that several sending processes
+    may claim mails concurrently.
+
+    Claimed mails are moved to another sorted set until acked or nacked, and
+    given back to the queue after `visibility_timeout` seconds, in case the
+    process which claimed them died.
+
+    Requires Redis 2.6 or later, for Lua scripting.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', key='mailing:queue',
+                 batch_size=100, retry_delay=60, visibility_timeout=600):
+        self.connection = RedisConnection(url)
+        self.key = key
+        self.claimed_key = key + ':claimed'
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.visibility_timeout = visibility_timeout
+
+    def __len__(self):
+        return self.connection.execute('ZCARD', self.key)
+
+    def clear(self):
+        self.connection.execute('DEL', self.key, self.claimed_key)
+
+    def push(self, items):
+        self._zadd(self.key, items)
+
+    def _zadd(self, key, items):
+        args = []
+        for pk, timestamp in items:
+            args.extend([repr(float(timestamp)), pk])
+        if args:
+            self.connection.execute('ZADD', key, *args)
+
+    def _zrem(self, key, pks):
+        if pks:
+            self.connection.execute('ZREM', key, *pks)
+
+    # Give mails claimed before ARGV[2] back to the queue, then move at most
+    # ARGV[3] mails due at ARGV[1] to the claimed set, in a single atomic step
+    # so that no mail is lost if the client fails halfway.
+    CLAIM_SCRIPT = """
+local expired = redis.call(
+    'ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+for i, pk in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], pk)
+    redis.call('ZADD', KEYS[1], ARGV[1], pk)
+end
+local due = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for i, pk in ipairs(due) do
+    redis.call('ZREM', KEYS[1], pk)
+    redis.call('ZADD', KEYS[2], ARGV[1], pk)
+end
+return due
+"""
+
+    def claim(self, limit=None):
+        # Mails claimed for longer than `visibility_timeout` are given back
+        # to the queue first, in case the process which claimed them died.
+        now = time.time()
+        # Sending the script again would claim another batch, the first one
+        # being only given back after the visibility timeout.
+        due = [
+            int(pk) for pk in self.connection.execute(
+                'EVAL', self.CLAIM_SCRIPT, 2, self.key, self.claimed_key,
+                repr(now), repr(now - self.visibility_timeout),
+                limit or self.batch_size, idempotent=False)
+        ]
+        mails = self.get_pending_mails(due)
+        # Mails no longer pending are simply dropped.
+        self._zrem(self.claimed_key, sorted(
+            set(due) - {mail.pk for mail in mails}))
+        return mails
+
+    def ack(self, mails, sent_on):
+        super().ack(mails, sent_on)
+        self._zrem(self.claimed_key, [mail.pk for mail in mails])
+
+    def nack(self, mails, retry=False):
+        super().nack(mails, retry)
+        if retry:
+            timestamp = time.time() + self.retry_delay
+            self._zadd(self.key, [(mail.pk, timestamp) for mail in mails])
+        self._zrem(self.claimed_key, [mail.pk for mail in mails])
+
+
+@lru_cache(maxsize=None)
+def _load_queue(path):
+    return import_string(path)(**QUEUE_OPTIONS)
+
+
+def get_queue():
+    """Return the instance of the QUEUE_BACKEND class, shared by the current
+    process."""
+    return _load_queue(QUEUE_BACKEND)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+"""Signals sent along the rendering and sending of mails, with `Mail` as
+sender.
+
+Durations are given in seconds, as a dict which keys are among:
+
+- 'render': rendering of subject, headers and body templates;
+- 'db': database queries (saving the mail, checking blacklist and
+  subscriptions, updating statuses...);
+- 'mime': building the message, attachments included;
+- 'smtp': transmission of the message by the e-mail backend.
+"""
+from django.dispatch import Signal
+
+__all__ = [
+    'pre_render', 'post_render', 'pre_send', 'post_send', 'batch_finished',
+]
+
+pre_render = Signal(providing_args=['campaign_key', 'subject', 'headers'])
+"""Sent by `render_mail` before anything is rendered or saved."""
+
+post_render = Signal(providing_args=[
+    'mail', 'mail_id', 'campaign_key', 'durations',
+])
+"""Sent by `render_mail` once the mail is saved, with 'render' and 'db'
+durations."""
+
+pre_send = Signal(providing_args=['mail', 'mail_id', 'campaign_key'])
+"""Sent by `send_mail` before the message is built."""
+
+post_send = Signal(providing_args=[
+    'mail', 'mail_id', 'campaign_key', 'message', 'exception', 'durations',
+])
+"""Sent by `send_mail` once the message is sent, or failed to be sent, with
+'mime' and 'smtp' durations. `message` is the EmailMultiAlternatives
+instance, or None when the mail was not sent. `exception` is the exception
+raised while sending, if any."""
+
+batch_finished = Signal(providing_args=[
+    'nb_successes', 'nb_failures', 'durations',
+])
+"""Sent by `send_queued_mails` once every mail of the batch is processed,
+with 'db', 'mime' and 'smtp' durations summed over the batch."""
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+"""A minimal SMTP server accepting every message, meant to measure sending
+throughput without a real mail server.
+"""
+import socketserver
+import threading
+
+__all__ = [
+    'SMTPSink',
+]
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 {} SMTP sink'.format(self.server.hostname))
+        mail_from, rcpt_tos = None, []
+        for line in self.rfile:
+            command = line.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self.reply('250-{}'.format(self.server.hostname))
+                self.reply('250 8BITMIME')
+            elif verb == 'HELO':
+                self.reply('250 {}'.format(self.server.hostname))
+            elif verb == 'MAIL':
+                mail_from, rcpt_tos = command[10:].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                rcpt_tos.append(command[8:].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self.read_data()
+                self.server.message_received(mail_from, rcpt_tos, data)
+                mail_from, rcpt_tos = None, []
+                self.reply('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                if verb == 'RSET':
+                    mail_from, rcpt_tos = None, []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+    def read_data(self):
+        lines = []
+        for line in self.rfile:
+            if line in (b'.\r\n', b'.\n'):
+                break
+            # Undo dot-stuffing.
+            if line.startswith(b'.'):
+                line = line[1:]
+            lines.append(line)
+        return b''.join(lines)
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """SMTP server accepting every message, counting them in `nb_messages`
+    and passing them to `on_message(mail_from, rcpt_tos, data)` if given.
+
+    Bind to port 0 to get a free port, then read it from `server_address`.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # Accept bursts of connections from concurrent senders.
+    request_queue_size = 128
+    hostname = 'localhost'
+
+    def __init__(self, address=('127.0.0.1', 0), on_message=None):
+        super().__init__(address, SMTPSinkHandler)
+        self.on_message = on_message
+        self.nb_messages = 0
+        self._lock = threading.Lock()
+
+    def message_received(self, mail_from, rcpt_tos, data):
+        with self._lock:
+            self.nb_messages += 1
+            if self.on_message is not None:
+                self.on_message(mail_from, rcpt_tos, data)
+
+    def start(self):
+        """Serve in a background thread and return the (host, port) address
+        listened on."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
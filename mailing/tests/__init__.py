@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.utils import timezone
+
+from mailing.models import Mail
+
+
+def create_mail(to='john@example.com', **kwargs):
+    """Create a pending mail due a minute ago."""
+    kwargs.setdefault('status', Mail.STATUS_PENDING)
+    kwargs.setdefault('scheduled_on', timezone.now() - timedelta(minutes=1))
+    return Mail.objects.create(
+        subject="Hello", html_body="<p>Hello</p>",
+        inline_headers={'To': to}, **kwargs)
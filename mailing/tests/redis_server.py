@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""A stand-in of a Redis server, implementing the commands used by
+mailing.queues.RedisQueue on sorted sets kept in memory.
+
+Lua scripts are not interpreted: EVAL runs a Python version of the scripts
+of RedisQueue, known by their source.
+"""
+import socketserver
+import threading
+
+from mailing.queues import RedisQueue
+
+
+class RedisHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                line = self.rfile.readline()
+            except ConnectionError:
+                # Closed by the client before reading its last reply.
+                return
+            if not line:
+                return
+            args = []
+            for i in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            with self.server.lock:
+                try:
+                    reply = self.server.execute(
+                        args[0].decode().upper(), *args[1:])
+                except Exception as e:
+                    self.wfile.write(b'-ERR ' + str(e).encode() + b'\r\n')
+                    continue
+            self.wfile.write(self.encode(reply))
+
+    def encode(self, reply):
+        if isinstance(reply, str):
+            return b'+' + reply.encode() + b'\r\n'
+        if isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if isinstance(reply, bytes):
+            return b'$%d\r\n%s\r\n' % (len(reply), reply)
+        return b'*%d\r\n' % len(reply) + b''.join(map(self.encode, reply))
+
+
+def parse_score(value):
+    return float(value.decode().replace('inf', 'Infinity'))
+
+
+class RedisServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super().__init__(address, RedisHandler)
+        self.lock = threading.Lock()
+        self.data = {}
+        self.scripts = {RedisQueue.CLAIM_SCRIPT: self.claim_script}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return 'redis://{}:{}/0'.format(*self.server_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def sorted_members(self, key):
+        zset = self.data.get(key, {})
+        return sorted(zset.items(), key=lambda item: (item[1], item[0]))
+
+    def claim_script(self, keys, argv):
+        queue = self.data.setdefault(keys[0], {})
+        claimed = self.data.setdefault(keys[1], {})
+        now, expired_before = parse_score(argv[0]), parse_score(argv[1])
+        for member, score in self.sorted_members(keys[1]):
+            if score <= expired_before:
+                del claimed[member]
+                queue[member] = now
+        due = [
+            member for member, score in self.sorted_members(keys[0])
+            if score <= now
+        ][:int(argv[2])]
+        for member in due:
+            del queue[member]
+            claimed[member] = now
+        return due
+
+    def execute(self, command, *args):
+        if command in ('PING', 'SELECT', 'AUTH'):
+            return 'OK'
+        if command == 'DEL':
+            return sum(self.data.pop(key, None) is not None for key in args)
+        if command == 'ZADD':
+            zset = self.data.setdefault(args[0], {})
+            added = 0
+            for i in range(1, len(args), 2):
+                added += args[i + 1] not in zset
+                zset[args[i + 1]] = parse_score(args[i])
+            return added
+        if command == 'ZCARD':
+            return len(self.data.get(args[0], {}))
+        if command == 'ZREM':
+            zset = self.data.get(args[0], {})
+            return sum(zset.pop(member, None) is not None for member in args[1:])
+        if command == 'EVAL':
+            script = self.scripts[args[0].decode()]
+            nb_keys = int(args[1])
+            return script(args[2:2 + nb_keys], args[2 + nb_keys:])
+        if command == 'ZRANGEBYSCORE':
+            low, high = parse_score(args[1]), parse_score(args[2])
+            members = [
+                member for member, score in self.sorted_members(args[0])
+                if low <= score <= high
+            ]
+            if len(args) > 3 and args[3].upper() == b'LIMIT':
+                offset, count = int(args[4]), int(args[5])
+                members = members[offset:offset + count]
+            return members
+        raise ValueError("unknown command '{}'".format(command))
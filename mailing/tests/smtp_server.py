@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""An asyncio SMTP server keeping the messages it receives, meant to test
+mailing.aio against a local server."""
+import asyncio
+
+
+class AsyncSMTPServer:
+    """Accept every message in `messages`, as (mail_from, rcpt_tos, data)
+    tuples, except for recipients in `rejected`. Each reply to DATA is
+    delayed by `delay` seconds, so that sessions overlap.
+
+    `max_sessions` is the highest number of concurrent sessions seen.
+    """
+
+    def __init__(self, rejected=(), delay=0):
+        self.rejected = set(rejected)
+        self.delay = delay
+        self.messages = []
+        self.sessions = 0
+        self.max_sessions = 0
+        self.server = None
+
+    async def start(self):
+        """Listen on a free port and return the (host, port) address."""
+        self.server = await asyncio.start_server(
+            self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.sessions += 1
+        self.max_sessions = max(self.max_sessions, self.sessions)
+
+        def reply(line):
+            writer.write(line.encode() + b'\r\n')
+
+        try:
+            reply('220 localhost SMTP stub')
+            mail_from, rcpt_tos = None, []
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                command = line.decode().strip()
+                verb = command[:4].upper()
+                if verb == 'EHLO':
+                    reply('250-localhost')
+                    reply('250 8BITMIME')
+                elif verb == 'MAIL':
+                    mail_from, rcpt_tos = command[10:].strip('<>'), []
+                    reply('250 OK')
+                elif verb == 'RCPT':
+                    address = command[8:].strip('<>')
+                    if address in self.rejected:
+                        reply('550 No such user')
+                    else:
+                        rcpt_tos.append(address)
+                        reply('250 OK')
+                elif verb == 'DATA':
+                    reply('354 End data with <CR><LF>.<CR><LF>')
+                    lines = []
+                    while True:
+                        line = await reader.readline()
+                        if line == b'.\r\n':
+                            break
+                        lines.append(line[1:] if line[:1] == b'.' else line)
+                    await asyncio.sleep(self.delay)
+                    self.messages.append((mail_from, rcpt_tos, b''.join(lines)))
+                    mail_from, rcpt_tos = None, []
+                    reply('250 OK')
+                elif verb == 'RSET':
+                    mail_from, rcpt_tos = None, []
+                    reply('250 OK')
+                elif verb == 'QUIT':
+                    reply('221 Bye')
+                    return
+                else:
+                    reply('502 Command not implemented')
+        finally:
+            self.sessions -= 1
+            writer.close()
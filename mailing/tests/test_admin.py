@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from mailing.admin import EstimatedCountPaginator, MailAdmin
+from mailing.models import Mail, MailRecipient
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class MailAdminTestCase(TestCase):
+
+    def setUp(self):
+        self.mails = [
+            Mail.objects.create(subject="Mail {}".format(i), html_body="body")
+            for i in range(5)
+        ]
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        self.url = reverse('admin:mailing_mail_changelist')
+
+    def test_count_limit(self):
+        with mock.patch('mailing.admin.ADMIN_COUNT_LIMIT', 3):
+            paginator = EstimatedCountPaginator(Mail.objects.all(), 2)
+            self.assertEqual(paginator.count, 3)
+            paginator = EstimatedCountPaginator(
+                Mail.objects.filter(pk=self.mails[0].pk), 2)
+            self.assertEqual(paginator.count, 1)
+        with mock.patch('mailing.admin.ADMIN_COUNT_LIMIT', None):
+            paginator = EstimatedCountPaginator(Mail.objects.all(), 2)
+            self.assertEqual(paginator.count, 5)
+
+    @mock.patch('mailing.admin.ADMIN_COUNT_LIMIT', 3)
+    @mock.patch.object(MailAdmin, 'list_per_page', 1)
+    def test_pages_past_count_limit(self):
+        pks = [mail.pk for mail in self.mails]
+        for page in range(5):
+            response = self.client.get(self.url, {'p': page})
+            self.assertEqual(response.status_code, 200)
+            cl = response.context['cl']
+            self.assertEqual(cl.result_count, 3)
+            self.assertEqual(
+                [mail.pk for mail in cl.result_list], [pks[-page - 1]])
+        # Past the last mail.
+        response = self.client.get(self.url, {'p': 5})
+        self.assertRedirects(
+            response, self.url + '?e=1', fetch_redirect_response=False)
+
+    def test_changelist_defers_bodies(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        mail = response.context['cl'].result_list[0]
+        self.assertIn('html_body', mail.get_deferred_fields())
+
+    @mock.patch('mailing.admin.ADMIN_KEYSET_PAGINATION', True)
+    @mock.patch.object(MailAdmin, 'list_per_page', 2)
+    def test_keyset_pagination(self):
+        pages = []
+        url = self.url
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            cl = response.context['cl']
+            pages.append([mail.pk for mail in cl.result_list])
+            url = cl.next_page_url and self.url + cl.next_page_url
+        pks = [mail.pk for mail in reversed(self.mails)]
+        self.assertEqual(pages, [pks[0:2], pks[2:4], pks[4:]])
+        self.assertContains(response, "First page")
+
+    def change_data(self, mail, **kwargs):
+        data = {
+            'campaign': '', 'scheduled_on_0': '2020-01-01',
+            'scheduled_on_1': '12:00:00', 'status': mail.status,
+            'subject': mail.subject, 'html_body': mail.html_body,
+            'text_body': '',
+        }
+        for prefix in ['static_attachments', 'dynamic_attachments']:
+            data.update({
+                prefix + '-TOTAL_FORMS': '0', prefix + '-INITIAL_FORMS': '0',
+            })
+        data.update(kwargs)
+        return data
+
+    def test_edit_inline_headers(self):
+        mail = self.mails[0]
+        mail.inline_headers = {'To': 'john@example.com'}
+        mail.save()
+        url = reverse('admin:mailing_mail_change', args=[mail.pk])
+        response = self.client.get(url)
+        self.assertContains(response, 'To: john@example.com</textarea>')
+        response = self.client.post(url, self.change_data(
+            mail, headers_text="To: jane@example.com\r\nReply-To: me@x.org"))
+        self.assertEqual(response.status_code, 302)
+        mail.refresh_from_db()
+        self.assertEqual(mail.inline_headers, {
+            'To': 'jane@example.com', 'Reply-To': 'me@x.org'})
+        # The recipients index follows.
+        self.assertEqual(
+            list(mail.recipients.values_list('address', flat=True)),
+            ['jane@example.com'])
+        self.assertEqual(
+            list(Mail.objects.sent_to('jane@example.com')), [mail])
+        response = self.client.post(url, self.change_data(
+            mail, headers_text="Not a header"))
+        self.assertContains(response, "Invalid header line")
+
+        response = self.client.get(reverse('admin:mailing_mail_add'))
+        self.assertContains(response, 'name="headers_text"')
+
+        # Headers of mails already sent are read-only.
+        Mail.objects.filter(pk=mail.pk).update(status=Mail.STATUS_SENT)
+        response = self.client.get(url)
+        self.assertNotContains(response, 'name="headers_text"')
+        self.assertContains(response, 'jane@example.com')
+
+    def test_search_inline_headers(self):
+        mail = self.mails[0]
+        mail.inline_headers = {'To': '"Doe, John" <john@example.com>'}
+        mail.save()
+        for search in ['"Doe, John"', 'to:"Doe', '"Doe']:
+            response = self.client.get(self.url, {'q': search})
+            self.assertEqual(
+                list(response.context['cl'].result_list), [mail], search)
+
+    def test_search_address(self):
+        sent_to = self.mails[0]
+        sent_to.inline_headers = {'To': 'john@example.com'}
+        sent_to.save()
+        sent_to.recipients.create(
+            kind=MailRecipient.KIND_TO, address='john@example.com',
+            domain='example.com')
+        mentioned = self.mails[1]
+        mentioned.subject = "Mail for john@example.com"
+        mentioned.save()
+        for search in ['john@example.com', '@example.com']:
+            response = self.client.get(self.url, {'q': search})
+            self.assertCountEqual(
+                response.context['cl'].result_list, [sent_to, mentioned])
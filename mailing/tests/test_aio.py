@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from datetime import timedelta
+import threading
+import time
+from unittest import mock
+
+from django.core.management import call_command
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from mailing.aio import aqueue_mail, arender_mail, send_queued_mails_async
+from mailing.models import Campaign, Mail
+from mailing.utils import render_mail
+from mailing.signals import batch_finished, post_send
+from mailing.smtpsink import SMTPSink
+
+from . import create_mail
+from .smtp_server import AsyncSMTPServer
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class SendQueuedMailsAsyncTestCase(TransactionTestCase):
+
+    def connect(self, signal):
+        calls = []
+
+        def receiver(**kwargs):
+            calls.append(kwargs)
+
+        signal.connect(receiver)
+        self.addCleanup(signal.disconnect, receiver)
+        return calls
+
+    def send(self, server, **kwargs):
+        async def send():
+            host, port = await server.start()
+            try:
+                with self.settings(EMAIL_HOST=host, EMAIL_PORT=port):
+                    return await send_queued_mails_async(**kwargs)
+            finally:
+                await server.stop()
+        return asyncio.run(send())
+
+    def test_send(self):
+        mails = [create_mail() for i in range(10)]
+        later = create_mail(
+            scheduled_on=timezone.now() + timedelta(hours=1))
+        post_sends = self.connect(post_send)
+        batches = self.connect(batch_finished)
+        server = AsyncSMTPServer(delay=0.05)
+        self.assertEqual(self.send(server, sessions=3), (10, 0))
+        self.assertEqual(len(server.messages), 10)
+        self.assertEqual(server.max_sessions, 3)
+        mail_from, rcpt_tos, data = server.messages[0]
+        self.assertEqual(rcpt_tos, ['john@example.com'])
+        self.assertIn(b'Subject: Hello', data)
+        self.assertEqual(
+            Mail.objects.filter(status=Mail.STATUS_SENT).count(), 10)
+        later.refresh_from_db()
+        self.assertEqual(later.status, Mail.STATUS_PENDING)
+        self.assertCountEqual(
+            [call['mail_id'] for call in post_sends],
+            [mail.pk for mail in mails])
+        self.assertEqual(set(post_sends[0]['durations']), {'mime', 'smtp'})
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(
+            set(batches[0]['durations']), {'db', 'mime', 'smtp'})
+
+    def test_failures(self):
+        rejected = create_mail(to='nobody@example.com')
+        sent = create_mail()
+        campaign = Campaign.objects.create(
+            key='debug', name="Debug", subject="Debug", debug_mode=True)
+        skipped = create_mail(campaign=campaign)
+        server = AsyncSMTPServer(rejected=['nobody@example.com'])
+        with mock.patch('mailing.utils.DEBUG_EMAIL', None):
+            self.assertEqual(self.send(server, sessions=1), (1, 2))
+        # The session went on after the refused recipient.
+        self.assertEqual(len(server.messages), 1)
+        rejected.refresh_from_db()
+        self.assertEqual(rejected.status, Mail.STATUS_FAILURE)
+        self.assertIn('No such user', rejected.failure_reason)
+        sent.refresh_from_db()
+        self.assertEqual(sent.status, Mail.STATUS_SENT)
+        skipped.refresh_from_db()
+        self.assertEqual(skipped.status, Mail.STATUS_PENDING)
+
+    def test_connection_refused(self):
+        mail = create_mail()
+        server = AsyncSMTPServer()
+
+        async def send():
+            host, port = await server.start()
+            await server.stop()
+            with self.settings(EMAIL_HOST=host, EMAIL_PORT=port):
+                return await send_queued_mails_async()
+
+        self.assertEqual(asyncio.run(send()), (0, 1))
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, Mail.STATUS_FAILURE)
+
+    def test_worker_command(self):
+        create_mail()
+        create_mail()
+        sink = SMTPSink()
+        host, port = sink.start()
+        self.addCleanup(sink.stop)
+        with self.settings(EMAIL_HOST=host, EMAIL_PORT=port):
+            call_command(
+                'send_queued_mails_worker', '--async', '--smtp-sessions', '2',
+                '--max-mails', '1', '--interval', '0')
+        self.assertEqual(sink.nb_messages, 2)
+        self.assertFalse(
+            Mail.objects.filter(status=Mail.STATUS_PENDING).exists())
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class AsyncQueueMailTestCase(TransactionTestCase):
+
+    def test_aqueue_mail(self):
+        Campaign.objects.create(
+            key='welcome', name="Welcome", subject="Welcome {{ name }}")
+        mail = asyncio.run(aqueue_mail(
+            'welcome', {'name': "John"}, {'To': 'john@example.com'},
+            html_template="<p>Hi {{ name }}</p>"))
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, Mail.STATUS_PENDING)
+        self.assertEqual(mail.subject, "Welcome John")
+        self.assertEqual(mail.html_body, "<p>Hi John</p>")
+        self.assertEqual(mail.campaign.key, 'welcome')
+        # Unknown campaigns behave as with queue_mail.
+        with self.assertRaises(Campaign.DoesNotExist):
+            asyncio.run(aqueue_mail('unknown', fail_silently=False))
+
+    def test_close_old_connections(self):
+        closed = []
+
+        def close_if_unusable_or_obsolete(connection):
+            closed.append(threading.get_ident())
+
+        with mock.patch.object(
+                BaseDatabaseWrapper, 'close_if_unusable_or_obsolete',
+                close_if_unusable_or_obsolete):
+            asyncio.run(arender_mail(
+                "Hello", "<p>Hello</p>", {'To': 'john@example.com'}, {}))
+        # Before and after the call, in the thread running it.
+        self.assertEqual(len(closed), 2)
+        self.assertNotEqual(closed[0], threading.get_ident())
+
+    def test_arender_mail(self):
+        def slow_render_mail(*args, **kwargs):
+            time.sleep(0.2)
+            return render_mail(*args, **kwargs)
+
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def render():
+            ticker = asyncio.ensure_future(tick())
+            try:
+                return await arender_mail(
+                    "Hello {{ name }}", "<p>Hello</p>",
+                    {'To': 'john@example.com'}, {'name': "John"})
+            finally:
+                ticker.cancel()
+
+        with mock.patch('mailing.aio.render_mail', slow_render_mail):
+            mail = asyncio.run(render())
+        self.assertEqual(mail.subject, "Hello John")
+        self.assertTrue(Mail.objects.filter(pk=mail.pk).exists())
+        # The event loop kept running while the mail was rendered.
+        self.assertGreater(len(ticks), 5)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from io import StringIO
+import mailbox
+import os
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from mailing.models import (
+    Mail, MailArchive, MailArchiveHeader, MailHeader, MailRecipient,
+)
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class MailArchiveTestCase(TestCase):
+
+    def create_mail(self, status=Mail.STATUS_SENT, days_ago=40):
+        mail = Mail.objects.create(
+            subject="Test", html_body="<p>Test</p>", status=status,
+            scheduled_on=timezone.now() - timedelta(days=days_ago))
+        mail.headers.create(name='To', value='test@example.com')
+        mail.recipients.create(
+            kind=MailRecipient.KIND_TO, address='test@example.com', domain='example.com')
+        mail.static_attachments.create(attachment='test.txt')
+        return mail
+
+    def test_move_mails_to_archive(self):
+        sent = self.create_mail()
+        pending = self.create_mail(Mail.STATUS_PENDING)
+        recent = self.create_mail(days_ago=1)
+        call_command('move_mails_to_archive', '30', stdout=StringIO())
+        self.assertQuerysetEqual(
+            Mail.objects.order_by('pk'), [pending.pk, recent.pk],
+            transform=lambda m: m.pk)
+        self.assertFalse(MailHeader.objects.filter(mail_id=sent.pk).exists())
+        archived = MailArchive.objects.get()
+        self.assertEqual(archived.pk, sent.pk)
+        self.assertEqual(archived.html_body, sent.html_body)
+        self.assertEqual(archived.get_headers(), {
+            'To': 'test@example.com', 'X-Mail-Id': str(sent.pk)})
+        self.assertEqual(
+            [a.get_file_name() for a in archived.get_attachments()],
+            ['test.txt'])
+        self.assertEqual(
+            list(MailArchive.objects.sent_to('test@example.com')), [archived])
+
+    def test_mirror_falls_back_to_archive(self):
+        mail = self.create_mail()
+        url = mail.get_absolute_url()
+        MailArchive.objects.archive([mail.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.content, b"<p>Test</p>")
+
+    def test_admin_falls_back_to_archive(self):
+        mail = self.create_mail()
+        MailArchive.objects.archive([mail.pk])
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        response = self.client.get(
+            reverse('admin:mailing_mail_change', args=[mail.pk]))
+        self.assertRedirects(
+            response,
+            reverse('admin:mailing_mailarchive_change', args=[mail.pk]))
+        self.assertContains(
+            self.client.get(response.url), 'test@example.com')
+        # Invalid primary keys get the stock "doesn't exist" redirect.
+        response = self.client.get(
+            reverse('admin:mailing_mail_change', args=['abc']))
+        self.assertRedirects(response, reverse('admin:index'))
+
+    def test_admin_search_points_to_archive(self):
+        mail = self.create_mail()
+        other = self.create_mail()
+        MailArchive.objects.archive([mail.pk])
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        url = reverse('admin:mailing_mail_changelist')
+        response = self.client.get(url, {'q': 'test@example.com'})
+        self.assertEqual(list(response.context['cl'].result_list), [other])
+        self.assertContains(
+            response, '{}?q=test%40example.com'.format(
+                reverse('admin:mailing_mailarchive_changelist')))
+        response = self.client.get(url, {'q': 'nobody@example.com'})
+        self.assertNotContains(response, 'Archived mails also match')
+
+    def test_purge_and_export_archived_mails(self):
+        mail = self.create_mail()
+        MailArchive.objects.archive([mail.pk])
+        kept = self.create_mail()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        path = os.path.join(tmp_dir.name, 'mails.mbox')
+        call_command(
+            'archive_mails', '30', path, '--archived', '--format', 'mbox',
+            '--no-compress', stdout=StringIO())
+        messages = list(mailbox.mbox(path))
+        self.assertEqual([m['X-Mail-Id'] for m in messages], [str(mail.pk)])
+        self.assertEqual(messages[0]['To'], 'test@example.com')
+        call_command(
+            'purge_old_mails', '30', '--archived', stdout=StringIO())
+        self.assertFalse(MailArchive.objects.exists())
+        self.assertFalse(MailArchiveHeader.objects.exists())
+        self.assertQuerysetEqual(
+            Mail.objects.all(), [kept.pk], transform=lambda m: m.pk)
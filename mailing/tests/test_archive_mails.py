@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+import gzip
+from io import StringIO
+import json
+import mailbox
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from mailing.models import Mail
+
+
+class ArchiveMailsTestCase(TestCase):
+
+    def setUp(self):
+        self.mails = []
+        for i in range(3):
+            mail = Mail.objects.create(
+                subject="Test {}".format(i), html_body="<p>Test</p>",
+                status=Mail.STATUS_SENT,
+                scheduled_on=timezone.now() - timedelta(days=40))
+            mail.headers.create(name='To', value='test@example.com')
+            self.mails.append(mail)
+        self.recent = Mail.objects.create(
+            subject="Recent", html_body="<p>Test</p>",
+            status=Mail.STATUS_SENT)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def archive(self, *args):
+        call_command('archive_mails', *args, stdout=StringIO())
+
+    def test_jsonl(self):
+        path = os.path.join(self.tmp_dir, 'mails.jsonl.gz')
+        self.archive('30', path, '--batch-size', '2')
+        with gzip.open(path, 'rt') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(
+            [r['id'] for r in records], [m.pk for m in self.mails])
+        self.assertEqual(records[0]['headers'], [['To', 'test@example.com']])
+        self.assertEqual(Mail.objects.count(), 4)
+
+    def test_mbox_and_delete(self):
+        path = os.path.join(self.tmp_dir, 'mails.mbox')
+        self.archive('30', path, '--format', 'mbox', '--no-compress',
+                     '--delete')
+        messages = list(mailbox.mbox(path))
+        self.assertEqual(
+            [m['X-Mail-Id'] for m in messages],
+            [str(m.pk) for m in self.mails])
+        self.assertEqual(messages[0]['To'], 'test@example.com')
+        self.assertQuerysetEqual(
+            Mail.objects.all(), [self.recent.pk], transform=lambda m: m.pk)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from io import StringIO
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from mailing.models import Blacklist
+
+
+class ImportBlacklistTestCase(TestCase):
+
+    def setUp(self):
+        Blacklist.objects.create(
+            email='John@Example.com', reason=Blacklist.REASON_SPAM)
+
+    def test_import(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write(
+                "john@example.com\nJane <Jane@Example.com>\nnot an address\n"
+                "jane@example.com\nbob@example.com\n")
+        self.addCleanup(os.remove, f.name)
+        stdout = StringIO()
+        call_command(
+            'import_blacklist', f.name, '--reason', 'hardbounce',
+            '--batch-size', '2', stdout=stdout)
+        self.assertIn(
+            "2 addresses blacklisted, 2 already blacklisted", stdout.getvalue())
+        self.assertEqual(
+            sorted(Blacklist.objects.values_list('email', 'reason')), [
+                ('Jane@Example.com', Blacklist.REASON_HARDBOUNCE),
+                ('John@Example.com', Blacklist.REASON_SPAM),
+                ('bob@example.com', Blacklist.REASON_HARDBOUNCE),
+            ])
+        self.assertEqual(
+            Blacklist.objects.get(email='Jane@Example.com').normalized_email,
+            'jane@example.com')
+
+    def test_conflicts_are_not_counted(self):
+        # Conflicting on the e-mail address but not on its normalized form.
+        Blacklist.objects.create(email='bob@example.com')
+        Blacklist.objects.filter(email='bob@example.com').update(
+            normalized_email='')
+        self.assertEqual(
+            Blacklist.objects.bulk_blacklist(
+                ['bob@example.com', 'jane@example.com']), (1, 1))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from io import StringIO
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from mailing.models import Blacklist, Mail
+
+DSN = """\
+From MAILER-DAEMON Mon Jan  1 00:00:00 2018
+From: Mail Delivery System <MAILER-DAEMON@example.com>
+Subject: Undelivered Mail Returned to Sender
+MIME-Version: 1.0
+Content-Type: multipart/report; report-type=delivery-status;
+ boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+Your message could not be delivered.
+
+--BOUNDARY
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; mx.example.com
+
+Final-Recipient: rfc822; {recipient}
+Action: {action}
+Status: {status}
+Diagnostic-Code: smtp; {status} Something
+ went wrong
+
+--BOUNDARY
+Content-Type: text/rfc822-headers
+
+Subject: Test
+X-Mail-Id: {mail_id}
+
+--BOUNDARY--
+"""
+
+
+class ProcessBouncesTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.hard, self.soft = [
+            Mail.objects.create(
+                subject="Test", html_body="<p>Test</p>",
+                status=Mail.STATUS_SENT, scheduled_on=timezone.now())
+            for i in range(2)
+        ]
+        self.messages = [
+            DSN.format(recipient='John@Example.com', action='failed',
+                       status='5.1.1', mail_id=self.hard.pk),
+            DSN.format(recipient='jane@example.com', action='delayed',
+                       status='4.2.2', mail_id=self.soft.pk),
+            "From nobody Mon Jan  1 00:00:00 2018\nSubject: Not a DSN\n\nHi\n",
+        ]
+
+    def process(self, *args):
+        stdout = StringIO()
+        call_command('process_bounces', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def assertBouncesRecorded(self):
+        self.hard.refresh_from_db()
+        self.soft.refresh_from_db()
+        self.assertEqual(self.hard.status, Mail.STATUS_FAILURE)
+        self.assertEqual(self.hard.failure_reason, "Hard bounce (5.1.1)")
+        self.assertEqual(self.soft.status, Mail.STATUS_SENT)
+        self.assertEqual(self.soft.failure_reason, "Soft bounce (4.2.2)")
+        self.assertEqual(
+            list(Blacklist.objects.values_list(
+                'email', 'normalized_email', 'reason')),
+            [('John@Example.com', 'john@example.com',
+              Blacklist.REASON_HARDBOUNCE)])
+
+    def test_mbox(self):
+        path = os.path.join(self.tmpdir, 'bounces')
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.messages))
+        output = self.process(path, '--batch-size', '1')
+        self.assertIn(
+            "3 messages read, 1 hard bounces, 1 soft bounces, 1 addresses "
+            "blacklisted", output)
+        self.assertBouncesRecorded()
+
+    def test_maildir(self):
+        for subdir in ('new', 'cur', 'tmp'):
+            os.mkdir(os.path.join(self.tmpdir, subdir))
+        for i, message in enumerate(self.messages):
+            path = os.path.join(self.tmpdir, 'new', str(i))
+            with open(path, 'w') as f:
+                # Maildir messages have no "From " line.
+                f.write(message.split('\n', 1)[1])
+        self.process(self.tmpdir)
+        self.assertBouncesRecorded()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from io import StringIO
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from mailing.models import (
+    Blacklist, Campaign, Mail, MailRecipient, MailStaticAttachment,
+    Subscription,
+)
+
+
+class LoadgenTestCase(TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        patcher = mock.patch(
+            'mailing.management.commands.mailing_loadgen.ATTACHMENTS_DIR',
+            tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def loadgen(self):
+        call_command(
+            'mailing_loadgen', '--mails', '50', '--campaigns', '4',
+            '--recipients', '100', '--blacklist', '10',
+            '--subscriptions', '20', '--batch-size', '15', '--seed', '42',
+            stdout=StringIO())
+        return list(Mail.objects.order_by('pk').values_list(
+            'campaign__key', 'inline_headers'))
+
+    def test_loadgen(self):
+        mails = self.loadgen()
+        self.assertEqual(len(mails), 50)
+        self.assertEqual(Campaign.objects.count(), 4)
+        self.assertEqual(
+            set(Mail.objects.values_list('status', flat=True)),
+            {Mail.STATUS_PENDING})
+        self.assertEqual(MailRecipient.objects.count(), 50)
+        self.assertEqual(
+            MailStaticAttachment.objects.count(),
+            Mail.objects.filter(
+                campaign__key__in=['loadgen-0', 'loadgen-2']).count())
+        self.assertTrue(1 <= Blacklist.objects.count() <= 10)
+        self.assertTrue(1 <= Subscription.objects.count() <= 20)
+
+        # The same seed generates the same mails.
+        Mail.objects.all().delete()
+        self.assertEqual(self.loadgen(), mails)
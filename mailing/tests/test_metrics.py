@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from mailing import metrics
+from mailing.models import Campaign, Mail
+from mailing.signals import post_render, post_send, batch_finished
+from mailing.utils import queue_mail, send_queued_mails
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+@mock.patch('mailing.views.METRICS_ENABLED', True)
+class MetricsViewTestCase(TestCase):
+
+    def setUp(self):
+        metrics._local_values.clear()
+        self.addCleanup(metrics._local_values.clear)
+        metrics.connect_receivers()
+        for signal in (post_render, post_send, batch_finished):
+            self.addCleanup(
+                signal.disconnect, sender=Mail, dispatch_uid='mailing.metrics')
+        self.url = reverse('mailing:metrics')
+
+    def test_queue(self):
+        campaign = Campaign.objects.create(key='newsletter', name="Newsletter")
+        now = timezone.now()
+        for days_ago in (2, 1, -1):
+            Mail.objects.create(
+                campaign=campaign, status=Mail.STATUS_PENDING,
+                scheduled_on=now - timedelta(days=days_ago))
+        Mail.objects.create(status=Mail.STATUS_PENDING, scheduled_on=now)
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        lines = response.content.decode().splitlines()
+        self.assertIn('mailing_pending_mails{campaign="newsletter"} 3', lines)
+        self.assertIn('mailing_pending_mails{campaign=""} 1', lines)
+        age = next(
+            line for line in lines if line.startswith(
+                'mailing_oldest_pending_mail_age_seconds{campaign="newsletter"}'))
+        self.assertAlmostEqual(
+            float(age.split()[-1]), 2 * 24 * 3600, delta=60)
+
+    def test_counters_and_histograms(self):
+        queue_mail(
+            None, {}, {'To': 'test@example.com'}, subject="Hello",
+            html_template="<p>Hello</p>")
+        send_queued_mails()
+        lines = self.client.get(self.url).content.decode().splitlines()
+        self.assertIn('mailing_send_cycles_total 1', lines)
+        self.assertIn('mailing_sent_mails_total 1', lines)
+        self.assertIn('mailing_failed_mails_total 0', lines)
+        self.assertIn('mailing_render_duration_seconds_count 1', lines)
+        self.assertIn('mailing_smtp_duration_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('mailing_smtp_duration_seconds_bucket{le="10.0"} 1', lines)
+
+    @mock.patch('mailing.metrics.METRICS_CACHE', 'default')
+    def test_cache(self):
+        self.addCleanup(metrics.caches['default'].clear)
+        send_queued_mails()
+        send_queued_mails()
+        self.assertFalse(metrics._local_values)
+        lines = self.client.get(self.url).content.decode().splitlines()
+        self.assertIn('mailing_send_cycles_total 2', lines)
+
+    def test_disabled(self):
+        with mock.patch('mailing.views.METRICS_ENABLED', False):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
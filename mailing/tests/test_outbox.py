@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import datetime
+import decimal
+from io import BytesIO, StringIO
+import os
+import tempfile
+from unittest import mock
+import uuid
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+from mailing.models import Campaign, Mail, OutboxMail
+from mailing.outbox import ValueDecoder, encode_value, process_outbox
+from mailing.utils import queue_mail
+
+
+class EncodeValueTestCase(TestCase):
+
+    def test_round_trip(self):
+        campaign = Campaign.objects.create(
+            key='welcome', name="Welcome", subject="Welcome")
+        now = timezone.now()
+        value = {
+            'campaign': campaign,
+            'items': [1, "two", (3.5, None, True)],
+            'now': now,
+            'today': now.date(),
+            'time': now.time(),
+            'price': decimal.Decimal('12.30'),
+            'id': uuid.UUID(int=42),
+            'label': _("Hello"),
+        }
+        encoded = encode_value(value)
+        self.assertEqual(encoded['campaign'], {
+            '__type__': 'model', 'model': 'mailing.campaign',
+            'pk': campaign.pk,
+        })
+        with self.assertNumQueries(1):
+            decoder = ValueDecoder([encoded, encoded])
+        self.assertEqual(decoder.decode(encoded), dict(
+            value, items=[1, "two", [3.5, None, True]], label="Hello"))
+
+    def test_unsupported_values(self):
+        with self.assertRaises(TypeError):
+            encode_value({'object': object()})
+        with self.assertRaises(TypeError):
+            encode_value(Campaign(key='unsaved'))
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class OutboxTestCase(TestCase):
+
+    def setUp(self):
+        self.campaign = Campaign.objects.create(
+            key='welcome', name="Welcome", subject="Welcome {{ user.name }}")
+
+    def queue_mail(self, context, **kwargs):
+        return queue_mail(
+            'welcome', context, {'To': 'john@example.com'},
+            html_template="<p>Hi {{ user.name }}</p>", **kwargs)
+
+    def test_queue_mail(self):
+        scheduled_on = timezone.now() + datetime.timedelta(hours=1)
+        with self.assertNumQueries(1):
+            record = self.queue_mail(
+                {'user': self.campaign}, outbox=True,
+                scheduled_on=scheduled_on)
+        self.assertIsInstance(record, OutboxMail)
+        self.assertFalse(Mail.objects.exists())
+
+        self.assertEqual(process_outbox(), (1, 0))
+        self.assertFalse(OutboxMail.objects.exists())
+        mail = Mail.objects.get()
+        self.assertEqual(mail.status, Mail.STATUS_PENDING)
+        self.assertEqual(mail.campaign, self.campaign)
+        self.assertEqual(mail.subject, "Welcome Welcome")
+        self.assertEqual(mail.html_body, "<p>Hi Welcome</p>")
+        self.assertEqual(mail.scheduled_on, scheduled_on)
+        self.assertEqual(process_outbox(), (0, 0))
+
+    def test_dynamic_attachments(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        with self.settings(MEDIA_ROOT=media_root.name):
+            self.queue_mail({}, outbox=True, dynamic_attachments=[
+                {'attachment': ContentFile(b'%PDF\x00', name='invoice.pdf'),
+                 'filename': 'invoice.pdf', 'mime_type': 'application/pdf'},
+                {'attachment': "Plain text", 'filename': 'notes.txt'},
+                BytesIO(b'raw'),
+            ])
+            # Nothing is written until the mail is rendered.
+            self.assertEqual(os.listdir(media_root.name), [])
+            self.assertEqual(process_outbox(), (1, 0))
+            mail = Mail.objects.get()
+            contents = []
+            for attachment in mail.dynamic_attachments.order_by('pk'):
+                with attachment.attachment.open('rb') as f:
+                    contents.append(f.read())
+        self.assertEqual(contents, [b'%PDF\x00', b'Plain text', b'raw'])
+        self.assertEqual(
+            mail.dynamic_attachments.order_by('pk')[0].mime_type,
+            'application/pdf')
+
+    def test_setting(self):
+        with mock.patch('mailing.utils.OUTBOX_ENABLED', True):
+            self.assertIsInstance(self.queue_mail({}), OutboxMail)
+            self.assertIsInstance(
+                self.queue_mail({}, outbox=False), Mail)
+
+    def test_failures(self):
+        deleted = Campaign.objects.create(
+            key='deleted', name="Deleted", subject="Deleted")
+        missing_object = self.queue_mail({'user': deleted}, outbox=True)
+        deleted.delete()
+        # Kept even though campaigns which do not exist are skipped silently
+        # by default.
+        missing_campaign = queue_mail(
+            'unknown', {}, {'To': 'john@example.com'}, outbox=True)
+        queued = self.queue_mail({}, outbox=True)
+
+        with self.assertLogs('mailing.outbox', 'ERROR'):
+            self.assertEqual(process_outbox(), (3, 2))
+        # Failed mails are kept, without any mail being created.
+        self.assertEqual(Mail.objects.count(), 1)
+        self.assertFalse(OutboxMail.objects.filter(pk=queued.pk).exists())
+        missing_object.refresh_from_db()
+        self.assertEqual(missing_object.status, OutboxMail.STATUS_FAILURE)
+        self.assertIn("no longer exists", missing_object.failure_reason)
+        missing_campaign.refresh_from_db()
+        self.assertEqual(missing_campaign.status, OutboxMail.STATUS_FAILURE)
+        self.assertEqual(process_outbox(), (0, 0))
+
+    def test_limit(self):
+        for i in range(3):
+            self.queue_mail({}, outbox=True)
+        self.assertEqual(process_outbox(2), (2, 0))
+        self.assertEqual(OutboxMail.objects.count(), 1)
+
+    def test_partition(self):
+        records = [self.queue_mail({}, outbox=True) for i in range(5)]
+        even = [record.pk for record in records if record.pk % 2 == 0]
+        self.assertEqual(
+            process_outbox(partition=(1, 2)), (5 - len(even), 0))
+        self.assertQuerysetEqual(
+            OutboxMail.objects.all(), even,
+            transform=lambda record: record.pk)
+        self.assertEqual(process_outbox(partition=(0, 2)), (len(even), 0))
+
+    def test_command(self):
+        for i in range(3):
+            self.queue_mail({}, outbox=True)
+        stdout = StringIO()
+        call_command('process_outbox', batch_size=2, stdout=stdout)
+        self.assertEqual(
+            stdout.getvalue().strip(), "3 mails processed, 0 failures")
+        self.assertEqual(Mail.objects.count(), 3)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from unittest import mock
+
+from django.core import mail as django_mail
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from mailing.models import Campaign, Mail
+from mailing.pipeline import SendPipeline
+from mailing.queues import BaseQueue, DatabaseQueue
+from mailing.signals import batch_finished, post_send
+from mailing.utils import _build_message
+
+from . import create_mail
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class SendPipelineTestCase(TransactionTestCase):
+
+    def connect(self, signal):
+        calls = []
+
+        def receiver(**kwargs):
+            calls.append(kwargs)
+
+        signal.connect(receiver)
+        self.addCleanup(signal.disconnect, receiver)
+        return calls
+
+    def test_send(self):
+        mails = [create_mail() for i in range(25)]
+        later = create_mail()
+        later.scheduled_on = timezone.now() + timedelta(hours=1)
+        later.save()
+        post_sends = self.connect(post_send)
+        batches = self.connect(batch_finished)
+        # Fetch more mails than the queues hold, so that the pipeline claims
+        # mails still in flight.
+        pipeline = SendPipeline(
+            builders=2, senders=3, writers=2, queue_size=2, fetch_size=7,
+            write_size=4)
+        with self.assertLogs('mailing.pipeline', 'INFO'):
+            self.assertEqual(pipeline.run(), (25, 0))
+        # Each mail was sent exactly once.
+        self.assertEqual(len(django_mail.outbox), 25)
+        self.assertCountEqual(
+            [call['mail_id'] for call in post_sends],
+            [mail.pk for mail in mails])
+        self.assertEqual(
+            Mail.objects.filter(status=Mail.STATUS_SENT).count(), 25)
+        later.refresh_from_db()
+        self.assertEqual(later.status, Mail.STATUS_PENDING)
+
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0]['nb_successes'], 25)
+        self.assertEqual(
+            set(batches[0]['durations']), {'db', 'mime', 'smtp'})
+        self.assertEqual(
+            list(pipeline.stats), ['fetch', 'build', 'send', 'write'])
+        for name, stats in pipeline.stats.items():
+            self.assertEqual(stats['items'], 25)
+            self.assertGreater(stats['items_per_sec'], 0)
+            self.assertLessEqual(stats['max_queue'], 2)
+        self.assertEqual(pipeline.stats['send']['concurrency'], 3)
+
+    def test_failures(self):
+        failing = create_mail()
+        sent = create_mail()
+        campaign = Campaign.objects.create(
+            key='debug', name="Debug", subject="Debug", debug_mode=True)
+        skipped = create_mail(campaign=campaign)
+        post_sends = self.connect(post_send)
+
+        def build_message(mail):
+            if mail.pk == failing.pk:
+                raise ValueError("Broken")
+            return _build_message(mail)
+
+        with mock.patch('mailing.pipeline._build_message', build_message), \
+                mock.patch('mailing.utils.DEBUG_EMAIL', None):
+            self.assertEqual(SendPipeline().run(), (1, 2))
+        self.assertEqual(len(django_mail.outbox), 1)
+        failing.refresh_from_db()
+        self.assertEqual(failing.status, Mail.STATUS_FAILURE)
+        self.assertEqual(failing.failure_reason, "Broken")
+        sent.refresh_from_db()
+        self.assertEqual(sent.status, Mail.STATUS_SENT)
+        # Skipped mails stay pending, without being fetched again.
+        skipped.refresh_from_db()
+        self.assertEqual(skipped.status, Mail.STATUS_PENDING)
+        exceptions = {
+            call['mail_id']: call['exception'] for call in post_sends}
+        self.assertIsInstance(exceptions[failing.pk], ValueError)
+        self.assertIsNone(exceptions[skipped.pk])
+
+    def test_skipped_mails_ahead(self):
+        campaign = Campaign.objects.create(
+            key='debug', name="Debug", subject="Debug", debug_mode=True)
+        for i in range(3):
+            create_mail(campaign=campaign)
+        mail = create_mail()
+        with mock.patch('mailing.utils.DEBUG_EMAIL', None):
+            self.assertEqual(SendPipeline(fetch_size=2).run(), (1, 3))
+            # Even if the queue does not defer mails given back.
+            Mail.objects.update(
+                status=Mail.STATUS_PENDING,
+                scheduled_on=timezone.now() - timedelta(minutes=1))
+            with mock.patch.object(DatabaseQueue, 'nack', BaseQueue.nack):
+                self.assertEqual(SendPipeline(fetch_size=2).run(), (1, 3))
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, Mail.STATUS_SENT)
+
+    def test_send_failure(self):
+        mail = create_mail()
+        with mock.patch(
+                'django.core.mail.backends.locmem.EmailBackend.send_messages',
+                side_effect=OSError("Connection refused")):
+            self.assertEqual(SendPipeline().run(), (0, 1))
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, Mail.STATUS_FAILURE)
+        self.assertEqual(mail.failure_reason, "Connection refused")
+
+    def test_nothing_to_send(self):
+        batches = self.connect(batch_finished)
+        pipeline = SendPipeline()
+        self.assertEqual(pipeline.run(), (0, 0))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(pipeline.stats['fetch']['items'], 0)
+
+    def test_invalid_concurrency(self):
+        with self.assertRaises(ValueError):
+            SendPipeline(senders=0)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+import signal
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from mailing.prefork import Supervisor
+
+
+class SupervisorTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.log_path = os.path.join(self.directory, 'log')
+
+    def log(self, message):
+        with open(self.log_path, 'a') as f:
+            f.write(message + '\n')
+
+    def read_log(self):
+        try:
+            with open(self.log_path) as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def worker(self, index, count, stop_event):
+        self.log('start {}/{}'.format(index, count))
+        marker = os.path.join(self.directory, str(index))
+        if not os.path.exists(marker):
+            open(marker, 'w').close()
+            if index == 0:
+                # Recycled.
+                return
+            raise ValueError("Crashed")
+        stop_event.wait(30)
+        self.log('stop {}'.format(index))
+
+    def terminate_when_started(self):
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            starts = [
+                line for line in self.read_log() if line.startswith('start')]
+            if len(starts) >= 4:
+                break
+            time.sleep(0.05)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def test_supervisor(self):
+        handler = signal.getsignal(signal.SIGTERM)
+        thread = threading.Thread(target=self.terminate_when_started)
+        thread.start()
+        with self.assertLogs('mailing.daemon', 'INFO') as logs:
+            Supervisor(self.worker, 2, restart_delay=0).run()
+        thread.join()
+        self.assertEqual(signal.getsignal(signal.SIGTERM), handler)
+        log = self.read_log()
+        # Both workers were restarted once, then stopped gracefully.
+        self.assertCountEqual(log, [
+            'start 0/2', 'start 1/2', 'start 0/2', 'start 1/2',
+            'stop 0', 'stop 1',
+        ])
+        self.assertEqual(
+            len([line for line in logs.output if 'crashed' in line]), 1)
+
+    def test_signal_while_spawning(self):
+        supervisor_pid = os.getpid()
+        pthread_sigmask = signal.pthread_sigmask
+
+        def sigmask(how, signals):
+            if how == signal.SIG_UNBLOCK and os.getpid() == supervisor_pid:
+                # SIGTERM received while the worker was being forked.
+                os.kill(supervisor_pid, signal.SIGTERM)
+            return pthread_sigmask(how, signals)
+
+        def worker(index, count, stop_event):
+            self.log('stopped' if stop_event.wait(10) else 'timeout')
+
+        started = time.monotonic()
+        with mock.patch('signal.pthread_sigmask', sigmask), \
+                self.assertLogs('mailing.daemon', 'INFO'):
+            Supervisor(worker, 1).run()
+        self.assertEqual(self.read_log(), ['stopped'])
+        self.assertLess(time.monotonic() - started, 5)
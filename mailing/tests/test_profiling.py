@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import os
+import pstats
+import tempfile
+
+from django.test import SimpleTestCase
+
+from mailing.profiling import BatchProfiler
+
+
+def batch(value):
+    return sum(range(value))
+
+
+class BatchProfilerTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_profile(self):
+        profiler = BatchProfiler(self.directory, every=2, keep=2, top=5)
+        with self.assertLogs('mailing.profiling', 'INFO') as logs:
+            for i in range(7):
+                self.assertEqual(profiler.run(batch, 10), 45)
+        # Batches 2, 4 and 6 were profiled, the oldest file was removed.
+        self.assertEqual(len(logs.records), 3)
+        self.assertIn('batch', logs.output[0])
+        files = sorted(os.listdir(self.directory))
+        self.assertEqual(len(files), 2)
+        self.assertTrue(files[0].endswith('-000004.prof'))
+        self.assertTrue(files[1].endswith('-000006.prof'))
+        stats = pstats.Stats(os.path.join(self.directory, files[1]))
+        self.assertIn(
+            'batch', [name for _, _, name in stats.stats])
+
+    def test_exception(self):
+        profiler = BatchProfiler(self.directory, top=0)
+        with self.assertRaises(TypeError):
+            profiler.run(batch, None)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
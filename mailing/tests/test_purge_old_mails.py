@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from mailing.models import Mail, MailHeader
+
+
+class PurgeOldMailsTestCase(TestCase):
+
+    def create_mail(self, days_ago, status=Mail.STATUS_SENT):
+        mail = Mail.objects.create(
+            subject="Test", html_body="<p>Test</p>", status=status,
+            scheduled_on=timezone.now() - timedelta(days=days_ago))
+        mail.headers.create(name='To', value='test@example.com')
+        return mail
+
+    def purge(self, *args):
+        call_command('purge_old_mails', *args, stdout=StringIO())
+
+    def test_purge_in_batches(self):
+        old = [self.create_mail(40) for i in range(5)]
+        recent = self.create_mail(10)
+        self.purge('30', '--batch-size', '2')
+        self.assertQuerysetEqual(
+            Mail.objects.all(), [recent.pk], transform=lambda m: m.pk)
+        self.assertFalse(
+            MailHeader.objects.filter(mail_id__in=[m.pk for m in old]).exists())
+        self.assertEqual(recent.headers.count(), 1)
+
+    def test_only_statuses(self):
+        sent = self.create_mail(40)
+        failed = self.create_mail(40, Mail.STATUS_FAILURE)
+        self.purge('30', '--only-statuses', 'FAILURE')
+        self.assertTrue(Mail.objects.filter(pk=sent.pk).exists())
+        self.assertFalse(Mail.objects.filter(pk=failed.pk).exists())
+
+    def test_exclude_statuses(self):
+        sent = self.create_mail(40)
+        pending = self.create_mail(40, Mail.STATUS_PENDING)
+        self.purge('30', '--exclude-statuses', str(Mail.STATUS_PENDING))
+        self.assertFalse(Mail.objects.filter(pk=sent.pk).exists())
+        self.assertTrue(Mail.objects.filter(pk=pending.pk).exists())
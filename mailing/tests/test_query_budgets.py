@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""Upper bounds on the number of queries of the hot paths.
+
+Each path is measured with few and many recipients, headers, mails or rows:
+the number of queries must stay within the budget and must not grow with
+them. Raise a budget only along with the reason for the new query.
+"""
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from mailing.models import (
+    Blacklist, Campaign, CampaignStaticAttachment, Mail, MailArchive,
+    MailHeader, OutboxMail, Subscription, SubscriptionType,
+)
+from mailing.utils import (
+    get_subscriptions_management_url, queue_mail, send_queued_mails,
+)
+
+
+class QueryBudgetMixin:
+
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        with CaptureQueriesContext(connection) as queries:
+            yield queries
+        self.assertLessEqual(
+            len(queries), budget, "{} queries over a budget of {}:\n{}".format(
+                len(queries), budget,
+                '\n'.join(query['sql'] for query in queries)))
+
+    def assertQueryBudgetConstant(self, budget, func, sizes, prepare=None):
+        """Call `func(size)` for every given size, after `prepare(size)` if
+        given, and check that every call runs the same number of queries,
+        within `budget`."""
+        counts = []
+        for size in sizes:
+            if prepare is not None:
+                prepare(size)
+            with self.assertQueryBudget(budget) as queries:
+                func(size)
+            counts.append(len(queries))
+        self.assertEqual(
+            len(set(counts)), 1,
+            "Queries grow with size: {}".format(dict(zip(sizes, counts))))
+
+
+def get_recipients(prefix, count):
+    return ', '.join(
+        'Recipient {0} <{1}{0}@example.com>'.format(i, prefix)
+        for i in range(count))
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class QueueMailBudgetTestCase(QueryBudgetMixin, TestCase):
+
+    def setUp(self):
+        subscription_type = SubscriptionType.objects.create(
+            name="Offers", description="Weekly offers")
+        self.campaign = Campaign.objects.create(
+            key='offers', name="Offers", subject="Offers",
+            subscription_type=subscription_type)
+        CampaignStaticAttachment.objects.create(
+            campaign=self.campaign, attachment='offer.pdf',
+            filename='offer.pdf', mime_type='application/pdf')
+        Subscription.objects.bulk_set_subscribed(
+            ('to{}@example.com'.format(i) for i in range(0, 20, 2)),
+            [subscription_type.pk], subscribed=True)
+        Blacklist.objects.bulk_blacklist(
+            ['to3@example.com', 'cc3@example.com'],
+            reason=Blacklist.REASON_HARDBOUNCE)
+
+    def get_headers(self, size):
+        headers = {
+            'To': get_recipients('to', size),
+            'Cc': get_recipients('cc', size),
+        }
+        headers.update(
+            ('X-Extra-{}'.format(i), '{{ first_name }}') for i in range(size))
+        return headers
+
+    def test_without_campaign(self):
+        # SAVEPOINT, INSERT mail, SELECT blacklist, UPDATE mail, INSERT
+        # recipients, RELEASE SAVEPOINT, UPDATE status.
+        def queue(size):
+            mail = queue_mail(
+                None, {'first_name': "John"}, self.get_headers(size),
+                subject="Hello {{ first_name }}",
+                html_template="<p>Hello {{ first_name }}</p>")
+            self.assertIsNotNone(mail)
+        self.assertQueryBudgetConstant(7, queue, [1, 10])
+
+    def test_with_campaign(self):
+        # The above, plus SELECT campaign with its subscription type, SELECT
+        # extra headers, SELECT static attachments, SELECT subscriptions and
+        # INSERT attachments.
+        def add_campaign_headers(size):
+            self.campaign.extra_headers.all().delete()
+            for i in range(size):
+                self.campaign.extra_headers.create(
+                    name='X-Campaign-{}'.format(i), value='value')
+
+        def queue(size):
+            mail = queue_mail(
+                'offers', {'first_name': "John"}, self.get_headers(size),
+                html_template="<p>Hello {{ first_name }}</p>")
+            self.assertIsNotNone(mail)
+        self.assertQueryBudgetConstant(
+            12, queue, [1, 10], prepare=add_campaign_headers)
+
+
+class SendQueuedMailsBudgetTestCase(QueryBudgetMixin, TestCase):
+
+    def create_mails(self, count):
+        campaign = Campaign.objects.create(
+            key='offers-{}'.format(count), name="Offers", subject="Offers")
+        scheduled_on = timezone.now() - timedelta(minutes=1)
+        for i in range(count):
+            mail = Mail.objects.create(
+                campaign=campaign if i % 2 else None,
+                subject="Mail {}".format(i), html_body="<p>Hello</p>",
+                status=Mail.STATUS_PENDING, scheduled_on=scheduled_on,
+                inline_headers={
+                    'To': get_recipients('to', 3),
+                    'Cc': get_recipients('cc', 3),
+                } if i % 3 else None)
+            if mail.inline_headers is None:
+                # Mails storing their headers in rows.
+                MailHeader.objects.bulk_create([
+                    MailHeader(mail=mail, name='To', value='to@example.com'),
+                    MailHeader(mail=mail, name='Reply-To',
+                               value='reply@example.com'),
+                ])
+            if i == 1:
+                # A mail failing to be sent.
+                mail.static_attachments.create(
+                    attachment='missing.pdf', filename='missing.pdf')
+
+    def test_send_queued_mails(self):
+        # SELECT mails with their campaigns, SELECT headers, static and
+        # dynamic attachments, UPDATE successes, UPDATE failures.
+        def send(count):
+            nb_successes, nb_failures = send_queued_mails()
+            self.assertEqual(nb_failures, 1)
+            self.assertEqual(nb_successes, count - 1)
+        self.assertQueryBudgetConstant(
+            6, send, [3, 20], prepare=self.create_mails)
+
+    def test_nothing_to_send(self):
+        with self.assertQueryBudget(1):
+            send_queued_mails()
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class ViewsBudgetTestCase(QueryBudgetMixin, TestCase):
+
+    def test_mirror(self):
+        mail = Mail.objects.create(
+            subject="Mail", html_body="<p>Hello</p>",
+            status=Mail.STATUS_SENT, sent_on=timezone.now())
+        with self.assertQueryBudget(1):
+            response = self.client.get(mail.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+
+    def test_archived_mirror(self):
+        mail = Mail.objects.create(subject="Mail", html_body="<p>Hello</p>")
+        MailArchive.objects.archive([mail.pk])
+        with self.assertQueryBudget(2):
+            response = self.client.get(mail.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+
+    def test_subscriptions_management(self):
+        url = get_subscriptions_management_url('john@example.com')
+
+        def manage(size):
+            subscription_types = [
+                SubscriptionType.objects.create(
+                    name="Type {}-{}".format(size, i), description="Type")
+                for i in range(size)
+            ]
+            Subscription.objects.create(
+                email='john@example.com',
+                subscription_type=subscription_types[0])
+            # SELECT subscriptions, SELECT subscription types.
+            with self.assertQueryBudget(2):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            # SELECT subscriptions, SAVEPOINT, SELECT subscription types,
+            # INSERT and UPDATE subscriptions, RELEASE SAVEPOINT. Subscription
+            # types are cached, and only checked before creating
+            # subscriptions.
+            with self.assertQueryBudget(6):
+                response = self.client.post(url, {
+                    'subscribed_{}'.format(subscription_type.pk): i % 2
+                    for i, subscription_type in enumerate(subscription_types)
+                })
+            self.assertEqual(response.status_code, 302)
+            SubscriptionType.objects.clear_cache()
+
+        manage(1)
+        manage(10)
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class AdminChangelistBudgetTestCase(QueryBudgetMixin, TestCase):
+
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+
+    def create_rows(self, count):
+        subscription_type = SubscriptionType.objects.create(
+            name="Type {}".format(count), description="Type")
+        campaign = Campaign.objects.create(
+            key='campaign-{}'.format(count), name="Campaign",
+            subject="Subject", subscription_type=subscription_type)
+        mails = [
+            Mail.objects.create(
+                campaign=campaign, subject="Mail", html_body="<p>Hello</p>")
+            for i in range(count)
+        ]
+        MailArchive.objects.archive([mail.pk for mail in mails[::2]])
+        Subscription.objects.bulk_set_subscribed(
+            ('{}-{}@example.com'.format(count, i) for i in range(count)),
+            [subscription_type.pk], subscribed=True)
+        Blacklist.objects.bulk_blacklist(
+            '{}-{}@example.com'.format(count, i) for i in range(count))
+        OutboxMail.objects.bulk_create([
+            OutboxMail(campaign_key=campaign.key, context={})
+            for i in range(count)
+        ])
+
+    def test_changelists(self):
+        # Session, user, counts and rows, choices of the related filters.
+        budgets = {
+            'mail': 7,
+            'mailarchive': 7,
+            'campaign': 6,
+            'subscription': 6,
+            'subscriptiontype': 5,
+            'blacklist': 5,
+            'outboxmail': 5,
+        }
+        counts = {}
+        for size in [1, 10]:
+            self.create_rows(size)
+            for model, budget in budgets.items():
+                url = reverse('admin:mailing_{}_changelist'.format(model))
+                with self.assertQueryBudget(budget) as queries:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                counts.setdefault(model, set()).add(len(queries))
+        for model, model_counts in counts.items():
+            self.assertEqual(len(model_counts), 1, model)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from io import StringIO
+import time
+from unittest import mock
+
+from django.core import mail as django_mail
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from mailing.models import Campaign, Mail
+from mailing.queues import (
+    DatabaseQueue, MemoryQueue, RedisConnection, RedisQueue, get_queue,
+)
+from mailing.utils import queue_mail, send_queued_mails
+
+from . import create_mail
+from .redis_server import RedisServer
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class MemoryQueueTestCase(TransactionTestCase):
+
+    def setUp(self):
+        patcher = mock.patch(
+            'mailing.queues.QUEUE_BACKEND', 'mailing.queues.MemoryQueue')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        get_queue().clear()
+
+    def queue_mail(self, **kwargs):
+        return queue_mail(
+            None, {}, {'To': 'john@example.com'}, subject="Hello",
+            html_template="<p>Hello</p>", **kwargs)
+
+    def test_send(self):
+        queue = get_queue()
+        self.assertIsInstance(queue, MemoryQueue)
+        mail = self.queue_mail()
+        later = self.queue_mail(
+            scheduled_on=timezone.now() + timedelta(hours=1))
+        self.assertEqual(len(queue), 2)
+        # Pending mails which were not queued are ignored.
+        create_mail()
+        self.assertEqual(send_queued_mails(), (1, 0))
+        self.assertEqual(len(django_mail.outbox), 1)
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, Mail.STATUS_SENT)
+        self.assertEqual(len(queue), 1)
+        later.refresh_from_db()
+        self.assertEqual(later.status, Mail.STATUS_PENDING)
+
+    def test_enqueue_on_commit(self):
+        queue = get_queue()
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.queue_mail()
+                raise ValueError
+        self.assertEqual(len(queue), 0)
+        with transaction.atomic():
+            self.queue_mail()
+            self.assertEqual(len(queue), 0)
+        self.assertEqual(len(queue), 1)
+
+    def test_failure_and_retry(self):
+        queue = get_queue()
+        mails = [create_mail(), create_mail()]
+        queue.push([(mail.pk, time.time()) for mail in mails])
+        claimed = queue.claim()
+        self.assertEqual(claimed, mails)
+        claimed[0].failure_reason = "Refused"
+        queue.nack(claimed[:1])
+        queue.nack(claimed[1:], retry=True)
+        mails[0].refresh_from_db()
+        self.assertEqual(mails[0].status, Mail.STATUS_FAILURE)
+        self.assertEqual(mails[0].failure_reason, "Refused")
+        # Retried after retry_delay.
+        self.assertEqual(queue.claim(), [])
+        self.assertEqual(len(queue), 1)
+
+    def test_enqueue_pending_mails(self):
+        create_mail()
+        create_mail(status=Mail.STATUS_SENT)
+        stdout = StringIO()
+        call_command('enqueue_pending_mails', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "1 mails pushed\n")
+        self.assertEqual(len(get_queue()), 1)
+
+
+class DatabaseQueueTestCase(TestCase):
+
+    def test_claim(self):
+        queue = DatabaseQueue()
+        mails = [create_mail(), create_mail()]
+        create_mail(scheduled_on=timezone.now() + timedelta(hours=1))
+        create_mail(status=Mail.STATUS_SENT)
+        self.assertCountEqual(queue.claim(), mails)
+        self.assertEqual(queue.claim(limit=1), mails[:1])
+        queue.ack(mails[:1], timezone.now())
+        queue.nack(mails[1:], retry=True)
+        # Mails given back are deferred.
+        self.assertEqual(queue.claim(), [])
+        DatabaseQueue(retry_delay=0).nack(mails[1:], retry=True)
+        self.assertEqual(queue.claim(), mails[1:])
+
+    def test_retry_does_not_block_the_queue(self):
+        campaign = Campaign.objects.create(
+            key='debug', name="Debug", subject="Debug", debug_mode=True)
+        for i in range(3):
+            create_mail(campaign=campaign)
+        mail = create_mail()
+        with mock.patch('mailing.utils.DEBUG_EMAIL', None):
+            results = [send_queued_mails(2) for i in range(2)]
+        self.assertEqual(results, [(0, 2), (1, 1)])
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, Mail.STATUS_SENT)
+
+    def test_partition(self):
+        mails = [create_mail() for i in range(5)]
+        claimed = []
+        for index in range(3):
+            queue = DatabaseQueue()
+            queue.set_partition(index, 3)
+            claimed.append({mail.pk for mail in queue.claim()})
+        self.assertEqual(set.union(*claimed), {mail.pk for mail in mails})
+        self.assertEqual(sum(map(len, claimed)), 5)
+
+    def test_worker_full_batches(self):
+        for i in range(3):
+            create_mail()
+        # The next batch is sent right away after a full one.
+        with mock.patch('threading.Event.wait') as wait:
+            call_command(
+                'send_queued_mails_worker', '--batch-size', '2',
+                '--max-mails', '3')
+        wait.assert_not_called()
+        self.assertEqual(len(django_mail.outbox), 3)
+
+    def test_ack_keeps_canceled_mails(self):
+        create_mail()
+        create_mail()
+        queue = DatabaseQueue()
+        sent, canceled = queue.claim()
+        Mail.objects.filter(pk=canceled.pk).update(
+            status=Mail.STATUS_CANCELED)
+        queue.ack([sent, canceled], timezone.now())
+        sent.refresh_from_db()
+        self.assertEqual(sent.status, Mail.STATUS_SENT)
+        canceled.refresh_from_db()
+        self.assertEqual(canceled.status, Mail.STATUS_CANCELED)
+        self.assertIsNone(canceled.sent_on)
+
+
+class RedisQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.server = RedisServer()
+        self.addCleanup(self.server.stop)
+        self.queue = RedisQueue(self.server.start(), batch_size=2)
+        self.addCleanup(self.queue.connection.close)
+
+    def test_claim(self):
+        mails = [create_mail() for i in range(3)]
+        later = create_mail(scheduled_on=timezone.now() + timedelta(hours=1))
+        deleted = create_mail()
+        self.queue.push([(mail.pk, time.time() - 60) for mail in mails])
+        self.queue.push([(later.pk, time.time() + 3600)])
+        self.queue.push([(deleted.pk, time.time() - 120)])
+        deleted.delete()
+        self.assertEqual(len(self.queue), 5)
+        # The deleted mail is dropped, batches are limited to batch_size.
+        self.assertEqual(self.queue.claim(), mails[:1])
+        self.assertEqual(self.queue.claim(), mails[1:])
+        self.assertEqual(self.queue.claim(), [])
+        self.assertEqual(len(self.queue), 1)
+        self.queue.ack(mails[:2], timezone.now())
+        self.queue.nack(mails[2:], retry=True)
+        self.assertEqual(
+            self.server.data[b'mailing:queue:claimed'], {})
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(
+            Mail.objects.filter(status=Mail.STATUS_SENT).count(), 2)
+
+    def test_recover(self):
+        mail = create_mail()
+        self.queue.push([(mail.pk, time.time())])
+        self.assertEqual(self.queue.claim(), [mail])
+        self.assertEqual(self.queue.claim(), [])
+        # The claiming process died before acking the mail.
+        self.queue.visibility_timeout = 0
+        self.assertEqual(self.queue.claim(), [mail])
+
+    def test_crash_after_claim(self):
+        mail = create_mail()
+        self.queue.push([(mail.pk, time.time())])
+        with mock.patch.object(
+                RedisQueue, 'get_pending_mails', side_effect=OSError):
+            with self.assertRaises(OSError):
+                self.queue.claim()
+        # The mail was moved to the claimed set in the same step as it was
+        # popped, so it is recovered after the visibility timeout.
+        self.assertEqual(
+            list(self.server.data[b'mailing:queue:claimed']),
+            [str(mail.pk).encode()])
+        self.queue.visibility_timeout = 0
+        self.assertEqual(self.queue.claim(), [mail])
+
+    def test_reconnect(self):
+        self.queue.clear()
+        self.queue.connection._sock.close()
+        self.assertEqual(len(self.queue), 0)
+
+    def test_claim_reply_lost(self):
+        mails = [create_mail() for i in range(3)]
+        self.queue.push([(mail.pk, time.time()) for mail in mails])
+        self.assertEqual(len(self.queue), 3)
+        with mock.patch.object(
+                RedisConnection, '_read_reply', side_effect=EOFError):
+            with self.assertRaises(EOFError):
+                self.queue.claim()
+        # The claim is not sent again, which would claim a second batch.
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(
+            len(self.server.data[b'mailing:queue:claimed']), 2)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.core import mail as outbox
+from django.test import TestCase, override_settings
+
+from mailing.models import Mail
+from mailing.signals import (
+    pre_render, post_render, pre_send, post_send, batch_finished,
+)
+from mailing.utils import queue_mail, send_queued_mails
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class SignalsTestCase(TestCase):
+
+    def setUp(self):
+        self.received = []
+        for signal in (pre_render, post_render, pre_send, post_send,
+                       batch_finished):
+            signal.connect(self.receiver, sender=Mail)
+            self.addCleanup(signal.disconnect, self.receiver, sender=Mail)
+
+    def receiver(self, signal, sender, **kwargs):
+        self.received.append((signal, kwargs))
+
+    def queue_mail(self):
+        return queue_mail(
+            None, {'name': "World"}, {'To': 'test@example.com'},
+            subject="Hello {{ name }}", html_template="<p>{{ name }}</p>")
+
+    def test_render_and_send(self):
+        mail = self.queue_mail()
+        self.assertEqual(send_queued_mails(), (1, 0))
+        self.assertEqual(len(outbox.outbox), 1)
+        signals = [signal for signal, kwargs in self.received]
+        self.assertEqual(signals, [
+            pre_render, post_render, pre_send, post_send, batch_finished])
+        kwargs = dict((signal, kwargs) for signal, kwargs in self.received)
+
+        self.assertEqual(kwargs[pre_render]['subject'], "Hello {{ name }}")
+        self.assertIsNone(kwargs[pre_render]['campaign_key'])
+        self.assertEqual(kwargs[post_render]['mail_id'], mail.pk)
+        self.assertEqual(
+            sorted(kwargs[post_render]['durations']), ['db', 'render'])
+        self.assertEqual(kwargs[pre_send]['mail_id'], mail.pk)
+        self.assertEqual(
+            sorted(kwargs[post_send]['durations']), ['mime', 'smtp'])
+        self.assertIsNotNone(kwargs[post_send]['message'])
+        self.assertIsNone(kwargs[post_send]['exception'])
+        self.assertEqual(kwargs[batch_finished]['nb_successes'], 1)
+        self.assertEqual(
+            sorted(kwargs[batch_finished]['durations']),
+            ['db', 'mime', 'smtp'])
+
+    def test_send_failure(self):
+        mail = self.queue_mail()
+        error = OSError("Connection refused")
+        with mock.patch(
+                'django.core.mail.EmailMultiAlternatives.send',
+                side_effect=error):
+            self.assertEqual(send_queued_mails(), (0, 1))
+        kwargs = dict((signal, kwargs) for signal, kwargs in self.received)
+        self.assertEqual(kwargs[post_send]['mail_id'], mail.pk)
+        self.assertIs(kwargs[post_send]['exception'], error)
+        self.assertIsNone(kwargs[post_send]['message'])
+        self.assertEqual(kwargs[batch_finished]['nb_failures'], 1)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from django.core.mail import EmailMessage, get_connection
+from django.test import SimpleTestCase
+
+from mailing.smtpsink import SMTPSink
+
+
+class SMTPSinkTestCase(SimpleTestCase):
+
+    def test_send(self):
+        received = []
+        sink = SMTPSink(on_message=lambda *args: received.append(args))
+        host, port = sink.start()
+        self.addCleanup(sink.stop)
+        connection = get_connection(
+            'django.core.mail.backends.smtp.EmailBackend',
+            host=host, port=port)
+        messages = [
+            EmailMessage("Hello", ".dotted line\nbody", 'from@example.com',
+                         ['to@example.com'], cc=['cc@example.com'])
+            for i in range(2)
+        ]
+        self.assertEqual(connection.send_messages(messages), 2)
+        self.assertEqual(sink.nb_messages, 2)
+        mail_from, rcpt_tos, data = received[0]
+        self.assertEqual(mail_from, '<from@example.com>')
+        self.assertEqual(rcpt_tos, ['<to@example.com>', '<cc@example.com>'])
+        self.assertIn(b'\r\n.dotted line\r\n', data)
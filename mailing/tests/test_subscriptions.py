@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+from io import StringIO
+import os
+import tempfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from mailing.models import Blacklist, Subscription, SubscriptionType
+from mailing.utils import get_subscriptions_management_url
+
+
+class BulkSubscriptionTestCase(TestCase):
+
+    def setUp(self):
+        self.newsletter = SubscriptionType.objects.create(
+            name="Newsletter", description="")
+        self.offers = SubscriptionType.objects.create(
+            name="Offers", description="")
+        Subscription.objects.create(
+            email='John@Example.com', subscription_type=self.newsletter)
+
+    def assertSubscriptions(self, expected):
+        self.assertEqual(
+            sorted(Subscription.objects.values_list(
+                'email', 'subscription_type__name', 'subscribed')),
+            sorted(expected))
+
+    def test_bulk_set_subscribed(self):
+        result = Subscription.objects.bulk_set_subscribed(
+            ['john@example.com', ' jane@example.com', '', 'JANE@example.com'],
+            [self.newsletter.pk, self.offers.pk], subscribed=False,
+            batch_size=1)
+        # The second JANE batch updates the subscriptions created by the first.
+        self.assertEqual(result, (3, 3))
+        self.assertSubscriptions([
+            ('John@Example.com', "Newsletter", False),
+            ('john@example.com', "Offers", False),
+            ('jane@example.com', "Newsletter", False),
+            ('jane@example.com', "Offers", False),
+        ])
+
+    @override_settings(ROOT_URLCONF='mailing.tests.urls')
+    def test_admin_view(self):
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        response = self.client.post(
+            reverse('admin:bulk_subscription_management'), {
+                'emails': "JOHN@example.com\njane@example.com",
+                'unsubscribe': [self.newsletter.pk],
+            })
+        self.assertRedirects(
+            response, reverse('admin:mailing_subscription_changelist'))
+        self.assertSubscriptions([
+            ('John@Example.com', "Newsletter", False),
+            ('jane@example.com', "Newsletter", False),
+        ])
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write("name;email\nJohn;john@example.com\nJane;jane@example.com\n")
+        self.addCleanup(os.remove, f.name)
+        call_command(
+            'bulk_subscription_management', f.name, "Offers", '--subscribe',
+            '--column', '1', '--delimiter', ';', stdout=StringIO())
+        self.assertSubscriptions([
+            ('John@Example.com', "Newsletter", True),
+            ('john@example.com', "Offers", True),
+            ('jane@example.com', "Offers", True),
+        ])
+
+
+class NormalizedEmailTestCase(TestCase):
+
+    def test_blacklist(self):
+        Blacklist.objects.create(email='John@Example.com ')
+        self.assertEqual(
+            Blacklist.objects.get().normalized_email, 'john@example.com')
+        self.assertEqual(
+            Blacklist.objects.filter_blacklisted(
+                'JOHN <john@example.COM>, jane@example.com', None),
+            [' jane@example.com', None])
+
+    def test_is_subscribed(self):
+        newsletter = SubscriptionType.objects.create(
+            name="Newsletter", description="", subscribed_by_default=True)
+        Subscription.objects.create(
+            email='John@Example.com', subscription_type=newsletter,
+            subscribed=False)
+        self.assertFalse(newsletter.is_subscribed('john@EXAMPLE.com'))
+        self.assertTrue(newsletter.is_subscribed('jane@example.com'))
+
+
+@mock.patch('mailing.models.manager.SUBSCRIPTION_CACHE_TIMEOUT', 60)
+class SubscriptionCacheTestCase(TestCase):
+
+    def setUp(self):
+        Subscription.objects._local_cache.clear()
+        self.addCleanup(Subscription.objects._local_cache.clear)
+        self.addCleanup(cache.clear)
+        self.newsletter = SubscriptionType.objects.create(
+            name="Newsletter", description="", subscribed_by_default=True)
+
+    def assertCached(self, email, expected):
+        self.newsletter.is_subscribed(email)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.newsletter.is_subscribed(email), expected)
+
+    def test_invalidation(self):
+        self.assertCached('john@example.com', True)
+        subscription = Subscription.objects.create(
+            email='John@Example.com', subscription_type=self.newsletter,
+            subscribed=False)
+        self.assertCached('john@example.com', False)
+        Subscription.objects.create_or_update(
+            email='John@Example.com', subscription_type=self.newsletter,
+            subscribed=True)
+        self.assertCached('john@example.com', True)
+        subscription.delete()
+        self.assertCached('john@example.com', True)
+        Subscription.objects.bulk_set_subscribed(
+            ['JOHN@example.com'], [self.newsletter.pk], subscribed=False)
+        self.assertCached('john@example.com', False)
+
+    @mock.patch('mailing.models.manager.SUBSCRIPTION_CACHE', 'default')
+    def test_cache_backend(self):
+        self.assertCached('john@example.com', True)
+        self.assertFalse(Subscription.objects._local_cache)
+        Subscription.objects.create(
+            email='john@example.com', subscription_type=self.newsletter,
+            subscribed=False)
+        self.assertCached('john@example.com', False)
+
+    @mock.patch('mailing.models.manager.SUBSCRIPTION_CACHE_MAX_ENTRIES', 1)
+    def test_max_entries(self):
+        self.assertCached('john@example.com', True)
+        self.assertCached('jane@example.com', True)
+        with self.assertNumQueries(1):
+            self.newsletter.is_subscribed('john@example.com')
+
+    def test_filter_subscribed(self):
+        Subscription.objects.create(
+            email='john@example.com', subscription_type=self.newsletter,
+            subscribed=False)
+        self.assertCached('jane@example.com', True)
+        emails = ['Jack <jack@example.com>', 'JOHN@example.com',
+                  'jane@example.com']
+        # Only the addresses missing from the cache are queried.
+        with self.assertNumQueries(1):
+            subscribed = self.newsletter.filter_subscribed(emails)
+        self.assertEqual(
+            subscribed, ['Jack <jack@example.com>', 'jane@example.com'])
+        with self.assertNumQueries(0):
+            self.newsletter.filter_subscribed(emails)
+        self.newsletter.subscribed_by_default = False
+        self.assertEqual(self.newsletter.filter_subscribed(emails), [])
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class SubscriptionsManagementViewTestCase(TestCase):
+
+    def setUp(self):
+        self.types = [
+            SubscriptionType.objects.create(
+                name="Type {}".format(i), description="",
+                subscribed_by_default=bool(i % 2))
+            for i in range(4)
+        ]
+        Subscription.objects.create(
+            email='john@example.com', subscription_type=self.types[0],
+            subscribed=True)
+        Subscription.objects.create(
+            email='john@example.com', subscription_type=self.types[1],
+            subscribed=True)
+        self.url = get_subscriptions_management_url('john@example.com')
+        SubscriptionType.objects.cached()
+
+    def test_get(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        form = response.context['form']
+        self.assertEqual(
+            [form[name].initial for name in form.fields],
+            [True, True, False, True])
+
+    def test_post(self):
+        data = {'subscribed_{}'.format(self.types[i].pk): 'on' for i in [1, 2]}
+        # SELECT, savepoint, SELECT types, INSERT, UPDATE, savepoint release.
+        with self.assertNumQueries(6):
+            response = self.client.post(self.url, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            sorted(Subscription.objects.values_list(
+                'subscription_type__name', 'subscribed')),
+            [("Type 0", False), ("Type 1", True), ("Type 2", True),
+             ("Type 3", False)])
+
+    def test_post_deleted_type(self):
+        # Deleted by another process, while still cached by this one.
+        SubscriptionType.objects.filter(pk=self.types[2].pk).delete()
+        data = {'subscribed_{}'.format(self.types[i].pk): 'on' for i in [1, 2]}
+        response = self.client.post(self.url, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            sorted(Subscription.objects.values_list(
+                'subscription_type_id', 'subscribed')),
+            [(self.types[0].pk, False), (self.types[1].pk, True),
+             (self.types[3].pk, False)])
+
+    @mock.patch('mailing.models.manager.SUBSCRIPTION_CACHE', 'default')
+    def test_cache_backend(self):
+        self.addCleanup(cache.clear)
+        self.assertEqual(SubscriptionType.objects.cached(), self.types)
+        self.assertEqual(cache.get('mailing:subscription_types'), self.types)
+        self.types[0].delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                SubscriptionType.objects.cached(), self.types[1:])
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
-from django.test import TestCase
+from io import StringIO
 
-from mailing.utils import html_to_text
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from mailing.models import Mail, MailHeader, MailRecipient
+from mailing.utils import html_to_text, queue_mail
 
 
 class HtmlToTextTestCase(TestCase):
@@ -108,3 +112,54 @@ class HtmlToTextTestCase(TestCase):
         html = "<a href='https://github.com/'>https://github.com/</a>"
         text = "https://github.com/"
         self.assertEqual(html_to_text(html), text)
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class QueueMailTestCase(TestCase):
+
+    def queue_mail(self, **kwargs):
+        return queue_mail(
+            None, {'name': "World"}, {'To': 'test@example.com'},
+            subject="Hello {{ name }}", html_template="<p>{{ name }}</p>",
+            **kwargs)
+
+    def test_headers_inline(self):
+        mail = self.queue_mail()
+        self.assertFalse(MailHeader.objects.filter(mail=mail).exists())
+        mail = Mail.objects.get(pk=mail.pk)
+        with self.assertNumQueries(0):
+            headers = mail.get_headers()
+        self.assertEqual(headers['To'], 'test@example.com')
+        self.assertEqual(headers['X-Mail-Id'], str(mail.pk))
+        self.assertEqual(dict(mail.headers.items()), mail.inline_headers)
+
+    def test_header_rows(self):
+        mail = self.queue_mail()
+        mail.inline_headers = None
+        mail.save()
+        mail.headers.create(name='To', value='other@example.com')
+        self.assertEqual(mail.get_headers()['To'], 'other@example.com')
+
+    def test_recipients_index(self):
+        mail = queue_mail(
+            None, {}, {
+                'To': 'John <John@Example.com>, jane@example.com',
+                'Cc': 'cc@example.org',
+            }, subject="Hello", html_template="<p>Hello</p>")
+        self.assertEqual(
+            sorted(mail.recipients.values_list('kind', 'address', 'domain')),
+            [
+                (MailRecipient.KIND_TO, 'jane@example.com', 'example.com'),
+                (MailRecipient.KIND_TO, 'john@example.com', 'example.com'),
+                (MailRecipient.KIND_CC, 'cc@example.org', 'example.org'),
+            ])
+        self.assertEqual(
+            list(Mail.objects.sent_to('JOHN <john@example.COM>')), [mail])
+        self.assertEqual(list(Mail.objects.sent_to_domain('example.org')), [mail])
+        self.assertFalse(Mail.objects.sent_to('bob@example.com').exists())
+
+    def test_index_mail_recipients(self):
+        mail = self.queue_mail()
+        mail.recipients.all().delete()
+        call_command('index_mail_recipients', stdout=StringIO())
+        self.assertEqual(list(Mail.objects.sent_to('test@example.com')), [mail])
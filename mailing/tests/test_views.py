@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from mailing.models import Mail
+
+
+@override_settings(ROOT_URLCONF='mailing.tests.urls')
+class MirrorViewTestCase(TestCase):
+
+    def setUp(self):
+        self.mail = Mail.objects.create(
+            subject="Test", html_body="<p>Test</p>", status=Mail.STATUS_SENT,
+            sent_on=timezone.now())
+        self.url = self.mail.get_absolute_url()
+
+    def test_sent_mail(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.content, b"<p>Test</p>")
+        self.assertTrue(response['ETag'])
+        self.assertIn('max-age=', response['Cache-Control'])
+
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_pending_mail(self):
+        self.mail.status = Mail.STATUS_PENDING
+        self.mail.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response.content, b"<p>Test</p>")
+        self.assertFalse(response.has_header('ETag'))
+
+    @mock.patch('mailing.views.MIRROR_CACHE', 'default')
+    def test_cache(self):
+        self.addCleanup(cache.clear)
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.content, b"<p>Test</p>")
+
+    def test_not_found(self):
+        self.mail.delete()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
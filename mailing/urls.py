@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from django.conf.urls import url
 
-from .views import MirrorView, SubscriptionsManagementView
+from .views import MetricsView, MirrorView, SubscriptionsManagementView
 
 __all__ = [
     'app_name', 'urlpatterns',
@@ -13,4 +13,5 @@ urlpatterns = [
         MirrorView.as_view(), name='mirror'),
     url(r'^subscriptions/(?P<signed_email>.+:[a-zA-Z0-9_-]+)/$',
         SubscriptionsManagementView.as_view(), name='subscriptions'),
+    url(r'^metrics/$', MetricsView.as_view(), name='metrics'),
 ]
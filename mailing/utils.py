@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2019 Aladom SAS & Hosting Dvpt SAS
+from collections import defaultdict
+from contextlib import contextmanager
 from functools import lru_cache
 import logging
 import re
+import time
 import warnings
 
 from django.conf import settings
@@ -17,8 +20,15 @@ from django.utils.html import strip_tags
 
 from .conf import (
     UNEXISTING_CAMPAIGN_FAIL_SILENTLY, SUBSCRIPTION_SIGNING_SALT, DEBUG_EMAIL,
+    OUTBOX_ENABLED,
+)
+from .models import (
+    Mail, MailRecipient, MailStaticAttachment, Campaign, Blacklist,
+)
+from .queues import get_queue
+from .signals import (
+    pre_render, post_render, pre_send, post_send, batch_finished,
 )
-from .models import Mail, Campaign, Blacklist
 
 __all__ = [
     'render_mail', 'queue_mail', 'send_mail', 'html_to_text', 'mail_logger',
@@ -50,6 +60,16 @@ class NoMoreRecipients(ValueError):
     pass
 
 
+@contextmanager
+def _timed(durations, key):
+    """Add the time spent within the block to `durations[key]`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        durations[key] += time.perf_counter() - started
+
+
 def AutoescapeTemplate(value):
     return get_template_backend().from_string(
         '{% autoescape off %}' + value + '{% endautoescape %}')
@@ -115,15 +135,23 @@ def render_mail(subject, html_template, headers, context=None, **kwargs):
 
     headers.setdefault('From', settings.DEFAULT_FROM_EMAIL)
     campaign = kwargs.get('campaign')
+    campaign_key = campaign.key if campaign else None
+    durations = defaultdict(float)
 
-    subject = AutoescapeTemplate(subject).render(context)
+    pre_render.send(
+        sender=Mail, campaign_key=campaign_key, subject=subject,
+        headers=headers)
+
+    with _timed(durations, 'render'):
+        subject = AutoescapeTemplate(subject).render(context)
 
     mail = Mail(subject=subject, status=Mail.STATUS_DRAFT)
     if 'campaign' in kwargs:
         mail.campaign = kwargs['campaign']
     if 'scheduled_on' in kwargs:
         mail.scheduled_on = kwargs['scheduled_on']
-    mail.save()
+    with _timed(durations, 'db'):
+        mail.save()
 
     mailing_ctx = {
         'subject': subject,
@@ -133,15 +161,18 @@ def render_mail(subject, html_template, headers, context=None, **kwargs):
         mailing_ctx['campaign'] = campaign
     context.update({'mailing': mailing_ctx})
 
-    rendered_headers = dict((name, AutoescapeTemplate(value).render(context))
-                            for name, value in headers.items())
-
-    rendered_headers['To'], rendered_headers['Cc'], rendered_headers['Bcc'] = \
-        Blacklist.objects.filter_blacklisted(
-            rendered_headers.get('To'),
-            rendered_headers.get('Cc'),
-            rendered_headers.get('Bcc'),
-            ignore=ignore_blacklist)
+    with _timed(durations, 'render'):
+        rendered_headers = dict(
+            (name, AutoescapeTemplate(value).render(context))
+            for name, value in headers.items())
+
+    with _timed(durations, 'db'):
+        rendered_headers['To'], rendered_headers['Cc'], \
+            rendered_headers['Bcc'] = Blacklist.objects.filter_blacklisted(
+                rendered_headers.get('To'),
+                rendered_headers.get('Cc'),
+                rendered_headers.get('Bcc'),
+                ignore=ignore_blacklist)
     if not rendered_headers['To']:
         mail.delete()
         raise NoMoreRecipients("All main recipients are blacklisted")
@@ -151,11 +182,9 @@ def render_mail(subject, html_template, headers, context=None, **kwargs):
         del rendered_headers['Bcc']
 
     if campaign:
-        actual_to = []
-        for email in rendered_headers['To'].split(','):
-            email = email.strip()
-            if campaign.is_subscribed(email):
-                actual_to.append(email)
+        with _timed(durations, 'db'):
+            actual_to = campaign.filter_subscribed([
+                email.strip() for email in rendered_headers['To'].split(',')])
         if not actual_to:
             mail.delete()
             raise NoMoreRecipients("All main recipients left are unsubscribed")
@@ -170,31 +199,41 @@ def render_mail(subject, html_template, headers, context=None, **kwargs):
     mailing_ctx['headers'] = rendered_headers
     context.update({'mailing': mailing_ctx})
 
-    html_body = html_template.render(context)
+    with _timed(durations, 'render'):
+        html_body = html_template.render(context)
 
-    text_body = ""
-    if 'text_template' in kwargs:
-        text_template = kwargs['text_template']
-        if not hasattr(text_template, 'render'):
-            text_template = AutoescapeTemplate(text_template)
-        text_body = text_template.render(context)
+        text_body = ""
+        if 'text_template' in kwargs:
+            text_template = kwargs['text_template']
+            if not hasattr(text_template, 'render'):
+                text_template = AutoescapeTemplate(text_template)
+            text_body = text_template.render(context)
 
     mail.html_body = html_body
     mail.text_body = text_body
-    mail.save()
-
-    for name, value in rendered_headers.items():
-        mail.headers.create(name=name, value=value)
-
-    for attachments in ['static_attachments', 'dynamic_attachments']:
-        """Handle both static and dynamic attachments with the same logic."""
-        for attachment in kwargs.get(attachments, []):
-            mail_attachments = getattr(mail, attachments)
+    mail.inline_headers = rendered_headers
+    with _timed(durations, 'db'):
+        mail.save()
+        MailRecipient.objects.bulk_create(
+            MailRecipient.objects.from_headers(rendered_headers, mail=mail))
+
+        static_attachments = []
+        for attachment in kwargs.get('static_attachments', []):
+            if not isinstance(attachment, dict):
+                attachment = {'attachment': attachment}
+            static_attachments.append(
+                MailStaticAttachment.objects.build(mail=mail, **attachment))
+        MailStaticAttachment.objects.bulk_create(static_attachments)
+        # Dynamic attachments save their file on creation.
+        for attachment in kwargs.get('dynamic_attachments', []):
             if isinstance(attachment, dict):
-                mail_attachments.create(**attachment)
+                mail.dynamic_attachments.create(**attachment)
             else:
-                mail_attachments.create(attachment=attachment)
+                mail.dynamic_attachments.create(attachment=attachment)
 
+    post_render.send(
+        sender=Mail, mail=mail, mail_id=mail.pk, campaign_key=campaign_key,
+        durations=dict(durations))
     return mail
 
 
@@ -204,7 +243,9 @@ def render_campaign_mail(campaign, context=None, **kwargs):
     to you to catch these exceptions and handle them properly.
     """
     subject = kwargs.pop('subject', campaign.get_subject())
-    html_template = kwargs.pop('html_template', campaign.get_template())
+    html_template = kwargs.pop('html_template', None)
+    if html_template is None:
+        html_template = campaign.get_template()
     headers = dict(campaign.extra_headers.items())
     headers.update(kwargs.pop('extra_headers', None) or {})
     static_attachments = kwargs.pop('static_attachments', [])
@@ -241,7 +282,19 @@ def queue_mail(campaign_key=None, context=None, extra_headers=None, **kwargs):
     to you to catch these exceptions and handle them properly.
 
     Return the saved Mail instance.
+
+    If `outbox` is True (see conf.OUTBOX_ENABLED), only record the arguments
+    in the outbox, and return the OutboxMail instance. The mail is rendered
+    and queued after the current transaction is committed, by
+    `mailing.outbox.process_outbox`. The context, headers and keyword
+    arguments must then be made of JSON serializable values, model
+    instances, dates, decimals, UUIDs and files, or a TypeError is raised.
+    Files of dynamic attachments are stored in the outbox, and only written
+    to the storage when the mail is rendered.
     """
+    if kwargs.pop('outbox', OUTBOX_ENABLED):
+        from .outbox import record_mail
+        return record_mail(campaign_key, context, extra_headers, **kwargs)
     fail_silently = kwargs.pop('fail_silently',
                                UNEXISTING_CAMPAIGN_FAIL_SILENTLY)
     try:
@@ -252,7 +305,8 @@ def queue_mail(campaign_key=None, context=None, extra_headers=None, **kwargs):
                                **kwargs)
         else:
             try:
-                campaign = Campaign.objects.get(key=campaign_key)
+                campaign = Campaign.objects.select_related(
+                    'subscription_type').get(key=campaign_key)
             except Campaign.DoesNotExist as e:
                 if fail_silently:
                     warnings.warn(
@@ -271,6 +325,7 @@ def queue_mail(campaign_key=None, context=None, extra_headers=None, **kwargs):
         return None
     mail.status = Mail.STATUS_PENDING
     mail.save()
+    get_queue().enqueue([mail])
     return mail
 
 
@@ -282,6 +337,38 @@ def send_mail(mail):
 
     Return the `EmailMultiAlternatives` instance of the sent mail.
     """
+    return _send_mail(mail, defaultdict(float))
+
+
+def _send_mail(mail, durations):
+    campaign_key = mail.campaign.key if mail.campaign else None
+    pre_send.send(
+        sender=Mail, mail=mail, mail_id=mail.pk, campaign_key=campaign_key)
+    local_durations = defaultdict(float)
+    msg = exception = None
+    try:
+        with _timed(local_durations, 'mime'):
+            msg = _build_message(mail)
+        if msg is not None:
+            with _timed(local_durations, 'smtp'):
+                msg.send()
+    except Exception as e:
+        exception = e
+        raise
+    finally:
+        for key, duration in local_durations.items():
+            durations[key] += duration
+        post_send.send(
+            sender=Mail, mail=mail, mail_id=mail.pk, campaign_key=campaign_key,
+            message=msg if exception is None else None, exception=exception,
+            durations=dict(local_durations))
+    return msg
+
+
+def _build_message(mail):
+    """Return the `EmailMultiAlternatives` instance of a Mail instance, or
+    None if it must not be sent.
+    """
     subject = mail.subject
     html_body = mail.html_body
     text_body = mail.text_body or html_to_text(html_body)
@@ -315,13 +402,13 @@ def send_mail(mail):
         msg.attach(attachment.get_file_name(), attachment.get_file_content(),
                    attachment.get_mime_type())
 
-    msg.send()
     return msg
 
 
-def send_queued_mails():
+def send_queued_mails(limit=None):
     """Send Mail objects with `status` Mail.STATUS_PENDING and having
-    `scheduled_on` set on a past date.
+    `scheduled_on` set on a past date, as claimed from the QUEUE_BACKEND, at
+    most `limit` of them if given.
 
     Set `status` Mail.STATUS_SENT and `sent_on` to current datetime for each
     mail successfully sent.
@@ -332,28 +419,38 @@ def send_queued_mails():
     mails successfully sent and failures.
     """
     now = timezone.now()
-    mails = Mail.objects.filter(status=Mail.STATUS_PENDING,
-                                scheduled_on__lte=now)
+    durations = defaultdict(float)
+    queue = get_queue()
     successes = []
+    failures = []
+    skipped = []
 
+    with _timed(durations, 'db'):
+        mails = queue.claim(limit)
     for mail in mails:
         try:
-            msg = send_mail(mail)
+            msg = _send_mail(mail, durations)
         except Exception as e:
-            mail.status = Mail.STATUS_FAILURE
             mail.failure_reason = str(e)
-            mail.save()
+            failures.append(mail)
         else:
             if msg is not None:
-                successes.append(mail.pk)
+                successes.append(mail)
+            else:
+                skipped.append(mail)
 
-    if successes:
-        mails.filter(pk__in=successes).update(status=Mail.STATUS_SENT,
-                                              sent_on=now)
+    with _timed(durations, 'db'):
+        queue.ack(successes, now)
+        queue.nack(failures)
+        # Mails of campaigns in debug mode without DEBUG_EMAIL stay pending.
+        queue.nack(skipped, retry=True)
 
     nb_successes = len(successes)
     nb_failures = len(mails) - nb_successes
 
+    batch_finished.send(
+        sender=Mail, nb_successes=nb_successes, nb_failures=nb_failures,
+        durations=dict(durations))
     return nb_successes, nb_failures
 
 
@@ -1,18 +1,30 @@
 # -*- coding: utf-8 -*-
 from django.contrib import messages
+from django.core.cache import caches
 from django.core.exceptions import SuspiciousOperation
 from django.core.signing import Signer, BadSignature
-from django.http import HttpResponse
-from django.shortcuts import get_object_or_404
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import View, FormView
 
-from .conf import MIRROR_SIGNING_SALT, SUBSCRIPTION_SIGNING_SALT
+from .conf import (
+    MIRROR_SIGNING_SALT, SUBSCRIPTION_SIGNING_SALT, MIRROR_MAX_AGE, MIRROR_CACHE,
+    METRICS_ENABLED,
+)
 from .forms import SubscriptionsManagementForm
-from .models import Mail
+from .metrics import render_metrics
+from .models import Mail, MailArchive
 
 
 class MirrorView(View):
+    """Online version of a mail.
+
+    Sent mails never change: they are served with a strong ETag and a long
+    max-age, conditional requests are answered without loading the body, and
+    pages may be kept in the MIRROR_CACHE cache.
+    """
 
     def get(self, request, *args, **kwargs):
         signed_pk = kwargs['signed_pk']
@@ -22,9 +34,46 @@ class MirrorView(View):
         except BadSignature as e:
             raise SuspiciousOperation(e)
 
-        mail = get_object_or_404(Mail, pk=pk)
+        cache = caches[MIRROR_CACHE] if MIRROR_CACHE else None
+        cache_key = 'mailing:mirror:{}'.format(pk)
+        etag = html_body = None
+        cached = cache.get(cache_key) if cache else None
+        if cached is not None:
+            etag, html_body = cached
+        elif 'HTTP_IF_NONE_MATCH' in request.META:
+            etag = self.get_etag(pk, *self.get_values(pk, 'status', 'sent_on'))
+        if etag is not None:
+            response = get_conditional_response(request, etag=etag)
+            if response is not None:
+                return response
+
+        if html_body is None:
+            status, sent_on, html_body = self.get_values(
+                pk, 'status', 'sent_on', 'html_body')
+            etag = self.get_etag(pk, status, sent_on)
+            if cache and etag is not None:
+                cache.set(cache_key, (etag, html_body))
+
+        response = HttpResponse(html_body)
+        if etag is not None:
+            response['ETag'] = etag
+            patch_cache_control(response, private=True, max_age=MIRROR_MAX_AGE)
+        return response
+
+    @staticmethod
+    def get_values(pk, *fields):
+        for model in [Mail, MailArchive]:
+            try:
+                return model.objects.values_list(*fields).get(pk=pk)
+            except model.DoesNotExist:
+                pass
+        raise Http404("No mail matches the given query.")
 
-        return HttpResponse(mail.html_body)
+    @staticmethod
+    def get_etag(pk, status, sent_on):
+        if status != Mail.STATUS_SENT or sent_on is None:
+            return None
+        return quote_etag('{}-{}'.format(pk, sent_on.timestamp()))
 
 
 class SubscriptionsManagementView(FormView):
@@ -55,3 +104,17 @@ class SubscriptionsManagementView(FormView):
 
     def get_success_url(self):
         return self.request.path
+
+
+class MetricsView(View):
+    """Metrics of the mail queue in Prometheus text format, only available
+    when METRICS_ENABLED is True.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not METRICS_ENABLED:
+            raise Http404("Metrics are disabled.")
+        response = HttpResponse(
+            render_metrics(), content_type='text/plain; version=0.0.4')
+        patch_cache_control(response, no_cache=True)
+        return response